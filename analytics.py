@@ -0,0 +1,202 @@
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+
+from psycopg2.extras import RealDictCursor, execute_values
+
+from db import connection
+from metrics import DB_QUERY, timed
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+-- Колонки заполняются по мере прохождения анкеты разными пачками записи, поэтому без NOT NULL:
+-- INSERT ... ON CONFLICT проверяет NOT NULL до обнаружения конфликта
+CREATE TABLE IF NOT EXISTS survey_results (
+    survey_id TEXT PRIMARY KEY,
+    telegram_id BIGINT,
+    business_type TEXT,
+    status TEXT,
+    answers JSONB,
+    questions_answered INT,
+    generated_review TEXT,
+    final_review TEXT,
+    edited BOOLEAN,
+    model TEXT,
+    cache_status TEXT,
+    generation_seconds REAL,
+    llm_seconds REAL,
+    sent_whatsapp BOOLEAN,
+    started_at TIMESTAMPTZ,
+    review_requested_at TIMESTAMPTZ,
+    reviewed_at TIMESTAMPTZ,
+    sent_at TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS survey_results_business_started_idx ON survey_results (business_type, started_at);
+CREATE INDEX IF NOT EXISTS survey_results_started_idx ON survey_results (started_at);
+CREATE INDEX IF NOT EXISTS survey_results_telegram_idx ON survey_results (telegram_id, started_at DESC);
+"""
+
+# Колонки, которые может передать record(); не переданные остаются как были
+COLUMNS = (
+    "telegram_id", "business_type", "status", "answers", "questions_answered", "generated_review", "final_review",
+    "edited", "model", "cache_status", "generation_seconds", "llm_seconds", "sent_whatsapp",
+    "started_at", "review_requested_at", "reviewed_at", "sent_at",
+)
+
+UPSERT = (
+    "INSERT INTO survey_results (survey_id, " + ", ".join(COLUMNS) + ", updated_at) VALUES %s "
+    "ON CONFLICT (survey_id) DO UPDATE SET "
+    + ", ".join(f"{c} = COALESCE(EXCLUDED.{c}, survey_results.{c})" for c in COLUMNS)
+    + ", updated_at = EXCLUDED.updated_at"
+)
+
+# Доля доведённых до отзыва и до отправки в WhatsApp анкет и время генерации по business_type
+STATS_QUERY = """
+SELECT
+    business_type,
+    count(*) AS surveys,
+    count(reviewed_at) AS reviewed,
+    count(*) FILTER (WHERE sent_whatsapp) AS sent,
+    count(*) FILTER (WHERE edited) AS edited,
+    avg(generation_seconds) AS avg_generation,
+    percentile_cont(0.95) WITHIN GROUP (ORDER BY generation_seconds) AS p95_generation
+FROM survey_results
+WHERE started_at >= now() - make_interval(days => %s)
+GROUP BY business_type
+ORDER BY surveys DESC
+"""
+
+
+def now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# Запись результатов анкет в survey_results без ожидания в обработчиках.
+# record() только обновляет словарь в памяти: события одной анкеты между сбросами
+# сливаются в одну строку (последнее значение каждой колонки побеждает).
+# Фоновый поток пишет пачку одним INSERT ... ON CONFLICT раз в flush_interval секунд
+# или сразу при накоплении flush_rows анкет. Если БД недоступна, накопленное
+# ограничено max_pending анкетами, лишние события отбрасываются.
+# Таблица создаётся тем же потоком при первом сбросе, чтобы не задерживать запуск бота.
+class AnalyticsWriter:
+    def __init__(self, flush_interval: float = 1.0, flush_rows: int = 100, max_pending: int = 10000):
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # survey_id -> {колонка: значение}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self.events = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self._schema_ready = False
+        self._thread = threading.Thread(target=self._flush_loop, name="analytics-flush", daemon=True)
+        self._thread.start()
+
+    def _ensure_schema(self):
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SCHEMA)
+            conn.commit()
+        self._schema_ready = True
+
+    def record(self, survey_id: str, **fields):
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Неизвестные поля анкеты: {', '.join(sorted(unknown))}")
+        with self._lock:
+            row = self._pending.get(survey_id)
+            if row is None:
+                if len(self._pending) >= self.max_pending:
+                    self.dropped += 1
+                    return
+                row = self._pending[survey_id] = {}
+            row.update(fields)
+            row["updated_at"] = now()
+            self.events += 1
+            full = len(self._pending) >= self.flush_rows
+        if full:
+            self._wakeup.set()
+
+    def _flush_loop(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self._write()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка записи результатов анкет в БД: {e}")
+
+    def _write(self):
+        with self._flush_lock:
+            if not self._schema_ready:
+                self._ensure_schema()
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            rows = []
+            for survey_id, row in batch.items():
+                values = [row.get(c) for c in COLUMNS]
+                answers = COLUMNS.index("answers")
+                if values[answers] is not None:
+                    values[answers] = json.dumps(values[answers], ensure_ascii=False)
+                rows.append((survey_id, *values, row["updated_at"]))
+            try:
+                with connection() as conn:
+                    with timed(DB_QUERY.labels("analytics_write")):
+                        with conn.cursor() as cur:
+                            execute_values(cur, UPSERT, rows, page_size=len(rows))
+                        conn.commit()
+            except Exception:
+                # Возвращаем несохранённое, не затирая события, пришедшие во время записи
+                with self._lock:
+                    for survey_id, row in batch.items():
+                        newer = self._pending.get(survey_id)
+                        if newer is None:
+                            if len(self._pending) >= self.max_pending:
+                                self.dropped += 1
+                                continue
+                            self._pending[survey_id] = row
+                        else:
+                            self._pending[survey_id] = {**row, **newer}
+                raise
+            self.flushes += 1
+            self.rows_written += len(rows)
+
+    # Остановка с записью накопленного
+    def close(self):
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._write()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "events": self.events,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "errors": self.errors,
+        }
+
+
+# Сводка по business_type за последние days дней
+def completion_stats(days: int = 7):
+    with connection() as conn:
+        with timed(DB_QUERY.labels("analytics_stats")), conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(STATS_QUERY, (days,))
+            rows = cur.fetchall()
+        conn.rollback()
+    return rows
@@ -0,0 +1,138 @@
+import csv
+import io
+import json
+from collections import namedtuple
+
+from psycopg2.extras import execute_values
+
+from db import connection
+from metrics import DB_QUERY, timed
+
+# Описание таблицы для импорта/экспорта: колонки файла и запросы
+Spec = namedtuple("Spec", ["columns", "unique", "insert", "replace_by_business_type", "export_query"])
+
+SPECS = {
+    "users": Spec(
+        ("telegram_id", "business_type"),
+        "telegram_id",
+        "INSERT INTO users (telegram_id, business_type) VALUES %s "
+        "ON CONFLICT (telegram_id) DO UPDATE SET business_type = EXCLUDED.business_type",
+        False,
+        "SELECT telegram_id, business_type FROM users ORDER BY telegram_id",
+    ),
+    # Вопросы и промпты заменяются целиком для каждого business_type из файла;
+    # порядок вопросов – порядок строк в файле
+    "questions": Spec(
+        ("business_type", "question_text"),
+        None,
+        "INSERT INTO questions (business_type, question_text) VALUES %s",
+        True,
+        "SELECT business_type, question_text FROM questions ORDER BY business_type, id",
+    ),
+    "prompts": Spec(
+        ("business_type", "prompt_text"),
+        "business_type",
+        "INSERT INTO prompts (business_type, prompt_text) VALUES %s",
+        True,
+        "SELECT business_type, prompt_text FROM prompts ORDER BY business_type",
+    ),
+}
+
+PAGE_SIZE = 1000
+
+
+class BulkError(Exception):
+    pass
+
+
+# Разбор CSV (с заголовком, разделитель , или ;) или JSON (список объектов).
+# Возвращает [(номер строки, dict)].
+def parse(content: bytes, filename: str = ""):
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise BulkError("Файл должен быть в кодировке UTF-8")
+    if filename.lower().endswith(".json") or text.lstrip().startswith("["):
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            raise BulkError(f"Некорректный JSON: {e}")
+        if not isinstance(data, list):
+            raise BulkError("JSON должен содержать список объектов")
+        return [(i + 1, record) for i, record in enumerate(data)]
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+    # Номер строки с учётом заголовка
+    return [(reader.line_num, record) for record in reader]
+
+
+# Проверка строк: возвращает (кортежи для вставки, [(номер строки, ошибка)])
+def validate(kind: str, records):
+    spec = SPECS[kind]
+    rows, errors = [], []
+    seen = {}
+    for line, record in records:
+        if not isinstance(record, dict):
+            errors.append((line, "ожидается объект с полями " + ", ".join(spec.columns)))
+            continue
+        values = [str(record.get(column) if record.get(column) is not None else "").strip() for column in spec.columns]
+        missing = [column for column, value in zip(spec.columns, values) if not value]
+        if missing:
+            errors.append((line, "не заполнено: " + ", ".join(missing)))
+            continue
+        if kind == "users":
+            try:
+                values[0] = int(values[0])
+            except ValueError:
+                errors.append((line, f"telegram_id должен быть числом: {values[0]}"))
+                continue
+        if spec.unique:
+            value = values[spec.columns.index(spec.unique)]
+            if value in seen:
+                errors.append((line, f"{spec.unique} {value} повторяется (строка {seen[value]})"))
+                continue
+            seen[value] = line
+        rows.append(tuple(values))
+    return rows, errors
+
+
+# Загрузка одной транзакцией; progress(загружено, всего) вызывается после каждой страницы
+def load(kind: str, rows, progress=None) -> int:
+    spec = SPECS[kind]
+    with connection() as conn, timed(DB_QUERY.labels(f"bulk_load_{kind}")):
+        with conn.cursor() as cur:
+            if spec.replace_by_business_type:
+                business_types = sorted({row[0] for row in rows})
+                cur.execute(f"DELETE FROM {kind} WHERE business_type = ANY(%s)", (business_types,))
+            for start in range(0, len(rows), PAGE_SIZE):
+                execute_values(cur, spec.insert, rows[start:start + PAGE_SIZE], page_size=PAGE_SIZE)
+                if progress is not None:
+                    progress(min(start + PAGE_SIZE, len(rows)), len(rows))
+        conn.commit()
+    return len(rows)
+
+
+# Выгрузка в файл out (бинарный): CSV через COPY, JSON через серверный курсор. Возвращает число строк.
+def export(kind: str, fmt: str, out) -> int:
+    spec = SPECS[kind]
+    with connection() as conn, timed(DB_QUERY.labels(f"bulk_export_{kind}")):
+        if fmt == "csv":
+            with conn.cursor() as cur:
+                cur.copy_expert(f"COPY ({spec.export_query}) TO STDOUT WITH (FORMAT csv, HEADER, ENCODING 'UTF8')", out)
+                count = cur.rowcount
+        else:
+            count = 0
+            with conn.cursor(name=f"export_{kind}") as cur:
+                cur.itersize = PAGE_SIZE
+                cur.execute(spec.export_query)
+                out.write(b"[")
+                for row in cur:
+                    record = dict(zip(spec.columns, row))
+                    out.write((b",\n" if count else b"\n") + json.dumps(record, ensure_ascii=False).encode())
+                    count += 1
+                out.write(b"\n]\n")
+        conn.rollback()
+    return count
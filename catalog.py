@@ -0,0 +1,153 @@
+import logging
+import select
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from psycopg2.extras import RealDictCursor
+
+from config import CATALOG_TTL, CATALOG_MAX_SIZE, CATALOG_CHANNEL
+from db import connection, dedicated_connection
+from metrics import DB_QUERY, registry, timed
+
+logger = logging.getLogger(__name__)
+
+# Каталог для типа бизнеса: упорядоченные вопросы и текст промпта
+CatalogEntry = namedtuple("CatalogEntry", ["questions", "prompt"])
+
+
+# Загрузка вопросов и промпта одним соединением из пула
+def load_catalog(business_type: str) -> CatalogEntry:
+    with connection() as conn:
+        with timed(DB_QUERY.labels("load_catalog")), conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT question_text FROM questions WHERE business_type = %s ORDER BY id", (business_type,))
+            questions = tuple(row["question_text"] for row in cur.fetchall())
+            cur.execute("SELECT prompt_text FROM prompts WHERE business_type = %s LIMIT 1", (business_type,))
+            row = cur.fetchone()
+    return CatalogEntry(questions, row["prompt_text"] if row else None)
+
+
+# Кэш каталога в памяти процесса: LRU с ограничением размера и TTL
+class CatalogCache:
+    def __init__(self, loader, ttl: float, max_size: int):
+        self._loader = loader
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # business_type -> (CatalogEntry, время загрузки)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, business_type: str) -> CatalogEntry:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(business_type)
+            if cached is not None and now - cached[1] < self.ttl:
+                self._entries.move_to_end(business_type)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+            generation = self._generation
+
+        entry = self._loader(business_type)
+
+        with self._lock:
+            # Если во время загрузки пришла инвалидация, результат может быть устаревшим – не кэшируем
+            if generation == self._generation:
+                self._entries[business_type] = (entry, now)
+                self._entries.move_to_end(business_type)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return entry
+
+    # Сброс одного типа бизнеса или всего кэша (business_type=None)
+    def invalidate(self, business_type: str = None):
+        with self._lock:
+            self._generation += 1
+            if business_type:
+                self._entries.pop(business_type, None)
+            else:
+                self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+cache = CatalogCache(load_catalog, CATALOG_TTL, CATALOG_MAX_SIZE)
+
+
+registry.collector("catalog", cache.stats)
+
+
+def get_catalog(business_type: str) -> CatalogEntry:
+    return cache.get(business_type)
+
+
+# Прогрев при старте: загружаем в кэш каталоги всех типов бизнеса (не больше размера кэша)
+def warm_up():
+    with connection() as conn:
+        with timed(DB_QUERY.labels("catalog_types")), conn.cursor() as cur:
+            cur.execute("SELECT DISTINCT business_type FROM prompts ORDER BY business_type LIMIT %s", (cache.max_size,))
+            business_types = [row[0] for row in cur.fetchall()]
+    for business_type in business_types:
+        cache.get(business_type)
+
+
+# Оповещение всех процессов об изменении каталога (пустая строка – сбросить всё)
+def notify_catalog_changed(business_type: str = None):
+    with connection() as conn:
+        with timed(DB_QUERY.labels("notify_catalog")):
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_notify(%s, %s)", (CATALOG_CHANNEL, business_type or ""))
+            conn.commit()
+
+
+# Фоновый поток: LISTEN на канале каталога, сбрасывает кэш по уведомлениям.
+# При обрыве соединения переподключается и сбрасывает кэш целиком,
+# так как уведомления за время простоя могли быть пропущены.
+class CatalogListener(threading.Thread):
+    def __init__(self, cache: CatalogCache, channel: str, reconnect_delay: float = 5.0):
+        super().__init__(name="catalog-listener", daemon=True)
+        self.cache = cache
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _listen(self):
+        conn = dedicated_connection()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f'LISTEN "{self.channel}"')
+            self.cache.invalidate()
+            logger.info(f"Подписка на изменения каталога: {self.channel}")
+            while not self._stop_event.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    logger.info(f"Каталог изменён: {notify.payload or 'все типы бизнеса'}")
+                    self.cache.invalidate(notify.payload or None)
+        finally:
+            conn.close()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                logger.error(f"Ошибка подписки на изменения каталога: {e}")
+                self.cache.invalidate()
+                self._stop_event.wait(self.reconnect_delay)
+
+
+def start_listener() -> CatalogListener:
+    listener = CatalogListener(cache, CATALOG_CHANNEL)
+    listener.start()
+    return listener
@@ -3,9 +3,14 @@ import os
 # Токены ботов
 TELEGRAM_CLIENT_TOKEN = os.environ.get("TELEGRAM_CLIENT_TOKEN")  # для клиентского бота
 TELEGRAM_ADMIN_TOKEN = os.environ.get("TELEGRAM_ADMIN_TOKEN")    # для админ-бота
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")  # адрес Bot API (например, tools/fake_telegram.py)
+
+# Telegram ID администраторов через запятую; пусто – /invalidate, массовый импорт/экспорт и /stats недоступны никому
+ADMIN_IDS = {int(i) for i in os.environ.get("ADMIN_IDS", "").replace(" ", "").split(",") if i}
 
 # Ключ OpenAI
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE")                        # альтернативный адрес API (например, локальный тестовый сервер)
 
 # Параметры подключения к PostgreSQL
 DB_HOST = os.environ.get("DB_HOST")
@@ -14,3 +19,104 @@ DB_NAME = os.environ.get("DB_NAME")
 DB_USER = os.environ.get("DB_USER")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
 
+
+# Пул соединений с PostgreSQL
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))            # ожидание свободного соединения, с
+DB_POOL_CHECK_IDLE = float(os.environ.get("DB_POOL_CHECK_IDLE", "30"))     # пинговать соединения, простаивавшие дольше, с
+DB_POOL_STATS_INTERVAL = int(os.environ.get("DB_POOL_STATS_INTERVAL", "300"))  # период записи статистики пула в лог, с (0 – отключить)
+
+# Кэш каталога (вопросы и промпты по business_type)
+CATALOG_TTL = float(os.environ.get("CATALOG_TTL", "600"))                  # время жизни записи, с
+CATALOG_MAX_SIZE = int(os.environ.get("CATALOG_MAX_SIZE", "256"))          # максимум типов бизнеса в кэше
+CATALOG_CHANNEL = os.environ.get("CATALOG_CHANNEL", "catalog_changed")     # канал LISTEN/NOTIFY для инвалидации
+
+# Параметры генерации отзыва
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4")
+REVIEW_TEMPERATURE = float(os.environ.get("REVIEW_TEMPERATURE", "0.7"))
+REVIEW_MAX_TOKENS = int(os.environ.get("REVIEW_MAX_TOKENS", "200"))
+
+# Лимиты OpenAI, повторы и запасная модель
+OPENAI_RPM = float(os.environ.get("OPENAI_RPM", "500"))                    # запросов в минуту к основной модели (0 – без ограничений)
+OPENAI_TPM = float(os.environ.get("OPENAI_TPM", "40000"))                  # токенов в минуту к основной модели
+OPENAI_FALLBACK_MODEL = os.environ.get("OPENAI_FALLBACK_MODEL", "gpt-3.5-turbo")  # пустая строка – без запасной модели
+OPENAI_FALLBACK_RPM = float(os.environ.get("OPENAI_FALLBACK_RPM", "3500"))
+OPENAI_FALLBACK_TPM = float(os.environ.get("OPENAI_FALLBACK_TPM", "90000"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))        # повторов при 429/5xx
+OPENAI_BACKOFF_BASE = float(os.environ.get("OPENAI_BACKOFF_BASE", "0.5"))  # начальная задержка повтора, с
+OPENAI_BACKOFF_CAP = float(os.environ.get("OPENAI_BACKOFF_CAP", "8"))      # максимальная задержка повтора, с
+OPENAI_FALLBACK_WAIT = float(os.environ.get("OPENAI_FALLBACK_WAIT", "2"))  # ожидание лимита основной модели, после которого идём на запасную, с
+OPENAI_FALLBACK_QUEUE_DEPTH = int(os.environ.get("OPENAI_FALLBACK_QUEUE_DEPTH", "8"))  # или столько запросов в очереди к основной модели
+
+# Генерация отзывов вне потоков диспетчера
+REVIEW_WORKERS = int(os.environ.get("REVIEW_WORKERS", "4"))                # потоков для запросов к OpenAI
+REVIEW_MAX_PENDING = int(os.environ.get("REVIEW_MAX_PENDING", "32"))       # максимум заданий в очереди и в работе
+REVIEW_TIMEOUT = float(os.environ.get("REVIEW_TIMEOUT", "60"))             # срок ответа со всеми повторами, включая запасную модель, с
+REVIEW_STILL_WORKING_AFTER = float(os.environ.get("REVIEW_STILL_WORKING_AFTER", "10"))  # через сколько секунд сообщить «ещё работаю»
+
+# Потоковый вывод отзыва по мере генерации
+REVIEW_STREAMING = os.environ.get("REVIEW_STREAMING", "1") == "1"
+REVIEW_STREAM_EDIT_INTERVAL = float(os.environ.get("REVIEW_STREAM_EDIT_INTERVAL", "1.5"))  # минимум между правками одного сообщения, с
+REVIEW_STREAM_EDITS_PER_SECOND = float(os.environ.get("REVIEW_STREAM_EDITS_PER_SECOND", "20"))  # общий лимит правок на бота
+
+# Режим работы ботов: "polling" или "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "8"))                      # потоков для обработчиков обновлений
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))       # ёмкость очереди входящих обновлений
+UPDATE_QUEUE_PUT_TIMEOUT = float(os.environ.get("UPDATE_QUEUE_PUT_TIMEOUT", "1"))  # ожидание места в очереди (webhook), с
+UPDATE_QUEUE_STATS_INTERVAL = int(os.environ.get("UPDATE_QUEUE_STATS_INTERVAL", "300"))  # период записи статистики очереди, с
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "30"))               # сколько ждать разбора очереди при остановке, с
+UPDATE_REQUEUE_DELAY = float(os.environ.get("UPDATE_REQUEUE_DELAY", "0.1"))  # через сколько вернуть в очередь обновление, пришедшее во время обработки предыдущего, с
+UPDATE_REQUEUE_ATTEMPTS = int(os.environ.get("UPDATE_REQUEUE_ATTEMPTS", "100"))  # сколько раз возвращать его, прежде чем отбросить
+UPDATE_REQUEUE_PER_USER = int(os.environ.get("UPDATE_REQUEUE_PER_USER", "10"))  # сколько таких обновлений одного пользователя может ждать одновременно
+
+# Очередь исходящих сообщений (ограничения Bot API на частоту отправки)
+OUTBOUND_QUEUE_ENABLED = os.environ.get("OUTBOUND_QUEUE_ENABLED", "1") == "1"
+OUTBOUND_GLOBAL_PER_SECOND = float(os.environ.get("OUTBOUND_GLOBAL_PER_SECOND", "30"))  # всего запросов в секунду на бота
+OUTBOUND_CHAT_PER_SECOND = float(os.environ.get("OUTBOUND_CHAT_PER_SECOND", "1"))      # в один личный чат
+OUTBOUND_CHAT_BURST = float(os.environ.get("OUTBOUND_CHAT_BURST", "3"))                # допустимая пачка в личный чат
+OUTBOUND_GROUP_PER_MINUTE = float(os.environ.get("OUTBOUND_GROUP_PER_MINUTE", "20"))   # в одну группу в минуту
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", "4"))            # потоков отправки
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))    # повторов после RetryAfter
+
+# Параметры webhook (у каждого бота свой процесс и свои переменные окружения)
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")                                # публичный адрес, например https://bots.example.com
+
+# Хранение состояния диалогов клиентского бота в PostgreSQL
+PERSISTENCE_ENABLED = os.environ.get("PERSISTENCE_ENABLED", "1") == "1"
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", "2"))  # период пакетной записи, с
+PERSISTENCE_FLUSH_BATCH = int(os.environ.get("PERSISTENCE_FLUSH_BATCH", "200"))        # внеочередная запись при таком числе изменений
+PERSISTENCE_REFRESH = os.environ.get("PERSISTENCE_REFRESH", "0") == "1"    # подтягивать изменения других процессов перед каждым обновлением
+PERSISTENCE_TTL_DAYS = float(os.environ.get("PERSISTENCE_TTL_DAYS", "30"))  # удалять состояние анкет, не менявшееся столько дней (0 – хранить всегда)
+
+# Кэш сгенерированных отзывов
+REVIEW_CACHE_VARIANTS = int(os.environ.get("REVIEW_CACHE_VARIANTS", "3"))  # вариантов текста на один ключ (0 – кэш отключён)
+REVIEW_CACHE_SIZE = int(os.environ.get("REVIEW_CACHE_SIZE", "5000"))       # максимум ключей
+REVIEW_CACHE_TTL = float(os.environ.get("REVIEW_CACHE_TTL", "86400"))      # время жизни ключа, с
+REVIEW_STATS_INTERVAL = int(os.environ.get("REVIEW_STATS_INTERVAL", "300"))  # период записи статистики генерации в лог, с
+
+# Метрики: эндпоинт Prometheus и структурированные логи
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))                    # порт /metrics (0 – не запускать; у каждого бота свой)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "0.0.0.0")
+METRICS_LOG_INTERVAL = int(os.environ.get("METRICS_LOG_INTERVAL", "300"))  # период записи сводки метрик в лог (JSON), с (0 – отключить)
+METRICS_SLOW_HANDLER = float(os.environ.get("METRICS_SLOW_HANDLER", "1"))  # обработчики дольше, с, пишутся в лог как WARNING
+
+# Аналитика: результаты анкет в таблице survey_results (пакетная запись в фоне)
+ANALYTICS_ENABLED = os.environ.get("ANALYTICS_ENABLED", "1") == "1"
+ANALYTICS_FLUSH_MS = int(os.environ.get("ANALYTICS_FLUSH_MS", "1000"))     # период записи, мс
+ANALYTICS_FLUSH_ROWS = int(os.environ.get("ANALYTICS_FLUSH_ROWS", "100"))  # внеочередная запись при таком числе анкет
+ANALYTICS_MAX_PENDING = int(os.environ.get("ANALYTICS_MAX_PENDING", "10000"))  # максимум анкет в памяти, если БД недоступна
+
+# Запуск: прогрев пула БД, кэша каталога и openai в фоне после начала приёма обновлений
+STARTUP_WARMUP_RETRY = float(os.environ.get("STARTUP_WARMUP_RETRY", "5"))  # пауза между попытками прогрева, с
+
+# Запуск клиентского бота в нескольких процессах (sharding.py). Лимиты Bot API и OpenAI делятся
+# между воркерами поровну, пул БД (DB_POOL_MIN/MAX) и потоки (BOT_WORKERS, REVIEW_WORKERS) – у каждого свои
+SHARD_PROCESSES = int(os.environ.get("SHARD_PROCESSES", str(os.cpu_count() or 1)))  # процессов-воркеров
+SHARD_QUEUE_SIZE = int(os.environ.get("SHARD_QUEUE_SIZE", "1000"))         # очередь обновлений к каждому воркеру
+SHARD_PUT_TIMEOUT = float(os.environ.get("SHARD_PUT_TIMEOUT", "1"))        # ожидание места в очереди воркера (webhook), с
+SHARD_RESTART_DELAY = float(os.environ.get("SHARD_RESTART_DELAY", "5"))    # воркер, упавший раньше, перезапускается с такой паузой, с
+SHARD_STATS_INTERVAL = float(os.environ.get("SHARD_STATS_INTERVAL", "5"))  # как часто воркеры сообщают свою нагрузку, с
@@ -0,0 +1,291 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from config import (
+    DB_HOST,
+    DB_PORT,
+    DB_NAME,
+    DB_USER,
+    DB_PASSWORD,
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    DB_POOL_TIMEOUT,
+    DB_POOL_CHECK_IDLE,
+)
+from metrics import DB_POOL_WAIT, registry
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых соединение считается «мёртвым» (рестарт Postgres, обрыв сети)
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Потокобезопасный пул соединений с ожиданием свободного слота,
+# проверкой соединения при выдаче и статистикой.
+class ConnectionPool:
+    def __init__(self, minconn: int, maxconn: int, timeout: float, check_idle: float, **dsn):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Некорректные размеры пула: min=%s, max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._dsn = dsn
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, время возврата в пул)]
+        self._size = 0
+        self._in_use = 0
+        self._waiters = 0
+        self._closed = False
+        # Статистика
+        self._checkouts = 0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        return psycopg2.connect(**self._dsn)
+
+    # Открываем минимальное количество соединений заранее
+    def prefill(self):
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    # Проверка соединения: закрытые отбрасываем сразу, долго простаивавшие пингуем
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    # Соединение оказалось оборвано – остальные простаивающие открыты к тому же серверу
+    # (например, до рестарта Postgres), поэтому закрываем и их, не дожидаясь ошибок у пользователей
+    def _discard_idle(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        if idle:
+            logger.warning(f"Соединение с БД оборвано, закрываем простаивающие соединения: {len(idle)}")
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def getconn(self, timeout: float = None):
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise psycopg2.pool.PoolError("Пул соединений закрыт")
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        idle_since = None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            "Нет свободных соединений за %.1f с (занято %d из %d)" % (timeout, self._in_use, self.maxconn)
+                        )
+                    self._waiters += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiters -= 1
+
+            if conn is None:
+                # Свободный слот есть – открываем новое соединение вне блокировки
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn, idle_since):
+                logger.warning("Соединение с БД недоступно, переподключаемся")
+                self._discard(conn)
+                self._discard_idle()
+                with self._cond:
+                    self._reconnects += 1
+                continue
+
+            waited = time.monotonic() - started
+            DB_POOL_WAIT.labels().observe(waited)
+            with self._cond:
+                self._in_use += 1
+                self._checkouts += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            return conn
+
+    def putconn(self, conn, broken: bool = False):
+        with self._cond:
+            self._in_use -= 1
+        if broken or conn.closed or self._closed:
+            # closed выставляет сам psycopg2, когда соединение с сервером потеряно
+            lost = conn.closed and not self._closed
+            self._discard(conn)
+            if lost:
+                self._discard_idle()
+            return
+        try:
+            # Незавершённая транзакция не должна попасть к следующему потоку
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except CONNECTION_ERRORS:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        conn = self.getconn(timeout)
+        broken = False
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiters": self._waiters,
+                "max": self.maxconn,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+                "discarded": self._discarded,
+                "checkout_avg_ms": round(self._wait_total / self._checkouts * 1000, 2) if self._checkouts else 0.0,
+                "checkout_max_ms": round(self._wait_max * 1000, 2),
+            }
+
+
+# Параметры подключения, общие для пула и выделенных соединений
+DSN = dict(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Общий пул процесса, создаётся при первом обращении
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    DB_POOL_TIMEOUT,
+                    DB_POOL_CHECK_IDLE,
+                    **DSN,
+                )
+                try:
+                    pool.prefill()
+                except Exception as e:
+                    logger.error(f"Не удалось открыть начальные соединения с БД: {e}")
+                _pool = pool
+    return _pool
+
+
+# Использование: with connection() as conn: ...
+def connection(timeout: float = None):
+    return get_pool().connection(timeout)
+
+
+# Проверка доступности БД; заодно открывает начальные соединения пула (прогрев при старте)
+def ping():
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+
+
+# Отдельное соединение вне пула – для долгоживущих LISTEN и т.п.
+def dedicated_connection():
+    return psycopg2.connect(**DSN)
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def pool_stats() -> dict:
+    return get_pool().stats() if _pool is not None else {}
+
+
+registry.collector("db_pool", pool_stats)
+
+
+# Периодическая задача для job_queue: пишем статистику пула в лог
+def log_pool_stats(context=None):
+    stats = pool_stats()
+    if stats:
+        logger.info("DB pool: " + ", ".join(f"{k}={v}" for k, v in stats.items()))
@@ -0,0 +1,298 @@
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_API_BASE,
+    OPENAI_MODEL,
+    OPENAI_RPM,
+    OPENAI_TPM,
+    OPENAI_FALLBACK_MODEL,
+    OPENAI_FALLBACK_RPM,
+    OPENAI_FALLBACK_TPM,
+    OPENAI_MAX_RETRIES,
+    OPENAI_BACKOFF_BASE,
+    OPENAI_BACKOFF_CAP,
+    OPENAI_FALLBACK_WAIT,
+    OPENAI_FALLBACK_QUEUE_DEPTH,
+    REVIEW_TIMEOUT,
+)
+from metrics import LLM_DURATION, LLM_FIRST_TOKEN
+
+logger = logging.getLogger(__name__)
+
+_openai = None
+_openai_lock = threading.Lock()
+
+
+# Модуль openai с настройками API. Импорт openai 0.28 тянет aiohttp и requests и занимает
+# заметную часть запуска бота, поэтому откладывается до первого запроса (или прогрева warm_up)
+def openai_module():
+    global _openai
+    if _openai is None:
+        with _openai_lock:
+            if _openai is None:
+                import openai
+                openai.api_key = OPENAI_API_KEY
+                if OPENAI_API_BASE:
+                    # Например, локальный тестовый сервер tools/fake_openai.py
+                    openai.api_base = OPENAI_API_BASE
+                _openai = openai
+    return _openai
+
+
+# Фоновый прогрев после старта: первый отзыв не ждёт импорта openai
+def warm_up():
+    openai_module()
+
+LLMResult = namedtuple("LLMResult", ["text", "model", "latency", "first_token", "attempts"])
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+# Token bucket: capacity единиц, пополняется со скоростью per_minute в минуту.
+# Общий для всех потоков процесса; per_minute <= 0 – без ограничений.
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.unlimited = per_minute <= 0
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self.waiters = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # Сколько секунд придётся ждать amount единиц (без учёта других ожидающих)
+    def estimated_wait(self, amount: float) -> float:
+        if self.unlimited:
+            return 0.0
+        with self._cond:
+            self._refill(time.monotonic())
+            missing = min(amount, self.capacity) - self._tokens
+            return max(0.0, missing / self.rate) if self.rate else float("inf")
+
+    def acquire(self, amount: float, timeout: float):
+        if self.unlimited:
+            return
+        amount = min(amount, self.capacity)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.waiters += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._tokens >= amount:
+                        self._tokens -= amount
+                        return
+                    wait = (amount - self._tokens) / self.rate if self.rate else timeout
+                    if now + wait > deadline:
+                        raise RateLimitTimeout("Лимит запросов к OpenAI исчерпан")
+                    self._cond.wait(wait)
+            finally:
+                self.waiters -= 1
+
+    # Возврат неизрасходованного (оценка токенов оказалась завышенной)
+    def release(self, amount: float):
+        if self.unlimited:
+            return
+        with self._cond:
+            self._tokens = min(self.capacity, self._tokens + amount)
+            self._cond.notify_all()
+
+
+# Модель со своими лимитами запросов и токенов в минуту и статистикой
+class ModelRoute:
+    def __init__(self, name: str, rpm: float, tpm: float):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.latency = LLM_DURATION.labels(name)
+        self.first_token = LLM_FIRST_TOKEN.labels(name)
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.errors = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self.requests.waiters + self.tokens.waiters
+
+    def estimated_wait(self, tokens: int) -> float:
+        return max(self.requests.estimated_wait(1), self.tokens.estimated_wait(tokens))
+
+    def stats(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "queue_depth": self.queue_depth,
+            "errors": self.errors,
+            "latency": self.latency.stats(),
+            "first_token": self.first_token.stats(),
+        }
+
+
+# Грубая оценка числа токенов: для русского текста ~3 символа на токен
+def estimate_tokens(messages, max_tokens: int) -> int:
+    return sum(len(m["content"]) for m in messages) // 3 + max_tokens
+
+
+# Ошибки, после которых запрос имеет смысл повторить
+def is_retryable(error: Exception) -> bool:
+    openai = openai_module()
+    if isinstance(error, (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                          openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return (error.http_status or 500) >= 500
+    return False
+
+
+def retry_after(error: Exception):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Единая точка обращения к OpenAI: лимиты, повторы с экспоненциальной задержкой и джиттером,
+# переключение на запасную модель при перегрузке основной, гистограммы задержек по моделям.
+class LLMClient:
+    def __init__(self, primary: ModelRoute, fallback: ModelRoute = None, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_cap: float = 8.0, request_timeout: float = 60,
+                 fallback_wait: float = 2.0, fallback_queue_depth: int = 8):
+        self.primary = primary
+        self.fallback = fallback
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.request_timeout = request_timeout
+        self.fallback_wait = fallback_wait
+        self.fallback_queue_depth = fallback_queue_depth
+        self.fallback_routed = 0
+
+    # Основная модель, если она не перегружена, иначе запасная
+    def route(self, tokens: int) -> ModelRoute:
+        if self.fallback is None:
+            return self.primary
+        if (self.primary.queue_depth >= self.fallback_queue_depth
+                or self.primary.estimated_wait(tokens) > self.fallback_wait):
+            self.fallback_routed += 1
+            return self.fallback
+        return self.primary
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        return delay
+
+    # on_delta(text) вызывается с накопленным текстом при потоковой генерации.
+    # На все попытки отводится request_timeout секунд: запасная модель получает остаток этого срока.
+    def complete(self, messages, temperature: float, max_tokens: int, on_delta=None) -> LLMResult:
+        tokens = estimate_tokens(messages, max_tokens)
+        route = self.route(tokens)
+        attempt = 0
+        deadline = time.monotonic() + self.request_timeout
+        while True:
+            try:
+                return self._call(route, messages, temperature, max_tokens, tokens, on_delta, deadline, attempt + 1)
+            except Exception as e:
+                if isinstance(e, RateLimitTimeout):
+                    # Лимит модели не освободится до срока – это не ошибка модели, повторять на ней бесполезно
+                    exhausted = True
+                else:
+                    with route._lock:
+                        route.errors += 1
+                    if not is_retryable(e):
+                        raise
+                    delay = self._backoff(attempt, e)
+                    # Повтор, который начнётся уже после срока, не нужен
+                    exhausted = attempt >= self.max_retries or delay >= deadline - time.monotonic()
+                if exhausted:
+                    if route is self.primary and self.fallback is not None and time.monotonic() < deadline:
+                        # Основная модель так и не ответила – повторяем на запасной
+                        logger.warning(f"OpenAI {route.name} недоступна ({e}), переключаемся на {self.fallback.name}")
+                        route, attempt = self.fallback, 0
+                        self.fallback_routed += 1
+                        continue
+                    raise
+                logger.warning(f"OpenAI {route.name}: {e}; повтор через {delay:.1f} с")
+                time.sleep(delay)
+                attempt += 1
+
+    # request_timeout в openai ограничивает ожидание каждого чтения, а не весь потоковый ответ,
+    # поэтому срок проверяется и между фрагментами
+    def _call(self, route, messages, temperature, max_tokens, tokens, on_delta, deadline, attempts) -> LLMResult:
+        route.requests.acquire(1, max(0.0, deadline - time.monotonic()))
+        try:
+            route.tokens.acquire(tokens, max(0.0, deadline - time.monotonic()))
+        except RateLimitTimeout:
+            route.requests.release(1)
+            raise
+        with route._lock:
+            route.inflight += 1
+        call_started = time.monotonic()
+        try:
+            openai = openai_module()
+            response = openai.ChatCompletion.create(
+                model=route.name,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                request_timeout=max(1.0, deadline - call_started),
+                stream=on_delta is not None,
+            )
+            first_token = None
+            if on_delta is None:
+                text = response.choices[0].message.content
+                used = response.get("usage", {}).get("total_tokens")
+                if used is not None and used < tokens:
+                    route.tokens.release(tokens - used)
+            else:
+                text = ""
+                for chunk in response:
+                    if time.monotonic() > deadline:
+                        raise openai.error.Timeout(f"Потоковый ответ {route.name} не уложился в {self.request_timeout:.0f} с")
+                    delta = chunk.choices[0].delta.get("content", "") if chunk.choices else ""
+                    if delta and first_token is None:
+                        first_token = time.monotonic() - call_started
+                        route.first_token.observe(first_token)
+                    text += delta
+                    on_delta(text)
+            latency = time.monotonic() - call_started
+            route.latency.observe(latency)
+            if first_token is None:
+                # Без потоковой передачи текст виден пользователю только целиком
+                first_token = latency
+                route.first_token.observe(first_token)
+            return LLMResult(text.strip(), route.name, latency, first_token, attempts)
+        finally:
+            with route._lock:
+                route.inflight -= 1
+
+    def stats(self) -> dict:
+        stats = {"fallback_routed": self.fallback_routed, self.primary.name: self.primary.stats()}
+        if self.fallback is not None:
+            stats[self.fallback.name] = self.fallback.stats()
+        return stats
+
+
+client = LLMClient(
+    ModelRoute(OPENAI_MODEL, OPENAI_RPM, OPENAI_TPM),
+    ModelRoute(OPENAI_FALLBACK_MODEL, OPENAI_FALLBACK_RPM, OPENAI_FALLBACK_TPM) if OPENAI_FALLBACK_MODEL else None,
+    max_retries=OPENAI_MAX_RETRIES,
+    backoff_base=OPENAI_BACKOFF_BASE,
+    backoff_cap=OPENAI_BACKOFF_CAP,
+    request_timeout=REVIEW_TIMEOUT,
+    fallback_wait=OPENAI_FALLBACK_WAIT,
+    fallback_queue_depth=OPENAI_FALLBACK_QUEUE_DEPTH,
+)
@@ -1,20 +1,23 @@
+import startup  # первым: от начала его импорта считается время запуска
 import logging
-import psycopg2
+import tempfile
+import time
 from psycopg2.extras import RealDictCursor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, CallbackContext
-from config import TELEGRAM_ADMIN_TOKEN, DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+from telegram.ext import CommandHandler, MessageHandler, Filters, CallbackQueryHandler, CallbackContext
+from config import TELEGRAM_ADMIN_TOKEN, ADMIN_IDS, DB_POOL_STATS_INTERVAL
+from db import connection, close_pool, log_pool_stats, ping
+from serving import build_updater, run
+from catalog import notify_catalog_changed
+from metrics import DB_QUERY, instrumented, timed
+import analytics
+import bulk
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
-    )
-    return conn
-
 # Пример команды /adduser
+@instrumented("add_user")
 def add_user(update: Update, context: CallbackContext):
     # Ожидается: /adduser telegram_id business_type
     try:
@@ -23,25 +26,182 @@ def add_user(update: Update, context: CallbackContext):
     except (IndexError, ValueError):
         update.message.reply_text("Используйте: /adduser <telegram_id> <business_type>")
         return
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute("INSERT INTO users (telegram_id, business_type) VALUES (%s, %s) ON CONFLICT (telegram_id) DO NOTHING", (telegram_id, business_type))
-            conn.commit()
+        with connection() as conn:
+            with timed(DB_QUERY.labels("add_user")), conn.cursor() as cur:
+                cur.execute("INSERT INTO users (telegram_id, business_type) VALUES (%s, %s) ON CONFLICT (telegram_id) DO NOTHING", (telegram_id, business_type))
+                conn.commit()
         update.message.reply_text("Пользователь добавлен.")
     except Exception as e:
         logger.error(e)
         update.message.reply_text("Ошибка при добавлении пользователя.")
-    finally:
-        conn.close()
+
+# Сброс каталога, массовые операции и статистика затрагивают всех пользователей –
+# без ADMIN_IDS они недоступны никому
+def is_admin(update: Update) -> bool:
+    return update.effective_user.id in ADMIN_IDS
+
+# Команда /invalidate – сброс кэша вопросов и промптов в клиентских ботах
+@instrumented("invalidate_catalog")
+def invalidate_catalog(update: Update, context: CallbackContext):
+    if not is_admin(update):
+        update.message.reply_text("Нет доступа.")
+        return
+    # Ожидается: /invalidate [business_type]; без аргумента сбрасывается весь каталог
+    business_type = context.args[0] if context.args else None
+    try:
+        notify_catalog_changed(business_type)
+        update.message.reply_text(f"Кэш каталога сброшен: {business_type or 'все типы бизнеса'}.")
+    except Exception as e:
+        logger.error(e)
+        update.message.reply_text("Ошибка при сбросе кэша каталога.")
+
+# --- Массовый импорт и экспорт ---
+IMPORT_HELP = (
+    "Отправьте файл CSV или JSON с подписью users, questions или prompts.\n"
+    "Колонки: users – telegram_id, business_type; questions – business_type, question_text; "
+    "prompts – business_type, prompt_text.\n"
+    "Вопросы и промпты заменяются целиком для каждого business_type из файла."
+)
+MAX_IMPORT_SIZE = 20 * 1024 * 1024  # ограничение Bot API на скачивание файлов
+MAX_ERRORS_IN_MESSAGE = 20
+
+@instrumented("import_help")
+def import_help(update: Update, context: CallbackContext):
+    update.message.reply_text(IMPORT_HELP)
+
+@instrumented("import_document")
+def import_document(update: Update, context: CallbackContext):
+    if not is_admin(update):
+        update.message.reply_text("Нет доступа.")
+        return
+    kind = (update.message.caption or "").replace("/import", "").strip().lower()
+    if kind not in bulk.SPECS:
+        update.message.reply_text(IMPORT_HELP)
+        return
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_IMPORT_SIZE:
+        update.message.reply_text("Файл слишком большой (максимум 20 МБ).")
+        return
+
+    status = update.message.reply_text("Файл получен, проверяю...")
+    try:
+        content = bytes(document.get_file().download_as_bytearray())
+        records = bulk.parse(content, document.file_name or "")
+    except bulk.BulkError as e:
+        status.edit_text(f"Ошибка: {e}")
+        return
+    except Exception as e:
+        logger.error(e)
+        status.edit_text("Не удалось получить файл.")
+        return
+
+    rows, errors = bulk.validate(kind, records)
+    if errors:
+        lines = [f"Строка {line}: {message}" for line, message in errors]
+        status.edit_text(
+            f"Найдено ошибок: {len(errors)}, данные не загружены.\n" + "\n".join(lines[:MAX_ERRORS_IN_MESSAGE])
+        )
+        if len(errors) > MAX_ERRORS_IN_MESSAGE:
+            report = ("\n".join(lines) + "\n").encode()
+            update.message.reply_document(document=report, filename=f"{kind}_errors.txt")
+        return
+    if not rows:
+        status.edit_text("В файле нет строк для загрузки.")
+        return
+
+    last_edit = [0.0]
+
+    def progress(done: int, total: int):
+        now = time.monotonic()
+        if done < total and now - last_edit[0] >= 2:
+            last_edit[0] = now
+            status.edit_text(f"Загрузка {kind}: {done}/{total}...")
+
+    try:
+        count = bulk.load(kind, rows, progress)
+    except Exception as e:
+        logger.error(e)
+        status.edit_text("Ошибка при загрузке, изменения отменены.")
+        return
+    if kind != "users":
+        notify_catalog_changed()
+    status.edit_text(f"Загружено {kind}: {count}.")
+
+@instrumented("export_data")
+def export_data(update: Update, context: CallbackContext):
+    # Ожидается: /export <users|questions|prompts> [csv|json]
+    if not is_admin(update):
+        update.message.reply_text("Нет доступа.")
+        return
+    kind = context.args[0].lower() if context.args else ""
+    fmt = context.args[1].lower() if len(context.args) > 1 else "csv"
+    if kind not in bulk.SPECS or fmt not in ("csv", "json"):
+        update.message.reply_text("Используйте: /export <users|questions|prompts> [csv|json]")
+        return
+    try:
+        with tempfile.TemporaryFile() as out:
+            count = bulk.export(kind, fmt, out)
+            out.seek(0)
+            update.message.reply_document(document=out, filename=f"{kind}.{fmt}", caption=f"{kind}: {count}")
+    except Exception as e:
+        logger.error(e)
+        update.message.reply_text("Ошибка при выгрузке.")
+
+# --- Аналитика анкет ---
+def percent(part: int, total: int) -> str:
+    return f"{part / total:.0%}" if total else "–"
+
+# Команда /stats [дней] – доля завершённых анкет и время генерации по типам бизнеса
+@instrumented("survey_stats")
+def survey_stats(update: Update, context: CallbackContext):
+    if not is_admin(update):
+        update.message.reply_text("Нет доступа.")
+        return
+    try:
+        days = int(context.args[0]) if context.args else 7
+    except ValueError:
+        update.message.reply_text("Используйте: /stats [количество дней]")
+        return
+    try:
+        rows = analytics.completion_stats(days)
+    except Exception as e:
+        logger.error(e)
+        update.message.reply_text("Ошибка при получении статистики.")
+        return
+    if not rows:
+        update.message.reply_text(f"За {days} дн. анкет нет.")
+        return
+    lines = [f"📊 Анкеты за {days} дн.:"]
+    for row in rows:
+        generation = "–"
+        if row["avg_generation"] is not None:
+            generation = f"{row['avg_generation']:.1f} с (p95 {row['p95_generation']:.1f} с)"
+        lines.append(
+            f"\n{row['business_type']}: начато {row['surveys']}, "
+            f"с отзывом {row['reviewed']} ({percent(row['reviewed'], row['surveys'])}), "
+            f"в WhatsApp {row['sent']} ({percent(row['sent'], row['surveys'])}), "
+            f"отредактировано {row['edited']}; генерация {generation}"
+        )
+    update.message.reply_text("\n".join(lines))
 
 def main():
-    updater = Updater(TELEGRAM_ADMIN_TOKEN, use_context=True)
+    startup.mark("imported")
+    if not ADMIN_IDS:
+        logger.warning("ADMIN_IDS не задан: /invalidate, /import, /export и /stats отключены")
+    updater = build_updater(TELEGRAM_ADMIN_TOKEN)
     dp = updater.dispatcher
     dp.add_handler(CommandHandler("adduser", add_user))
+    dp.add_handler(CommandHandler("invalidate", invalidate_catalog))
+    dp.add_handler(CommandHandler("import", import_help))
+    dp.add_handler(MessageHandler(Filters.document, import_document))
+    dp.add_handler(CommandHandler("export", export_data))
+    dp.add_handler(CommandHandler("stats", survey_stats))
     # Добавьте другие команды для управления вопросами и промптами аналогичным образом.
-    updater.start_polling()
-    updater.idle()
+    if DB_POOL_STATS_INTERVAL:
+        updater.job_queue.run_repeating(log_pool_stats, interval=DB_POOL_STATS_INTERVAL)
+    run(updater, TELEGRAM_ADMIN_TOKEN, warm_up=[("db", ping)])
+    close_pool()
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,11 @@
+import startup  # первым: от начала его импорта считается время запуска
 import logging
-import psycopg2
+import uuid
 from psycopg2.extras import RealDictCursor
-import openai
 import urllib.parse
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    Updater,
     CommandHandler,
     MessageHandler,
     Filters,
@@ -14,66 +13,91 @@ from telegram.ext import (
     ConversationHandler,
     CallbackContext,
 )
-from config import TELEGRAM_CLIENT_TOKEN, OPENAI_API_KEY, DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
-
-# Настройка OpenAI API
-openai.api_key = OPENAI_API_KEY
+from config import (
+    TELEGRAM_CLIENT_TOKEN,
+    BOT_MODE,
+    METRICS_PORT,
+    DB_POOL_STATS_INTERVAL,
+    OPENAI_MODEL,
+    REVIEW_TEMPERATURE,
+    REVIEW_MAX_TOKENS,
+    REVIEW_WORKERS,
+    REVIEW_MAX_PENDING,
+    REVIEW_STILL_WORKING_AFTER,
+    REVIEW_STREAMING,
+    REVIEW_STREAM_EDIT_INTERVAL,
+    REVIEW_STREAM_EDITS_PER_SECOND,
+    PERSISTENCE_ENABLED,
+    PERSISTENCE_FLUSH_INTERVAL,
+    PERSISTENCE_FLUSH_BATCH,
+    PERSISTENCE_REFRESH,
+    PERSISTENCE_TTL_DAYS,
+    REVIEW_CACHE_VARIANTS,
+    REVIEW_CACHE_SIZE,
+    REVIEW_CACHE_TTL,
+    REVIEW_STATS_INTERVAL,
+    ANALYTICS_ENABLED,
+    ANALYTICS_FLUSH_MS,
+    ANALYTICS_FLUSH_ROWS,
+    ANALYTICS_MAX_PENDING,
+)
+from db import connection, close_pool, log_pool_stats, ping
+from serving import WaitingRequeue, build_updater, persist_user_data, run
+from persistence import PostgresPersistence
+from analytics import AnalyticsWriter, now
+from catalog import get_catalog, start_listener, warm_up as warm_up_catalog
+import llm
+from metrics import DB_QUERY, SURVEY_STEPS, instrumented, registry, timed
+from review_cache import ReviewCache, make_key
+from review_jobs import EditThrottle, ReviewCancelled, ReviewJob, ReviewPipeline, StreamingMessage
 
 # Настройка логирования
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Определяем состояния диалога
-START_MENU, QUESTION, CONFIRM_REVIEW, EDIT_REVIEW_STATE = range(4)
-
-# Функция для подключения к БД
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
-    return conn
+START_MENU, QUESTION, CONFIRM_REVIEW, EDIT_REVIEW_STATE, GENERATING_REVIEW = range(5)
+
+# Шаги анкеты по порядку (метрика bot_survey_steps_total) – по ним считается отсев между шагами
+SURVEY_FUNNEL = (
+    "start", "survey_started", "question_1", "question_2", "question_3", "question_4",
+    "review_requested", "review_generated", "whatsapp",
+)
+
+def survey_step(step: str):
+    SURVEY_STEPS.labels(step).inc()
+
+# Доля пользователей, не дошедших до шага с предыдущего
+def survey_dropoff() -> dict:
+    counts = [SURVEY_STEPS.labels(step).value for step in SURVEY_FUNNEL]
+    return {
+        step: round(1 - count / previous, 3) if previous else 0.0
+        for step, previous, count in zip(SURVEY_FUNNEL[1:], counts, counts[1:])
+    }
+
+registry.collector("survey_dropoff", survey_dropoff)
+
+# Результаты анкет для аналитики (создаётся в main(), если ANALYTICS_ENABLED)
+analytics_writer = None
+
+def record_survey(user_data: dict, **fields):
+    survey_id = user_data.get("survey_id")
+    if analytics_writer is not None and survey_id:
+        analytics_writer.record(survey_id, **fields)
 
 # Проверка пользователя по Telegram ID
 def get_user(telegram_id: int):
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+    with connection() as conn:
+        with timed(DB_QUERY.labels("get_user")), conn.cursor(cursor_factory=RealDictCursor) as cur:
             query = "SELECT * FROM users WHERE telegram_id = %s LIMIT 1"
             cur.execute(query, (telegram_id,))
             return cur.fetchone()
-    finally:
-        conn.close()
-
-# Загрузка вопросов для заданного business_type
-def get_questions(business_type: str):
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            query = "SELECT question_text FROM questions WHERE business_type = %s ORDER BY id"
-            cur.execute(query, (business_type,))
-            rows = cur.fetchall()
-            return [row["question_text"] for row in rows]
-    finally:
-        conn.close()
-
-# Загрузка промпта для заданного business_type
-def get_prompt(business_type: str):
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            query = "SELECT prompt_text FROM prompts WHERE business_type = %s LIMIT 1"
-            cur.execute(query, (business_type,))
-            row = cur.fetchone()
-            return row["prompt_text"] if row else None
-    finally:
-        conn.close()
 
 # --- Стартовое меню ---
+@instrumented("start")
 def start(update: Update, context: CallbackContext) -> int:
+    # /start во время генерации – прежний отзыв больше не нужен и не должен попасть в новую анкету
+    review_pipeline.cancel(update.effective_chat.id)
     telegram_id = update.effective_user.id
     user = get_user(telegram_id)
     if not user:
@@ -82,9 +106,10 @@ def start(update: Update, context: CallbackContext) -> int:
 
     # Пользователь найден – получаем его бизнес-группу
     business_type = user["business_type"]
-    # Загружаем вопросы и промпт для данного типа бизнеса
-    questions = get_questions(business_type)
-    prompt = get_prompt(business_type)
+    # Вопросы и промпт для данного типа бизнеса берём из кэша каталога
+    catalog = get_catalog(business_type)
+    questions = list(catalog.questions)
+    prompt = catalog.prompt
 
     if not questions:
         update.message.reply_text("Ошибка: для вашего типа бизнеса не найдены вопросы. Обратитесь к администратору.")
@@ -100,6 +125,7 @@ def start(update: Update, context: CallbackContext) -> int:
     context.user_data["prompt"] = prompt
     context.user_data["current_question"] = 0
     context.user_data["answers"] = []
+    context.user_data["survey_id"] = uuid.uuid4().hex
 
     # Показываем стартовое меню анкеты
     keyboard = [
@@ -108,8 +134,11 @@ def start(update: Update, context: CallbackContext) -> int:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     update.message.reply_text("Добро пожаловать! Выберите действие:", reply_markup=reply_markup)
+    survey_step("start")
+    record_survey(context.user_data, telegram_id=telegram_id, business_type=business_type, status="started", started_at=now())
     return START_MENU
 
+@instrumented("start_menu_handler")
 def start_menu_handler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     query.answer()
@@ -118,12 +147,16 @@ def start_menu_handler(update: Update, context: CallbackContext) -> int:
         questions = context.user_data["questions"]
         question_text = f"📝 Вопрос 1/4:\n{questions[0]}"
         query.edit_message_text(text=question_text)
+        survey_step("survey_started")
         return QUESTION
     elif query.data == "cancel":
         query.edit_message_text(text="Анкетирование отменено.")
+        survey_step("cancelled")
+        record_survey(context.user_data, status="cancelled")
         return ConversationHandler.END
 
 # --- Этап вопросов ---
+@instrumented("answer_handler")
 def answer_handler(update: Update, context: CallbackContext) -> int:
     current_q = context.user_data.get("current_question", 0)
     answer = update.message.text
@@ -144,6 +177,7 @@ def answer_handler(update: Update, context: CallbackContext) -> int:
     update.message.reply_text(f"Ответ: \"{answer}\"\nВыберите действие:", reply_markup=reply_markup)
     return QUESTION
 
+@instrumented("question_callback_handler")
 def question_callback_handler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     query.answer()
@@ -153,9 +187,11 @@ def question_callback_handler(update: Update, context: CallbackContext) -> int:
         query.edit_message_text(text=f"📝 Вопрос {current_q+1}/4:\n{questions[current_q]}\nВведите новый ответ:")
         return QUESTION
     elif query.data == "next_question":
-        current_q += 1
-        context.user_data["current_question"] = current_q
-        if current_q < len(questions):
+        if current_q + 1 < len(questions):
+            survey_step(f"question_{current_q + 1}")
+            current_q += 1
+            context.user_data["current_question"] = current_q
+            record_survey(context.user_data, answers=list(context.user_data.get("answers", [])), questions_answered=current_q)
             question_text = f"📝 Вопрос {current_q+1}/4:\n{questions[current_q]}"
             query.edit_message_text(text=question_text)
             return QUESTION
@@ -169,39 +205,157 @@ def question_callback_handler(update: Update, context: CallbackContext) -> int:
             dynamic_prompt += "\n" + prompt
 
             query.edit_message_text(text="Формирую отзыв, пожалуйста, подождите...")
-            try:
-                response = openai.ChatCompletion.create(
-                    model="gpt-4",  # При необходимости замените на нужную модель
-                    messages=[
-                        {"role": "system", "content": "Ты помогаешь составить отзыв на клинику."},
-                        {"role": "user", "content": dynamic_prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=200
-                )
-                generated_review = response.choices[0].message.content.strip()
-            except Exception as e:
-                logger.error(f"Ошибка при вызове OpenAI API: {e}")
-                query.edit_message_text(text="Ошибка генерации отзыва. Попробуйте позже.")
-                return ConversationHandler.END
-
-            context.user_data["generated_review"] = generated_review
-            keyboard = [
-                [
-                    InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-                    InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-                    InlineKeyboardButton("🔄 Начать заново", callback_data="restart"),
+            # Генерация идёт в отдельном пуле, результат придёт через job_queue
+            context.user_data.pop("generated_review", None)
+            job = ReviewJob(query.message.chat_id, query.message.message_id, context.user_data, dynamic_prompt, context.bot,
+                            user_id=update.effective_user.id)
+            if review_pipeline.submit(context.job_queue, job) is None:
+                # Очередь заполнена – остаёмся на последнем вопросе с сохранёнными ответами,
+                # чтобы можно было повторить «Далее»
+                keyboard = [
+                    [
+                        InlineKeyboardButton("🔄 Изменить ответ", callback_data="edit_answer"),
+                        InlineKeyboardButton("⏭ Далее", callback_data="next_question"),
+                    ]
                 ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            review_text = f"🎉 Отзыв сформирован:\n\"{generated_review}\""
-            query.edit_message_text(text=review_text, reply_markup=reply_markup)
-            return CONFIRM_REVIEW
+                query.edit_message_text(text="Сервис перегружен. Нажмите «Далее», чтобы попробовать ещё раз.",
+                                        reply_markup=InlineKeyboardMarkup(keyboard))
+                survey_step("review_rejected")
+                record_survey(context.user_data, status="rejected")
+                return QUESTION
+            survey_step(f"question_{current_q + 1}")
+            context.user_data["current_question"] = current_q + 1
+            record_survey(context.user_data, answers=list(answers), questions_answered=current_q + 1)
+            survey_step("review_requested")
+            record_survey(context.user_data, status="review_requested", review_requested_at=now())
+            return GENERATING_REVIEW
     else:
         query.edit_message_text(text="Неизвестная команда, завершаем диалог.")
         return ConversationHandler.END
 
+# --- Генерация отзыва ---
+stream_throttle = EditThrottle(REVIEW_STREAM_EDITS_PER_SECOND)
+review_cache = ReviewCache(REVIEW_CACHE_SIZE, REVIEW_CACHE_TTL, REVIEW_CACHE_VARIANTS)
+
+def request_review(job: ReviewJob) -> str:
+    on_delta = None
+    if REVIEW_STREAMING:
+        # Потоковый режим: показываем текст по мере поступления токенов.
+        # После /cancel поток дочитывается без вывода – результат нужен кэшу и объединённым запросам.
+        message = StreamingMessage(job, stream_throttle, REVIEW_STREAM_EDIT_INTERVAL)
+
+        def on_delta(text):
+            if not job.cancelled:
+                message.update(text)
+
+    result = llm.client.complete(
+        [
+            {"role": "system", "content": "Ты помогаешь составить отзыв на клинику."},
+            {"role": "user", "content": job.prompt}
+        ],
+        temperature=REVIEW_TEMPERATURE,
+        max_tokens=REVIEW_MAX_TOKENS,
+        on_delta=on_delta,
+    )
+    job.model = result.model
+    job.llm_seconds = result.latency
+    return result.text
+
+def generate_review(job: ReviewJob) -> str:
+    if REVIEW_CACHE_VARIANTS <= 0:
+        job.cache_status = "generated"
+        return request_review(job)
+    user_data = job.user_data
+    key = make_key(
+        user_data.get("business_type", ""),
+        user_data.get("prompt", ""),
+        user_data.get("answers", []),
+        OPENAI_MODEL,
+        REVIEW_TEMPERATURE,
+    )
+    # Ключ – по OPENAI_MODEL, поэтому отзыв резервной модели в кэш не кладём
+    generated_review, job.cache_status = review_cache.get_or_generate(
+        key, lambda: request_review(job), store=lambda: job.model == OPENAI_MODEL
+    )
+    if job.cancelled:
+        raise ReviewCancelled()
+    return generated_review
+
+def deliver_review(context: CallbackContext, job: ReviewJob, generated_review: str):
+    survey_step("review_generated")
+    job.user_data["generated_review"] = generated_review
+    # Задачи job_queue не сохраняют user_data сами по себе (serving.UserJobQueue)
+    persist_user_data(context, job.user_id)
+    record_survey(
+        job.user_data,
+        status="reviewed",
+        generated_review=generated_review,
+        final_review=generated_review,
+        model=job.model or OPENAI_MODEL,  # при попадании в кэш модель запроса не известна – ключ кэша по OPENAI_MODEL
+        cache_status=job.cache_status,
+        generation_seconds=job.finished - job.created,
+        llm_seconds=job.llm_seconds,
+        reviewed_at=now(),
+    )
+    keyboard = [
+        [
+            InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
+            InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
+            InlineKeyboardButton("🔄 Начать заново", callback_data="restart"),
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    review_text = f"🎉 Отзыв сформирован:\n\"{generated_review}\""
+    context.bot.edit_message_text(chat_id=job.chat_id, message_id=job.message_id, text=review_text, reply_markup=reply_markup)
+
+def deliver_review_error(context: CallbackContext, job: ReviewJob, error: Exception):
+    survey_step("review_failed")
+    record_survey(job.user_data, status="failed")
+    context.bot.edit_message_text(
+        chat_id=job.chat_id,
+        message_id=job.message_id,
+        text="Ошибка генерации отзыва. Попробуйте позже.\nЧтобы начать заново, отправьте /start.",
+    )
+
+def review_still_working(context: CallbackContext, job: ReviewJob):
+    context.bot.edit_message_text(
+        chat_id=job.chat_id,
+        message_id=job.message_id,
+        text="Всё ещё формирую отзыв, осталось совсем немного...",
+    )
+
+review_pipeline = ReviewPipeline(
+    generate_review,
+    deliver_review,
+    deliver_review_error,
+    review_still_working,
+    workers=REVIEW_WORKERS,
+    max_pending=REVIEW_MAX_PENDING,
+    still_working_after=REVIEW_STILL_WORKING_AFTER,
+)
+
+def log_review_stats(context: CallbackContext):
+    logger.info("Review jobs: " + ", ".join(f"{k}={v}" for k, v in review_pipeline.stats().items()))
+    logger.info("Review cache: " + ", ".join(f"{k}={v}" for k, v in review_cache.stats().items()))
+    logger.info(f"OpenAI: {llm.client.stats()}")
+
+registry.collector("review_jobs", review_pipeline.stats)
+registry.collector("review_cache", review_cache.stats)
+
+# Сообщения, пришедшие пока отзыв формируется (или после ошибки генерации)
+@instrumented("generating_handler")
+def generating_handler(update: Update, context: CallbackContext) -> int:
+    if review_pipeline.pending(update.effective_chat.id):
+        update.message.reply_text("Отзыв ещё формируется, пожалуйста, подождите...")
+        return GENERATING_REVIEW
+    if "generated_review" in context.user_data:
+        # Отзыв уже готов – текст считается отредактированным отзывом
+        return edit_review_handler(update, context)
+    update.message.reply_text("Не удалось сформировать отзыв. Отправьте /start, чтобы начать заново.")
+    return GENERATING_REVIEW
+
 # --- Этап подтверждения отзыва ---
+@instrumented("review_callback_handler")
 def review_callback_handler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     query.answer()
@@ -230,6 +384,8 @@ def review_callback_handler(update: Update, context: CallbackContext) -> int:
             text="Отправьте отзыв через WhatsApp или выберите другое действие:",
             reply_markup=reply_markup,
         )
+        survey_step("whatsapp")
+        record_survey(context.user_data, status="sent", final_review=review, sent_whatsapp=True, sent_at=now())
         return CONFIRM_REVIEW
     elif query.data == "back_from_whatsapp":
         generated_review = context.user_data.get("generated_review", "")
@@ -257,9 +413,11 @@ def review_callback_handler(update: Update, context: CallbackContext) -> int:
         query.edit_message_text(text="Неизвестная команда, завершаем диалог.")
         return ConversationHandler.END
 
+@instrumented("edit_review_handler")
 def edit_review_handler(update: Update, context: CallbackContext) -> int:
     edited_review = update.message.text
     context.user_data["generated_review"] = edited_review
+    record_survey(context.user_data, status="edited", final_review=edited_review, edited=True)
     keyboard = [
         [
             InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
@@ -271,6 +429,7 @@ def edit_review_handler(update: Update, context: CallbackContext) -> int:
     update.message.reply_text(f"Ваш отредактированный отзыв:\n\"{edited_review}\"\nВыберите действие:", reply_markup=reply_markup)
     return CONFIRM_REVIEW
 
+@instrumented("cancel_edit_handler")
 def cancel_edit_handler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     query.answer()
@@ -286,15 +445,21 @@ def cancel_edit_handler(update: Update, context: CallbackContext) -> int:
     query.edit_message_text(text=f"Отзыв сохранён:\n\"{generated_review}\"", reply_markup=reply_markup)
     return CONFIRM_REVIEW
 
+@instrumented("cancel")
 def cancel(update: Update, context: CallbackContext) -> int:
+    survey_step("cancelled")
+    record_survey(context.user_data, status="cancelled")
+    review_pipeline.cancel(update.effective_chat.id)
     update.message.reply_text("Диалог отменен.")
     return ConversationHandler.END
 
-def main():
-    updater = Updater(TELEGRAM_CLIENT_TOKEN, use_context=True)
-    dp = updater.dispatcher
+# Обновления, пришедшие, пока обрабатывается предыдущее обновление того же пользователя
+waiting_updates = WaitingRequeue()
+registry.collector("waiting_updates", waiting_updates.stats)
 
-    conv_handler = ConversationHandler(
+# Диалог анкеты; используется и в main(), и в нагрузочном стенде tools/loadtest.py
+def build_conversation(persistent: bool = False) -> ConversationHandler:
+    return ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
             START_MENU: [CallbackQueryHandler(start_menu_handler, pattern="^(start_survey|cancel)$")],
@@ -306,17 +471,64 @@ def main():
                 CallbackQueryHandler(review_callback_handler, pattern="^(edit_review|send_whatsapp|back_from_whatsapp|restart)$"),
                 MessageHandler(Filters.text & ~Filters.command, edit_review_handler),
             ],
+            GENERATING_REVIEW: [
+                CallbackQueryHandler(review_callback_handler, pattern="^(edit_review|send_whatsapp|back_from_whatsapp|restart)$"),
+                CommandHandler("start", start),
+                MessageHandler(Filters.text & ~Filters.command, generating_handler),
+            ],
             EDIT_REVIEW_STATE: [
                 CallbackQueryHandler(cancel_edit_handler, pattern="^cancel_edit$"),
                 MessageHandler(Filters.text & ~Filters.command, edit_review_handler),
             ],
+            ConversationHandler.WAITING: [waiting_updates.handler()],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="survey",
+        persistent=persistent,
     )
 
-    dp.add_handler(conv_handler)
-    updater.start_polling()
-    updater.idle()
+# mode, updates, metrics_port – см. serving.run; воркеры sharding.py запускаются с mode="shard"
+# и shard=(номер воркера, число воркеров) – состояние анкет у каждого только своих пользователей
+def main(mode: str = BOT_MODE, updates=None, metrics_port: int = METRICS_PORT, shard: tuple = None):
+    global analytics_writer
+    startup.mark("imported")
+    if ANALYTICS_ENABLED:
+        analytics_writer = AnalyticsWriter(ANALYTICS_FLUSH_MS / 1000, ANALYTICS_FLUSH_ROWS, ANALYTICS_MAX_PENDING)
+        registry.collector("analytics", analytics_writer.stats)
+    persistence = None
+    if PERSISTENCE_ENABLED:
+        # Состояние анкет переживает перезапуск и доступно нескольким процессам бота
+        persistence = PostgresPersistence(
+            "client",
+            flush_interval=PERSISTENCE_FLUSH_INTERVAL,
+            flush_batch=PERSISTENCE_FLUSH_BATCH,
+            refresh=PERSISTENCE_REFRESH,
+            shard=shard,
+            ttl=PERSISTENCE_TTL_DAYS * 86400,
+        )
+        registry.collector("persistence", persistence.stats)
+    updater = build_updater(TELEGRAM_CLIENT_TOKEN, persistence=persistence, mode=mode)
+    dp = updater.dispatcher
+    dp.add_handler(build_conversation(persistent=persistence is not None))
+    if DB_POOL_STATS_INTERVAL:
+        updater.job_queue.run_repeating(log_pool_stats, interval=DB_POOL_STATS_INTERVAL)
+    if REVIEW_STATS_INTERVAL:
+        updater.job_queue.run_repeating(log_review_stats, interval=REVIEW_STATS_INTERVAL)
+    catalog_listener = start_listener()
+    # Пул БД, каталог и openai прогреваются уже после начала приёма обновлений
+    run(
+        updater,
+        TELEGRAM_CLIENT_TOKEN,
+        mode,
+        warm_up=[("db", ping), ("catalog", warm_up_catalog), ("openai", llm.warm_up)],
+        updates=updates,
+        metrics_port=metrics_port,
+    )
+    catalog_listener.stop()
+    review_pipeline.shutdown()
+    if analytics_writer is not None:
+        analytics_writer.close()
+    close_pool()
 
 if __name__ == "__main__":
     main()
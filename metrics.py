@@ -0,0 +1,296 @@
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import METRICS_SLOW_HANDLER
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин по умолчанию, секунды
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+# Для коротких операций: обработчики, запросы к БД
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Гистограмма с фиксированными корзинами (кумулятивные счётчики как в Prometheus)
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    # [(граница, накопленное количество)], последняя граница – +Inf
+    def cumulative(self):
+        with self._lock:
+            counts = list(self._counts)
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    # Приблизительный перцентиль по границам корзин
+    def quantile(self, q: float) -> float:
+        cumulative = self.cumulative()
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, total in cumulative:
+            if total >= rank:
+                return bound if bound != float("inf") else self.buckets[-1]
+        return self.buckets[-1]
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count, 3) if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+# Метрика с метками: по экземпляру Histogram/Counter на каждый набор значений меток
+class Family:
+    def __init__(self, kind: str, name: str, help: str, labelnames, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def children(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Реестр метрик процесса: гистограммы и счётчики, а также «сборщики» – функции,
+# возвращающие dict со статистикой компонента (пул БД, очереди и т.п.), которые
+# публикуются как gauge bot_<имя>_<ключ>
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}
+        self._collectors = {}
+
+    def _family(self, kind: str, name: str, help: str, labelnames, factory) -> Family:
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = Family(kind, name, help, labelnames, factory)
+            return family
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Family:
+        return self._family("histogram", name, help, labelnames, lambda: Histogram(buckets))
+
+    def counter(self, name: str, help: str, labelnames=()) -> Family:
+        return self._family("counter", name, help, labelnames, Counter)
+
+    def collector(self, name: str, collect):
+        with self._lock:
+            self._collectors[name] = collect
+
+    def _collected(self):
+        with self._lock:
+            collectors = list(self._collectors.items())
+        for name, collect in collectors:
+            try:
+                stats = collect() or {}
+            except Exception as e:
+                logger.warning(f"Не удалось собрать метрики {name}: {e}")
+                continue
+            yield name, {k: v for k, v in stats.items() if isinstance(v, (int, float))}
+
+    # Текстовый формат Prometheus (version 0.0.4)
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            families = list(self._families.values())
+        for family in families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, child in family.children():
+                if family.kind == "counter":
+                    lines.append(f"{family.name}{_format_labels(family.labelnames, values)} {_format_value(child.value)}")
+                    continue
+                for bound, total in child.cumulative():
+                    labels = _format_labels(family.labelnames, values, [("le", _format_value(bound))])
+                    lines.append(f"{family.name}_bucket{labels} {total}")
+                labels = _format_labels(family.labelnames, values)
+                lines.append(f"{family.name}_sum{labels} {_format_value(child.sum)}")
+                lines.append(f"{family.name}_count{labels} {child.count}")
+        for name, stats in self._collected():
+            for key, value in stats.items():
+                metric = f"bot_{name}_{key}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    # Сводка для структурированного лога: перцентили гистограмм, значения счётчиков, сборщики
+    # (метрики без наблюдений пропускаются)
+    def snapshot(self) -> dict:
+        result = {}
+        with self._lock:
+            families = list(self._families.values())
+        for family in families:
+            children = {}
+            for values, child in family.children():
+                if not (child.value if family.kind == "counter" else child.count):
+                    continue
+                key = ",".join(values) or "total"
+                children[key] = child.value if family.kind == "counter" else child.stats()
+            if children:
+                result[family.name] = children
+        for name, stats in self._collected():
+            result[name] = stats
+        return result
+
+
+registry = Registry()
+
+HANDLER_DURATION = registry.histogram(
+    "bot_handler_duration_seconds", "Время обработки обновления", ["handler"], FAST_BUCKETS)
+HANDLER_ERRORS = registry.counter("bot_handler_errors_total", "Исключения в обработчиках", ["handler"])
+DB_QUERY = registry.histogram("bot_db_query_seconds", "Время запросов к БД", ["query"], FAST_BUCKETS)
+DB_POOL_WAIT = registry.histogram("bot_db_pool_wait_seconds", "Ожидание соединения из пула", (), FAST_BUCKETS)
+LLM_FIRST_TOKEN = registry.histogram("bot_llm_first_token_seconds", "Время до первого токена OpenAI (без потоковой передачи – до полного ответа)", ["model"])
+LLM_DURATION = registry.histogram("bot_llm_duration_seconds", "Полное время запроса к OpenAI", ["model"])
+SURVEY_STEPS = registry.counter("bot_survey_steps_total", "Сколько раз пользователи дошли до шага анкеты", ["step"])
+
+# Отдельный логгер для структурированных записей (одна строка JSON на событие)
+events = logging.getLogger("metrics.events")
+
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    if events.isEnabledFor(level):
+        events.log(level, json.dumps({"event": event, **fields}, ensure_ascii=False, default=str))
+
+
+# Декоратор обработчика: длительность, ошибки, структурированная запись.
+# Каждый вызов пишется на уровне DEBUG, медленные (дольше slow секунд) – WARNING.
+def instrumented(name: str, slow: float = METRICS_SLOW_HANDLER):
+    histogram = HANDLER_DURATION.labels(name)
+    errors = HANDLER_ERRORS.labels(name)
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(update, context, *args, **kwargs):
+            started = time.perf_counter()
+            status = "ok"
+            try:
+                return handler(update, context, *args, **kwargs)
+            except Exception:
+                status = "error"
+                errors.inc()
+                raise
+            finally:
+                duration = time.perf_counter() - started
+                histogram.observe(duration)
+                level = logging.WARNING if slow is not None and duration > slow else logging.DEBUG
+                user = getattr(update, "effective_user", None)
+                log_event("handler", level, handler=name, status=status, duration_ms=round(duration * 1000, 2),
+                          user_id=user.id if user else None)
+
+        return wrapper
+
+    return decorator
+
+
+# Замер блока кода: with timed(DB_QUERY.labels("get_user")): ...
+@contextmanager
+def timed(histogram: Histogram):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+# Периодическая задача для job_queue: сводка метрик одной строкой JSON
+def log_snapshot(context=None):
+    log_event("metrics", **registry.snapshot())
+
+
+# HTTP-эндпоинты: /metrics для Prometheus, /healthz (процесс жив) и /ready (ready() вернул True –
+# проба готовности для оркестратора; без ready совпадает с /healthz)
+def start_http_server(port: int, listen: str = "0.0.0.0", ready=None) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status: int, data: bytes, content_type: str = "text/plain; charset=utf-8"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/metrics":
+                self._reply(200, registry.render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+            elif path == "/healthz":
+                self._reply(200, b"ok\n")
+            elif path == "/ready":
+                if ready is None or ready():
+                    self._reply(200, b"ready\n")
+                else:
+                    self._reply(503, b"not ready\n")
+            else:
+                self.send_error(404)
+
+    server = ThreadingHTTPServer((listen, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Метрики Prometheus: http://{listen}:{port}/metrics, готовность: /ready")
+    return server
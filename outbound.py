@@ -0,0 +1,237 @@
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram import Bot
+from telegram.error import RetryAfter
+from telegram.ext.extbot import ExtBot
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+# Бюджет отправок: burst сообщений сразу, дальше per_second в секунду
+class SendBudget:
+    def __init__(self, per_second: float, burst: float):
+        self.rate = per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    # Через сколько секунд можно отправить (0 – сейчас)
+    def delay(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Item:
+    __slots__ = ("call", "args", "kwargs", "futures", "edit_key", "enqueued", "attempts")
+
+    def __init__(self, call, args, kwargs, edit_key, future: Future):
+        self.call = call
+        self.args = args
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.edit_key = edit_key
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+# Очередь исходящих запросов к Bot API.
+# Соблюдает общий лимит бота и лимит на каждый чат (для групп строже), сохраняет порядок
+# внутри чата, схлопывает ещё не отправленные правки одного и того же сообщения в одну
+# (последняя побеждает) и повторяет запрос после RetryAfter.
+class OutboundQueue:
+    def __init__(self, global_per_second: float = 30, chat_per_second: float = 1, chat_burst: float = 3,
+                 group_per_minute: float = 20, workers: int = 4, max_retries: int = 3):
+        self.global_budget = SendBudget(global_per_second, global_per_second)
+        self.chat_per_second = chat_per_second
+        self.chat_burst = chat_burst
+        self.group_per_minute = group_per_minute
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbound")
+        self._cond = threading.Condition()
+        self._chats = {}        # chat_id -> deque[_Item]
+        self._budgets = {}      # chat_id -> SendBudget
+        self._busy = set()      # чаты, у которых запрос уже в полёте
+        self._ready = deque()   # порядок обхода чатов с ожидающими запросами
+        self._running = True
+        self._pruned = time.monotonic()
+        self.depth = 0
+        self.sent = 0
+        self.collapsed = 0
+        self.retries = 0
+        self.failed = 0
+        self.latency = Histogram()
+        self._thread = threading.Thread(target=self._loop, name="outbound-scheduler", daemon=True)
+        self._thread.start()
+
+    def _budget(self, chat_id) -> SendBudget:
+        budget = self._budgets.get(chat_id)
+        if budget is None:
+            if isinstance(chat_id, int) and chat_id < 0:
+                budget = SendBudget(self.group_per_minute / 60.0, 1)
+            else:
+                budget = SendBudget(self.chat_per_second, self.chat_burst)
+            self._budgets[chat_id] = budget
+        return budget
+
+    def submit(self, chat_id, call, args=(), kwargs=None, edit_key=None) -> Future:
+        kwargs = kwargs or {}
+        future = Future()
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("Очередь исходящих сообщений остановлена")
+            items = self._chats.get(chat_id)
+            if items is None:
+                items = self._chats[chat_id] = deque()
+                self._ready.append(chat_id)
+            if edit_key is not None:
+                for item in items:
+                    if item.edit_key == edit_key:
+                        # Правка того же сообщения ещё не отправлена – заменяем её содержимое
+                        item.args, item.kwargs = args, kwargs
+                        item.futures.append(future)
+                        self.collapsed += 1
+                        return future
+            items.append(_Item(call, args, kwargs, edit_key, future))
+            self.depth += 1
+            self._cond.notify()
+        return future
+
+    def _loop(self):
+        with self._cond:
+            while self._running or self.depth or self._busy:
+                now = time.monotonic()
+                if now - self._pruned > 60:
+                    self._prune(now)
+                wait = self.global_budget.delay(now)
+                chosen = None
+                if wait == 0:
+                    wait = 1.0
+                    for _ in range(len(self._ready)):
+                        chat_id = self._ready[0]
+                        self._ready.rotate(-1)
+                        if chat_id in self._busy:
+                            continue
+                        delay = self._budget(chat_id).delay(now)
+                        if delay == 0:
+                            chosen = chat_id
+                            break
+                        wait = min(wait, delay)
+                if chosen is None:
+                    self._cond.wait(wait)
+                    continue
+                item = self._chats[chosen].popleft()
+                self.depth -= 1
+                self._budget(chosen).take()
+                self.global_budget.take()
+                self._busy.add(chosen)
+                self._executor.submit(self._send, chosen, item)
+
+    # Бюджеты чатов без ожидающих сообщений и с восстановившимся лимитом больше не нужны
+    def _prune(self, now: float):
+        self._pruned = now
+        for chat_id in [c for c in self._budgets if c not in self._chats]:
+            budget = self._budgets[chat_id]
+            if budget.delay(now) == 0 and budget.tokens >= budget.burst:
+                del self._budgets[chat_id]
+
+    def _send(self, chat_id, item: _Item):
+        item.attempts += 1
+        try:
+            result, error = item.call(*item.args, **item.kwargs), None
+        except Exception as e:
+            result, error = None, e
+        with self._cond:
+            self._busy.discard(chat_id)
+            if isinstance(error, RetryAfter) and item.attempts <= self.max_retries:
+                # Повтор после паузы; пауза касается и чата, и всего бота
+                now = time.monotonic()
+                self.retries += 1
+                self._budget(chat_id).paused_until = now + error.retry_after
+                self.global_budget.paused_until = max(self.global_budget.paused_until, now + error.retry_after)
+                self._chats[chat_id].appendleft(item)
+                self.depth += 1
+                self._cond.notify()
+                return
+            if not self._chats[chat_id]:
+                del self._chats[chat_id]
+                self._ready.remove(chat_id)
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._cond.notify()
+        self.latency.observe(time.monotonic() - item.enqueued)
+        for future in item.futures:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    # Останавливает приём и дожидается отправки очереди (не дольше timeout)
+    def stop(self, timeout: float = 10):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "depth": self.depth,
+                "chats": len(self._chats),
+                "sent": self.sent,
+                "collapsed": self.collapsed,
+                "retries": self.retries,
+                "failed": self.failed,
+                "latency": self.latency.stats(),
+            }
+
+
+_EDIT_SIGNATURE = inspect.signature(Bot.edit_message_text)
+
+
+# Бот, отправляющий сообщения через OutboundQueue.
+# send_message и send_document ждут результата (вызывающий код получает Message, как раньше):
+# поток обработчика простаивает, пока чат исчерпал лимит, поэтому при частых ответах в один чат
+# занятых потоков BOT_WORKERS больше, чем без очереди. Одному пользователю это не мешает –
+# его обновления и так разбираются по очереди.
+# edit_message_text не блокирует и возвращает Future с результатом правки; ошибки правок пишутся в лог.
+class QueuedBot(ExtBot):
+    def __init__(self, *args, outbound: OutboundQueue, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound = outbound
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.outbound.submit(chat_id, super().send_message, (chat_id,) + args, kwargs).result()
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self.outbound.submit(chat_id, super().send_document, (chat_id,) + args, kwargs).result()
+
+    def edit_message_text(self, *args, **kwargs):
+        bound = _EDIT_SIGNATURE.bind(self, *args, **kwargs).arguments
+        chat_id = bound.get("chat_id")
+        edit_key = (chat_id, bound.get("message_id"), bound.get("inline_message_id"))
+        future = self.outbound.submit(chat_id, super().edit_message_text, args, kwargs, edit_key=edit_key)
+        future.add_done_callback(_log_edit_error)
+        return future
+
+
+def _log_edit_error(future: Future):
+    error = future.exception()
+    if error is not None and "not modified" not in str(error).lower():
+        logger.warning(f"Не удалось изменить сообщение: {error}")
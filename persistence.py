@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from psycopg2.extras import execute_values
+from telegram.ext import BasePersistence, ConversationHandler
+from telegram.ext.utils.promise import Promise
+
+from db import connection
+from metrics import DB_QUERY, timed
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bot_persistence (
+    namespace TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    user_id BIGINT,
+    data JSONB NOT NULL,
+    version BIGINT NOT NULL DEFAULT 1,
+    writer TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (namespace, kind, key)
+);
+CREATE INDEX IF NOT EXISTS bot_persistence_user_idx ON bot_persistence (namespace, user_id);
+CREATE INDEX IF NOT EXISTS bot_persistence_updated_idx ON bot_persistence (namespace, updated_at);
+"""
+
+UPSERT = """
+INSERT INTO bot_persistence (namespace, kind, key, user_id, data, writer) VALUES %s
+ON CONFLICT (namespace, kind, key) DO UPDATE
+SET data = EXCLUDED.data, user_id = EXCLUDED.user_id, writer = EXCLUDED.writer,
+    version = bot_persistence.version + 1, updated_at = now()
+RETURNING kind, key, version
+"""
+
+USER = "user"
+CONVERSATION = "conv:"
+
+
+# Состояние диалога, пока обработчик выполняется в пуле: (прежнее состояние, Promise)
+def _pending(state) -> bool:
+    return isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise)
+
+
+# PTB 13 передаёт в update_conversation ((прежнее, Promise), Promise), а прежнее состояние само
+# может быть ещё не разрешённым кортежем – разворачиваем до обычного состояния
+def _settled(state):
+    while _pending(state):
+        state = state[0]
+    return state
+
+
+# Сериализация для записи и сравнения с сохранённым: JSONB не сохраняет порядок ключей
+def _dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+
+# Хранение user_data и состояний ConversationHandler в PostgreSQL.
+# Изменения копятся в памяти и записываются пачками (write-behind): раз в flush_interval
+# секунд или при накоплении flush_batch изменённых записей, а также при остановке бота.
+# Несколько процессов могут работать с одним namespace: при refresh=True перед каждым
+# обновлением подтягиваются записи пользователя, изменённые другими процессами.
+# shard=(index, count) – процесс обслуживает только пользователей с user_id % count == index
+# (воркеры sharding.py) и читает и пишет только их записи.
+# ttl > 0 – записи, не менявшиеся ttl секунд (брошенные и завершённые анкеты), удаляются при старте
+# и раз в PRUNE_INTERVAL, вместе с данными пользователя в памяти.
+class PostgresPersistence(BasePersistence):
+    PRUNE_INTERVAL = 3600  # с
+
+    def __init__(self, namespace: str, flush_interval: float = 2.0, flush_batch: int = 200, refresh: bool = False,
+                 shard: tuple = None, ttl: float = 0):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.namespace = namespace
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.refresh = refresh
+        self.shard = shard
+        self.ttl = ttl
+        self.writer = f"{os.uname().nodename}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty = {}      # (kind, key) -> (user_id, json); завершённый диалог хранится как null
+        self._versions = {}   # (kind, key) -> последняя известная версия записи
+        self._saved = {}      # (kind, key) -> json, загруженный из БД или отправленный на запись
+        self._user_data = None
+        self._conversations = {}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_pruned = 0
+        self._ensure_schema()
+        self._pruned_at = 0.0
+        if self.ttl:
+            self._prune()
+        self._thread = threading.Thread(target=self._flush_loop, name="persistence-flush", daemon=True)
+        self._thread.start()
+
+    def _ensure_schema(self):
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SCHEMA)
+            conn.commit()
+
+    # Условие на записи своего namespace (и своего шарда)
+    def _where(self, clause: str, params: tuple):
+        if self.shard is not None:
+            index, count = self.shard
+            clause += " AND user_id %% %s = %s"
+            params += (count, index)
+        return "namespace = %s AND " + clause, (self.namespace,) + params
+
+    def _load(self, kind_clause: str, params: tuple):
+        where, params = self._where(kind_clause, params)
+        with connection() as conn:
+            with timed(DB_QUERY.labels("persistence_load")), conn.cursor() as cur:
+                cur.execute("SELECT kind, key, data, version FROM bot_persistence WHERE " + where, params)
+                return cur.fetchall()
+
+    # BasePersistence по умолчанию глубоко копирует данные при каждой загрузке и записи (замена
+    # объектов Bot) – в user_data их нет, а копия на каждое сохранение обходится дорого
+    def insert_bot(self, obj):
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    # --- Загрузка при старте ---
+    def get_user_data(self):
+        if self._user_data is None:
+            self._user_data = defaultdict(dict)
+            for kind, key, data, version in self._load("kind = %s", (USER,)):
+                self._loaded(kind, key, data, version)
+                self._user_data[int(key)] = data
+        return self._user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name: str):
+        # ConversationHandler хранит ссылку на этот словарь – его же обновляет refresh_user_data
+        if name not in self._conversations:
+            conversations = {}
+            for kind, key, data, version in self._load("kind = %s", (CONVERSATION + name,)):
+                self._loaded(kind, key, data, version)
+                if data is not None:
+                    conversations[tuple(json.loads(key))] = data
+            self._conversations[name] = conversations
+        return self._conversations[name]
+
+    def _loaded(self, kind: str, key: str, data, version: int):
+        self._versions[(kind, key)] = version
+        with self._lock:
+            self._saved[(kind, key)] = _dumps(data)
+
+    # --- Запись изменений (в очередь на сброс) ---
+    # Записи, совпадающие с уже сохранёнными, в очередь не попадают (полный проход
+    # Dispatcher.update_persistence() передаёт всех пользователей, в том числе не изменившихся)
+    def _mark(self, kind: str, key: str, user_id, data):
+        if self.shard is not None and user_id is not None and user_id % self.shard[1] != self.shard[0]:
+            return  # запись другого воркера
+        payload = _dumps(data)
+        with self._lock:
+            if self._saved.get((kind, key)) == payload:
+                self._dirty.pop((kind, key), None)
+                return
+            self._dirty[(kind, key)] = (user_id, payload)
+            pending = len(self._dirty)
+        if pending >= self.flush_batch:
+            self._wakeup.set()
+
+    def update_user_data(self, user_id: int, data: dict):
+        self._mark(USER, str(user_id), user_id, dict(data))
+
+    def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    def update_bot_data(self, data: dict):
+        pass
+
+    def update_conversation(self, name: str, key: tuple, new_state):
+        kind, row_key, user_id = CONVERSATION + name, json.dumps(list(key)), key[-1]
+        if _pending(new_state):
+            # Обработчик ещё выполняется (run_async): сохраняем прежнее состояние,
+            # а новое – когда обработчик завершится
+            old_state, promise = _settled(new_state[0]), new_state[1]
+            self._mark(kind, row_key, user_id, old_state)
+            promise.add_done_callback(lambda state: self._resolve_state(name, key, old_state, state))
+            return
+        self._mark(kind, row_key, user_id, new_state)
+
+    def _resolve_state(self, name: str, key: tuple, old_state, state):
+        if state is None:
+            state = old_state
+        elif state == ConversationHandler.END:
+            state = None
+        self._mark(CONVERSATION + name, json.dumps(list(key)), key[-1], state)
+
+    # --- Подтягивание изменений других процессов ---
+    def refresh_user_data(self, user_id: int, user_data: dict):
+        if not self.refresh:
+            return
+        with self._lock:
+            # Локальные несброшенные изменения новее любых записей в БД
+            pending = {kind for (kind, key) in self._dirty if key == str(user_id) or key.endswith(f", {user_id}]")}
+        rows = self._load("user_id = %s AND writer <> %s", (user_id, self.writer))
+        for kind, key, data, version in rows:
+            if kind in pending or version <= self._versions.get((kind, key), 0):
+                continue
+            self._loaded(kind, key, data, version)
+            if kind == USER:
+                user_data.clear()
+                user_data.update(data)
+            elif kind.startswith(CONVERSATION):
+                conversations = self._conversations.get(kind[len(CONVERSATION):])
+                if conversations is not None:
+                    if data is None:
+                        conversations.pop(tuple(json.loads(key)), None)
+                    else:
+                        conversations[tuple(json.loads(key))] = data
+
+    # --- Сброс в БД ---
+    def _flush_loop(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self._write()
+            except Exception as e:
+                logger.error(f"Ошибка записи состояния диалогов в БД: {e}")
+            if self.ttl and time.monotonic() - self._pruned_at >= self.PRUNE_INTERVAL:
+                try:
+                    self._prune()
+                except Exception as e:
+                    logger.error(f"Ошибка удаления устаревших состояний диалогов: {e}")
+
+    def _write(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._dirty = self._dirty, {}
+                # Пока пачка пишется, повтор тех же данных в очередь не ставим
+                previous = {item: self._saved.get(item) for item in batch}
+                for item, (user_id, payload) in batch.items():
+                    self._saved[item] = payload
+            if not batch:
+                return
+            rows = [
+                (self.namespace, kind, key, user_id, payload, self.writer)
+                for (kind, key), (user_id, payload) in batch.items()
+            ]
+            try:
+                versions = self._upsert(rows)
+            except Exception:
+                # Возвращаем несохранённое в очередь, не затирая более свежие изменения
+                with self._lock:
+                    for item, value in batch.items():
+                        self._dirty.setdefault(item, value)
+                        if self._saved.get(item) == value[1]:
+                            self._saved[item] = previous[item]
+                raise
+            for kind, key, version in versions:
+                self._versions[(kind, key)] = version
+            self.flushes += 1
+            self.rows_written += len(rows)
+
+    def _upsert(self, rows: list) -> list:
+        with connection() as conn:
+            with timed(DB_QUERY.labels("persistence_write")):
+                with conn.cursor() as cur:
+                    versions = execute_values(cur, UPSERT, rows, fetch=True)
+                conn.commit()
+        return versions
+
+    # --- Удаление устаревших записей ---
+    def _prune(self):
+        self._pruned_at = time.monotonic()
+        rows = self._delete_expired()
+        with self._lock:
+            for kind, key in rows:
+                self._saved.pop((kind, key), None)
+        for kind, key in rows:
+            self._versions.pop((kind, key), None)
+            if kind == USER:
+                if self._user_data is not None:
+                    self._user_data.pop(int(key), None)
+            elif kind.startswith(CONVERSATION):
+                conversations = self._conversations.get(kind[len(CONVERSATION):])
+                if conversations is not None:
+                    conversations.pop(tuple(json.loads(key)), None)
+        self.rows_pruned += len(rows)
+        if rows:
+            logger.info(f"Удалено устаревших записей состояния диалогов: {len(rows)}")
+
+    def _delete_expired(self) -> list:
+        where, params = self._where("updated_at < now() - make_interval(secs => %s)", (self.ttl,))
+        with connection() as conn:
+            with timed(DB_QUERY.labels("persistence_prune")), conn.cursor() as cur:
+                cur.execute("DELETE FROM bot_persistence WHERE " + where + " RETURNING kind, key", params)
+                rows = cur.fetchall()
+            conn.commit()
+        return rows
+
+    # Вызывается диспетчером при остановке
+    def flush(self):
+        self._stopped.set()
+        self._wakeup.set()
+        self._write()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._dirty)
+        return {"pending": pending, "flushes": self.flushes, "rows_written": self.rows_written, "rows_pruned": self.rows_pruned}
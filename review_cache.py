@@ -0,0 +1,111 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+# Нормализация ответа: регистр, ё/е, пунктуация и лишние пробелы не влияют на ключ
+def normalize(text: str) -> str:
+    text = (text or "").lower().replace("ё", "е")
+    text = _PUNCTUATION.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def make_key(business_type: str, prompt: str, answers, model: str, temperature: float) -> str:
+    payload = json.dumps(
+        [business_type, prompt.strip(), [normalize(a) for a in answers], model, round(temperature, 2)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# Кэш сгенерированных отзывов.
+# По каждому ключу хранится до variants вариантов текста: пока их меньше, запрос генерирует
+# новый вариант, затем пользователи получают случайный из готовых. Одинаковые запросы,
+# пришедшие одновременно, объединяются в один вызов генерации.
+class ReviewCache:
+    def __init__(self, max_keys: int = 5000, ttl: float = 86400, variants: int = 3):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.variants = variants
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (время создания, [варианты])
+        self._inflight = {}            # key -> Future
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self.evictions = 0
+
+    def _variants(self, key: str, now: float):
+        entry = self._entries.get(key)
+        if entry is None:
+            return []
+        if now - entry[0] >= self.ttl:
+            del self._entries[key]
+            self.evictions += 1
+            return []
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    # Возвращает (текст, источник): источник – "hit", "merged" или "generated".
+    # Если store() после генерации вернул False, текст получат только объединённые запросы, в кэш он не попадёт.
+    def get_or_generate(self, key: str, generate, store=None):
+        leader = False
+        with self._lock:
+            variants = self._variants(key, time.monotonic())
+            inflight = self._inflight.get(key)
+            if len(variants) >= self.variants or (variants and inflight is not None):
+                self.hits += 1
+                return random.choice(variants), "hit"
+            if inflight is not None:
+                self.merged += 1
+            else:
+                self.misses += 1
+                inflight = self._inflight[key] = Future()
+                leader = True
+        if not leader:
+            return inflight.result(), "merged"
+
+        try:
+            text = generate()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            inflight.set_exception(e)
+            raise
+        keep = store is None or store()
+        with self._lock:
+            del self._inflight[key]
+            if keep:
+                now = time.monotonic()
+                variants = self._variants(key, now)
+                if variants:
+                    if text not in variants:
+                        variants.append(text)
+                else:
+                    self._entries[key] = (now, [text])
+                while len(self._entries) > self.max_keys:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        inflight.set_result(text)
+        return text, "generated"
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.merged + self.misses
+            return {
+                "keys": len(self._entries),
+                "inflight": len(self._inflight),
+                "hits": self.hits,
+                "merged": self.merged,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.merged) / lookups, 3) if lookups else 0.0,
+            }
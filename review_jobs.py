@@ -0,0 +1,233 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram.error import RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class ReviewCancelled(Exception):
+    pass
+
+
+# Задание на генерацию отзыва для одного чата
+class ReviewJob:
+    def __init__(self, chat_id: int, message_id: int, user_data: dict, prompt: str, bot, user_id: int = None):
+        self.chat_id = chat_id
+        self.user_id = user_id  # чей user_data, для сохранения после доставки
+        self.message_id = message_id
+        self.user_data = user_data
+        self.prompt = prompt
+        self.bot = bot
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.progress_shown = False  # пользователь уже видит частичный результат
+        # Заполняются при генерации, для аналитики
+        self.model = None
+        self.llm_seconds = None
+        self.cache_status = None
+        # Сериализует правки сообщения из job_queue («ещё работаю» и доставку результата)
+        self.lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+
+# Общий для процесса лимит правок сообщений (Telegram ограничивает частоту запросов бота)
+class EditThrottle:
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    # Неблокирующая попытка: True, если правку можно отправить сейчас
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next:
+                return False
+            self._next = now + self.interval
+            return True
+
+
+# Постепенный вывод генерируемого текста в сообщение задания.
+# Правки прореживаются: не чаще min_interval для одного сообщения и в пределах общего лимита;
+# пропущенная правка не теряется – следующая покажет более полный текст.
+# QueuedBot не отправляет правку сразу, а возвращает Future (RetryAfter он повторяет сам) –
+# результат правки тогда учитывается по её завершении.
+class StreamingMessage:
+    def __init__(self, job: ReviewJob, throttle: EditThrottle, min_interval: float, cursor: str = " ▌"):
+        self.job = job
+        self.throttle = throttle
+        self.min_interval = min_interval
+        self.cursor = cursor
+        self.edits = 0
+        self._next_edit = 0.0
+        self._last_text = None
+
+    def update(self, text: str):
+        now = time.monotonic()
+        text = text.strip()
+        if not text or text == self._last_text or now < self._next_edit or not self.throttle.try_acquire():
+            return
+        with self.job.lock:
+            if self.job.cancelled:
+                return
+            try:
+                sent = self.job.bot.edit_message_text(chat_id=self.job.chat_id, message_id=self.job.message_id, text=text + self.cursor)
+            except TelegramError as e:
+                if not isinstance(e, RetryAfter) and "not modified" not in str(e).lower():
+                    logger.warning(f"Не удалось обновить сообщение с отзывом: {e}")
+                sent = e
+        self.edits += 1
+        self._last_text = text
+        self._next_edit = now + self.min_interval
+        if isinstance(sent, Future):
+            sent.add_done_callback(lambda future: self._edited(future.exception()))
+        else:
+            self._edited(sent if isinstance(sent, Exception) else None)
+
+    def _edited(self, error):
+        if error is None or "not modified" in str(error).lower():
+            self.job.progress_shown = True
+            return
+        # Правка не дошла – следующая отправит текст заново
+        self._last_text = None
+        if isinstance(error, RetryAfter):
+            self._next_edit = max(self._next_edit, time.monotonic() + error.retry_after)
+
+
+# Конвейер генерации отзывов вне потоков диспетчера.
+# generate(job) выполняется в собственном пуле потоков; результат доставляется
+# через job_queue вызовом on_success(context, job, review) или on_error(context, job, exc).
+class ReviewPipeline:
+    def __init__(self, generate, on_success, on_error, on_still_working=None,
+                 workers: int = 4, max_pending: int = 32, still_working_after: float = 10):
+        self._generate = generate
+        self._on_success = on_success
+        self._on_error = on_error
+        self._on_still_working = on_still_working
+        self.workers = workers
+        self.max_pending = max_pending
+        self.still_working_after = still_working_after
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="review")
+        self._lock = threading.Lock()
+        self._jobs = {}  # chat_id -> ReviewJob
+        # Задания в пуле, включая отменённые, но ещё выполняющиеся: отмена не прерывает
+        # начатый запрос к OpenAI, поэтому слот освобождается только по завершении _run
+        self._inflight = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    def pending(self, chat_id: int) -> bool:
+        with self._lock:
+            return chat_id in self._jobs
+
+    # Ставит задание в очередь; None, если очередь переполнена
+    def submit(self, job_queue, job: ReviewJob):
+        with self._lock:
+            previous = self._jobs.get(job.chat_id)
+        if previous is not None and not previous.done:
+            # Повторный запуск из того же чата заменяет предыдущий (отмена вне блокировки:
+            # отмена ещё не начатого задания сразу вызывает _release)
+            previous.cancel()
+            with self._lock:
+                self.cancelled += 1
+        with self._lock:
+            if self._inflight >= self.max_pending:
+                self.rejected += 1
+                return None
+            self._jobs[job.chat_id] = job
+            self._inflight += 1
+        try:
+            job.future = self._executor.submit(self._run, job_queue, job)
+        except Exception:
+            self._release(None)
+            raise
+        job.future.add_done_callback(self._release)
+        if self._on_still_working is not None and self.still_working_after:
+            job_queue.run_once(self._still_working, self.still_working_after, context=job)
+        return job
+
+    def cancel(self, chat_id: int) -> bool:
+        with self._lock:
+            job = self._jobs.pop(chat_id, None)
+            if job is None:
+                return False
+            self.cancelled += 1
+        job.cancel()
+        return True
+
+    def _release(self, future):
+        with self._lock:
+            self._inflight -= 1
+
+    def _run(self, job_queue, job: ReviewJob):
+        job.started = time.monotonic()
+        try:
+            if job.cancelled:
+                raise ReviewCancelled()
+            result, error = self._generate(job), None
+        except Exception as e:
+            result, error = None, e
+        job.finished = time.monotonic()
+        job_queue.run_once(self._deliver, 0, context=(job, result, error))
+
+    def _deliver(self, context):
+        job, result, error = context.job.context
+        with self._lock:
+            if self._jobs.get(job.chat_id) is job:
+                del self._jobs[job.chat_id]
+        if job.cancelled or isinstance(error, ReviewCancelled):
+            return
+        with job.lock:
+            if error is not None:
+                self.failed += 1
+                logger.error(f"Ошибка генерации отзыва для чата {job.chat_id}: {error}")
+                self._on_error(context, job, error)
+                return
+            self.completed += 1
+            self._on_success(context, job, result)
+
+    def _still_working(self, context):
+        job = context.job.context
+        with job.lock:
+            if not job.done and not job.cancelled and not job.progress_shown:
+                self._on_still_working(context, job)
+
+    def shutdown(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancel()
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            active = [j for j in self._jobs.values() if not j.done]
+        return {
+            "queued": sum(1 for j in active if j.started is None),
+            "running": sum(1 for j in active if j.started is not None),
+            "inflight": self._inflight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,322 @@
+import heapq
+import itertools
+import logging
+import queue
+import signal
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from telegram import Update
+from telegram.ext import Defaults, Dispatcher, JobQueue, TypeHandler, Updater
+from telegram.ext.extbot import ExtBot
+from telegram.utils.request import Request
+
+from config import (
+    TELEGRAM_API_URL,
+    BOT_MODE,
+    BOT_WORKERS,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_QUEUE_PUT_TIMEOUT,
+    UPDATE_QUEUE_STATS_INTERVAL,
+    DRAIN_TIMEOUT,
+    UPDATE_REQUEUE_DELAY,
+    UPDATE_REQUEUE_ATTEMPTS,
+    UPDATE_REQUEUE_PER_USER,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_URL,
+    OUTBOUND_QUEUE_ENABLED,
+    OUTBOUND_GLOBAL_PER_SECOND,
+    OUTBOUND_CHAT_PER_SECOND,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_GROUP_PER_MINUTE,
+    OUTBOUND_WORKERS,
+    OUTBOUND_MAX_RETRIES,
+    METRICS_PORT,
+    METRICS_LISTEN,
+    METRICS_LOG_INTERVAL,
+)
+from metrics import log_snapshot, registry, start_http_server
+from outbound import OutboundQueue, QueuedBot
+import startup
+
+logger = logging.getLogger(__name__)
+
+
+# Ограниченная очередь входящих обновлений со статистикой заполнения.
+# Если очередь полна дольше put_timeout, put() бросает queue.Full: в режиме webhook
+# Telegram получает 500 и доставит обновление повторно – это и есть обратное давление.
+class UpdateQueue(queue.Queue):
+    def __init__(self, maxsize: int = 0, put_timeout: float = None):
+        super().__init__(maxsize)
+        self.put_timeout = put_timeout
+        self._stats_lock = threading.Lock()
+        self._accepting = True
+        self.received = 0
+        self.rejected = 0
+        self.blocked = 0
+        self.high_water = 0
+        self._wait_total = 0.0
+
+    # После close() новые обновления не принимаются (используется при остановке)
+    def close(self):
+        self._accepting = False
+
+    def put(self, item, block=True, timeout=None):
+        if not self._accepting:
+            with self._stats_lock:
+                self.rejected += 1
+            raise queue.Full("Очередь обновлений закрыта")
+        if timeout is None:
+            timeout = self.put_timeout
+        started = time.monotonic()
+        full = self.maxsize > 0 and self.qsize() >= self.maxsize
+        try:
+            super().put(item, block, timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += 1
+            logger.warning("Очередь обновлений переполнена, обновление отклонено")
+            raise
+        waited = time.monotonic() - started
+        with self._stats_lock:
+            self.received += 1
+            self.blocked += full
+            self._wait_total += waited
+            self.high_water = max(self.high_water, self.qsize())
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "depth": self.qsize(),
+                "maxsize": self.maxsize,
+                "high_water": self.high_water,
+                "received": self.received,
+                "blocked": self.blocked,
+                "rejected": self.rejected,
+                "put_wait_avg_ms": round(self._wait_total / self.received * 1000, 2) if self.received else 0.0,
+            }
+
+
+# Обработчики выполняются в пуле (run_async), и пока обработчик пользователя не вернул новое состояние,
+# ConversationHandler направляет его следующие обновления в состояние WAITING, а без обработчика там – отбрасывает.
+# WaitingRequeue.handler() для WAITING возвращает такое обновление в очередь через delay секунд
+# (не больше attempts раз), и оно будет разобрано уже в новом состоянии диалога.
+# Отложенные обновления ждут в собственной очереди с одним потоком, а не в job_queue: после каждой
+# задачи job_queue диспетчер сохраняет данные всех пользователей. У одного пользователя одновременно
+# ждут не больше per_user обновлений – остальные отбрасываются.
+class WaitingRequeue:
+    MAX_TRACKED = 10000  # сколько update_id помнить для подсчёта попыток
+
+    def __init__(self, delay: float = UPDATE_REQUEUE_DELAY, attempts: int = UPDATE_REQUEUE_ATTEMPTS,
+                 per_user: int = UPDATE_REQUEUE_PER_USER):
+        self.delay = delay
+        self.attempts = attempts
+        self.per_user = per_user
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._tried = OrderedDict()  # update_id -> сколько раз уже возвращали
+        self._delayed = []  # куча (когда вернуть, номер, обновление, очередь обновлений)
+        self._counter = itertools.count()
+        self._waiting = Counter()  # user_id -> сколько его обновлений ждёт возврата
+        self._thread = None
+        self.requeued = 0
+        self.dropped = 0
+
+    # run_async=False: обработчик только откладывает обновление, а его результат (None)
+    # не должен заменить ожидаемое состояние диалога
+    def handler(self) -> TypeHandler:
+        return TypeHandler(Update, self._requeue, run_async=False)
+
+    def _requeue(self, update: Update, context):
+        user_id = update.effective_user.id if update.effective_user else None
+        with self._lock:
+            tried = self._tried.pop(update.update_id, 0)
+            if tried >= self.attempts:
+                self.dropped += 1
+                logger.warning(f"Обновление {update.update_id} отброшено: обработка предыдущего не завершилась")
+                return
+            if self.per_user and self._waiting[user_id] >= self.per_user:
+                self.dropped += 1
+                logger.warning(f"Обновление {update.update_id} отброшено: у пользователя {user_id} уже ждут {self.per_user}")
+                return
+            self._tried[update.update_id] = tried + 1
+            while len(self._tried) > self.MAX_TRACKED:
+                self._tried.popitem(last=False)
+            self._waiting[user_id] += 1
+            self.requeued += 1
+            when = time.monotonic() + self.delay
+            heapq.heappush(self._delayed, (when, next(self._counter), update, context.dispatcher.update_queue))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="waiting-requeue", daemon=True)
+                self._thread.start()
+            self._ready.notify()
+
+    def _loop(self):
+        while True:
+            with self._ready:
+                while not self._delayed or self._delayed[0][0] > time.monotonic():
+                    self._ready.wait(self._delayed[0][0] - time.monotonic() if self._delayed else None)
+                _, _, update, update_queue = heapq.heappop(self._delayed)
+                user_id = update.effective_user.id if update.effective_user else None
+                self._waiting[user_id] -= 1
+                if not self._waiting[user_id]:
+                    del self._waiting[user_id]
+            try:
+                update_queue.put(update, block=False)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                logger.warning(f"Обновление {update.update_id} отброшено: очередь обновлений полна или закрыта")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requeued": self.requeued, "dropped": self.dropped, "delayed": len(self._delayed)}
+
+
+# JobQueue PTB 13 после каждой задачи вызывает update_persistence() – сохранение user_data всех
+# пользователей. Здесь этого нет: задача, изменившая данные пользователя, сохраняет их сама (persist_user_data).
+class UserJobQueue(JobQueue):
+    def _update_persistence(self, event):
+        pass
+
+
+def persist_user_data(context, user_id: int):
+    dispatcher = context.dispatcher
+    if dispatcher.persistence is not None and user_id in dispatcher.user_data:
+        dispatcher.persistence.update_user_data(user_id, dispatcher.user_data[user_id])
+
+
+# Updater с ограниченной очередью обновлений и пулом из workers потоков:
+# все обработчики по умолчанию выполняются в этом пуле (run_async), а не в единственном потоке диспетчера
+def build_updater(token: str, workers: int = BOT_WORKERS, persistence=None, mode: str = BOT_MODE) -> Updater:
+    # Соединений к Bot API: по одному на поток пула + диспетчер, поллер, job_queue, основной поток
+    # и по одному на поток очереди исходящих сообщений
+    defaults = Defaults(run_async=True)
+    if OUTBOUND_QUEUE_ENABLED:
+        outbound = OutboundQueue(
+            OUTBOUND_GLOBAL_PER_SECOND,
+            OUTBOUND_CHAT_PER_SECOND,
+            OUTBOUND_CHAT_BURST,
+            OUTBOUND_GROUP_PER_MINUTE,
+            OUTBOUND_WORKERS,
+            OUTBOUND_MAX_RETRIES,
+        )
+        request = Request(con_pool_size=workers + 4 + OUTBOUND_WORKERS)
+        bot = QueuedBot(token, base_url=TELEGRAM_API_URL, request=request, defaults=defaults, outbound=outbound)
+    else:
+        request = Request(con_pool_size=workers + 4)
+        bot = ExtBot(token, base_url=TELEGRAM_API_URL, request=request, defaults=defaults)
+    put_timeout = UPDATE_QUEUE_PUT_TIMEOUT if mode == "webhook" else None
+    update_queue = UpdateQueue(UPDATE_QUEUE_SIZE, put_timeout)
+    job_queue = UserJobQueue()
+    dispatcher = Dispatcher(bot, update_queue, workers=workers, job_queue=job_queue, persistence=persistence)
+    job_queue.set_dispatcher(dispatcher)
+    # workers=None: пул потоков уже задан в Dispatcher (по умолчанию Updater требует свой)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def log_update_queue_stats(context):
+    stats = context.dispatcher.update_queue.stats()
+    logger.info("Update queue: " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+    if isinstance(context.bot, QueuedBot):
+        stats = context.bot.outbound.stats()
+        logger.info("Outbound queue: " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+
+
+# Режим shard (воркер sharding.py): обновления приходят от супервизора в виде dict через updates;
+# updates.get() возвращает None, когда супервизор останавливает воркер
+def start_feed(updater: Updater, updates, stop_event: threading.Event):
+    def feed():
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            try:
+                updater.update_queue.put(Update.de_json(data, updater.bot))
+            except queue.Full:
+                break  # очередь закрыта – воркер останавливается
+        stop_event.set()
+
+    updater.job_queue.start()
+    threading.Thread(target=updater.dispatcher.start, name="dispatcher", daemon=True).start()
+    threading.Thread(target=feed, name="shard-feed", daemon=True).start()
+
+
+# Запуск в режиме polling, webhook (BOT_MODE) или shard и ожидание сигнала остановки.
+# Webhook слушает WEBHOOK_LISTEN:WEBHOOK_PORT по пути /<token> и регистрируется как WEBHOOK_URL/<token>.
+# Метрики публикуются на METRICS_LISTEN:metrics_port/metrics, сводка пишется в лог раз в METRICS_LOG_INTERVAL.
+# Шаги warm_up ([(имя, функция)]) выполняются в фоне уже после начала приёма обновлений,
+# по их завершении /ready начинает отвечать 200.
+def run(updater: Updater, token: str, mode: str = BOT_MODE, warm_up=(), updates=None, metrics_port: int = METRICS_PORT):
+    if UPDATE_QUEUE_STATS_INTERVAL and isinstance(updater.update_queue, UpdateQueue):
+        updater.job_queue.run_repeating(log_update_queue_stats, interval=UPDATE_QUEUE_STATS_INTERVAL)
+    if isinstance(updater.update_queue, UpdateQueue):
+        registry.collector("update_queue", updater.update_queue.stats)
+    if isinstance(updater.bot, QueuedBot):
+        registry.collector("outbound", updater.bot.outbound.stats)
+    metrics_server = start_http_server(metrics_port, METRICS_LISTEN, startup.is_ready) if metrics_port else None
+    if METRICS_LOG_INTERVAL:
+        updater.job_queue.run_repeating(log_snapshot, interval=METRICS_LOG_INTERVAL)
+
+    stop_event = threading.Event()
+    if mode == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("Для режима webhook нужно задать WEBHOOK_URL")
+        updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=token,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{token}",
+        )
+        logger.info(f"Webhook запущен на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+    elif mode == "polling":
+        updater.start_polling()
+    elif mode == "shard":
+        start_feed(updater, updates, stop_event)
+    else:
+        raise ValueError(f"Неизвестный режим BOT_MODE: {mode}")
+    startup.mark("serving")
+    logger.info(f"Бот принимает обновления через {startup.phases()['serving']:.2f} с после запуска")
+    startup.warm_up(warm_up)
+
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(sig, lambda signum, frame: stop_event.set())
+    if mode == "shard":
+        # Ctrl+C получает вся группа процессов: воркер дорабатывает то, что ему успеет передать супервизор,
+        # и останавливается по его команде
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while not stop_event.wait(1):
+        pass
+    startup.stopping()
+    if mode == "shard" and isinstance(updater.update_queue, UpdateQueue):
+        updater.update_queue.close()
+    drain(updater)
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+
+# Плавная остановка: перестаём принимать обновления (webhook или polling), дожидаемся разбора очереди
+# (не дольше DRAIN_TIMEOUT) и только потом останавливаем диспетчер
+def drain(updater: Updater, timeout: float = DRAIN_TIMEOUT):
+    logger.info("Остановка: дорабатываем очередь обновлений...")
+    if updater.httpd:
+        if isinstance(updater.update_queue, UpdateQueue):
+            updater.update_queue.close()
+        updater.httpd.shutdown()
+        updater.httpd = None
+    elif updater.running:
+        # Polling: в PTB 13 нет stop_polling – поллер проверяет running и, сбросив его, больше не кладёт
+        # обновления в очередь (полученные в последнем getUpdates Telegram отдаст повторно после перезапуска)
+        updater.running = False
+    deadline = time.monotonic() + timeout
+    while not updater.update_queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    left = updater.update_queue.qsize()
+    if left:
+        logger.warning(f"Не успели обработать обновлений: {left}")
+    updater.stop()
+    if isinstance(updater.bot, QueuedBot):
+        # Отправляем то, что обработчики успели поставить в очередь
+        updater.bot.outbound.stop()
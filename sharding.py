@@ -0,0 +1,411 @@
+# Клиентский бот в нескольких процессах: супервизор принимает обновления (polling или webhook, BOT_MODE)
+# и раздаёт их SHARD_PROCESSES воркерам по effective_user.id – диалог пользователя всегда
+# обрабатывает один и тот же процесс. Воркер – обычный main_client в режиме shard.
+#     SHARD_PROCESSES=4 python sharding.py
+# Упавший воркер перезапускается, непрочитанные им обновления передаются новому процессу.
+# Метрики супервизора (нагрузка по воркерам) – на METRICS_PORT, воркера i – на METRICS_PORT + 1 + i.
+import startup  # первым: от начала его импорта считается время запуска
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from telegram.ext import Dispatcher, JobQueue, Updater
+from telegram.ext.extbot import ExtBot
+from telegram.utils.request import Request
+
+import config
+from config import (
+    TELEGRAM_CLIENT_TOKEN,
+    TELEGRAM_API_URL,
+    BOT_MODE,
+    UPDATE_QUEUE_STATS_INTERVAL,
+    DRAIN_TIMEOUT,
+    METRICS_PORT,
+    SHARD_PROCESSES,
+    SHARD_QUEUE_SIZE,
+    SHARD_PUT_TIMEOUT,
+    SHARD_RESTART_DELAY,
+    SHARD_STATS_INTERVAL,
+)
+from metrics import registry
+from serving import UpdateQueue, run
+
+logger = logging.getLogger(__name__)
+
+# Лимиты на бота и на ключ OpenAI: каждый воркер получает свою долю
+SHARED_LIMITS = (
+    "OUTBOUND_GLOBAL_PER_SECOND",
+    "OUTBOUND_GROUP_PER_MINUTE",
+    "REVIEW_STREAM_EDITS_PER_SECOND",
+    "OPENAI_RPM",
+    "OPENAI_TPM",
+    "OPENAI_FALLBACK_RPM",
+    "OPENAI_FALLBACK_TPM",
+)
+
+
+# Переменные окружения воркеров (процессы запускаются заново и читают config.py сами)
+def worker_environment(processes: int) -> dict:
+    return {name: str(getattr(config, name) / processes) for name in SHARED_LIMITS}
+
+
+# Номер воркера для обновления: по пользователю, для обновлений без пользователя – по чату
+def shard_of(update, shards: int) -> int:
+    if update.effective_user is not None:
+        return update.effective_user.id % shards
+    if update.effective_chat is not None:
+        return update.effective_chat.id % shards
+    return update.update_id % shards
+
+
+# --- Воркер ---
+
+# Источник обновлений воркера для serving.run(mode="shard"): None – пора останавливаться
+# (команда супервизора или супервизор завершился, не успев её отправить)
+class ShardSource:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self):
+        try:
+            return self.conn.recv()
+        except (EOFError, OSError):
+            logger.error("Супервизор завершился, останавливаем воркер")
+            return None
+
+
+# Нагрузка воркера для супервизора
+def worker_load() -> dict:
+    snapshot = registry.snapshot()
+    handlers = snapshot.get("bot_handler_duration_seconds", {})
+    update_queue = snapshot.get("update_queue", {})
+    reviews = snapshot.get("review_jobs", {})
+    return {
+        "pid": os.getpid(),
+        "ready": int(startup.is_ready()),
+        "cpu_seconds": time.process_time(),
+        "received": update_queue.get("received", 0),
+        "queue_depth": update_queue.get("depth", 0),
+        "handled": sum(h["count"] for h in handlers.values()),
+        "errors": sum(snapshot.get("bot_handler_errors_total", {}).values()),
+        "reviews": reviews.get("queued", 0) + reviews.get("running", 0),
+    }
+
+
+def report_load(conn, interval: float):
+    while True:
+        try:
+            conn.send(worker_load())
+        except (BrokenPipeError, EOFError, OSError):
+            return  # супервизор завершился
+        except Exception as e:
+            logger.warning(f"Не удалось собрать нагрузку воркера: {e}")
+        time.sleep(interval)
+
+
+def worker_main(index: int, shards: int, updates_conn, load_conn, stats_interval: float):
+    logging.basicConfig(
+        format=f"%(asctime)s - shard {index} - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    import main_client
+
+    threading.Thread(target=report_load, args=(load_conn, stats_interval), name="shard-load", daemon=True).start()
+    main_client.main(
+        "shard",
+        updates=ShardSource(updates_conn),
+        metrics_port=METRICS_PORT + 1 + index if METRICS_PORT else 0,
+        shard=(index, shards),
+    )
+
+
+# --- Супервизор ---
+
+# Канал обновлений к воркеру: ограниченная очередь в супервизоре и поток, пересылающий её в pipe.
+# multiprocessing.Queue здесь не подходит: читатель держит её блокировку всё время ожидания,
+# и убитый воркер оставил бы очередь недоступной. У супервизора остаётся копия читающего
+# конца pipe – после падения воркера непрочитанное забирается обратно (reset()).
+class ShardChannel:
+    def __init__(self, context, maxsize: int):
+        self.context = context
+        self.maxsize = maxsize
+        self._cond = threading.Condition()
+        self._items = deque()
+        self._sending = False
+        self._paused = False
+        self.reader, self._writer = context.Pipe(duplex=False)
+        threading.Thread(target=self._send_loop, name="shard-channel", daemon=True).start()
+
+    def put(self, item, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while len(self._items) >= self.maxsize:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Full("Очередь воркера переполнена")
+                self._cond.wait(remaining)
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                while not self._items or self._paused:
+                    self._cond.wait()
+                item = self._items.popleft()
+                writer = self._writer
+                self._sending = True
+                self._cond.notify_all()
+            try:
+                # Блокируется, пока воркер не освободит место в pipe, – так работает обратное давление
+                writer.send(item)
+            except OSError as e:
+                logger.warning(f"Не удалось передать обновление воркеру: {e}")
+            finally:
+                with self._cond:
+                    self._sending = False
+                    self._cond.notify_all()
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._items)
+
+    # После падения воркера: забираем из pipe непрочитанное, заводим новый pipe и ставим
+    # забранное в начало очереди. Возвращает количество возвращённых обновлений.
+    def reset(self) -> int:
+        with self._cond:
+            self._paused = True
+        leftovers = []
+        try:
+            while True:
+                with self._cond:
+                    sending = self._sending
+                if self.reader.poll(0.05):
+                    leftovers.append(self.reader.recv())
+                elif not sending:
+                    break
+        except Exception as e:
+            # Воркер умер посреди чтения сообщения – остаток pipe не разобрать
+            logger.warning(f"Часть обновлений упавшего воркера потеряна: {e}")
+        self.reader.close()
+        self._writer.close()
+        with self._cond:
+            self.reader, self._writer = self.context.Pipe(duplex=False)
+            self._items.extendleft(reversed(leftovers))
+            self._paused = False
+            self._cond.notify_all()
+        return len(leftovers)
+
+
+# Процесс-воркер и всё, что супервизор о нём знает
+class Worker:
+    def __init__(self, index: int, channel: ShardChannel):
+        self.index = index
+        self.channel = channel      # обновления (dict) к воркеру
+        self.process = None
+        self.load_conn = None       # канал, по которому воркер присылает worker_load()
+        self.started = 0.0
+        self.restart_at = None      # когда перезапустить упавший процесс
+        self.restarts = 0
+        self.forwarded = 0
+        self.load = {}
+        self.cpu_percent = 0.0
+        self._cpu_at = None         # (cpu_seconds, время) предыдущего отчёта
+
+
+class Supervisor:
+    def __init__(self, processes: int, queue_size: int = 1000, restart_delay: float = 5.0,
+                 stats_interval: float = 5.0):
+        if processes < 1:
+            raise ValueError("Нужен хотя бы один воркер")
+        self.context = multiprocessing.get_context("spawn")
+        self.restart_delay = restart_delay
+        self.stats_interval = stats_interval
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.workers = [Worker(i, ShardChannel(self.context, queue_size)) for i in range(processes)]
+
+    def _spawn(self, worker: Worker):
+        reader, writer = self.context.Pipe(duplex=False)
+        worker.process = self.context.Process(
+            target=worker_main,
+            args=(worker.index, len(self.workers), worker.channel.reader, writer, self.stats_interval),
+            name=f"client-shard-{worker.index}",
+        )
+        worker.process.start()
+        writer.close()
+        worker.load_conn = reader
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        worker.load = {}
+        worker._cpu_at = None
+        logger.info(f"Воркер {worker.index} запущен, pid {worker.process.pid}")
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def forward(self, update, timeout: float = None):
+        worker = self.workers[shard_of(update, len(self.workers))]
+        worker.channel.put(update.to_dict(), timeout)
+        with self._lock:
+            worker.forwarded += 1
+
+    def _read_load(self, worker: Worker):
+        try:
+            while worker.load_conn.poll():
+                load = worker.load_conn.recv()
+                now = time.monotonic()
+                if worker._cpu_at is not None:
+                    cpu, at = worker._cpu_at
+                    worker.cpu_percent = round((load["cpu_seconds"] - cpu) / max(now - at, 1e-3) * 100, 1)
+                worker._cpu_at = (load["cpu_seconds"], now)
+                worker.load = load
+        except (EOFError, OSError):
+            pass
+
+    def _restart(self, worker: Worker):
+        moved = worker.channel.reset()
+        worker.load_conn.close()
+        worker.restarts += 1
+        self._spawn(worker)
+        if moved:
+            logger.info(f"Воркеру {worker.index} передано непрочитанных обновлений: {moved}")
+
+    # Периодическая задача для job_queue: нагрузка воркеров и перезапуск упавших
+    def check(self, context=None):
+        for worker in self.workers:
+            self._read_load(worker)
+            if self._stopping or worker.process.is_alive():
+                continue
+            now = time.monotonic()
+            if worker.restart_at is None:
+                logger.error(f"Воркер {worker.index} (pid {worker.process.pid}) завершился с кодом {worker.process.exitcode}")
+                # Падение сразу после запуска – не перезапускаем в цикле без паузы
+                worker.restart_at = max(now, worker.started + self.restart_delay)
+            if now >= worker.restart_at:
+                self._restart(worker)
+
+    # Шаг прогрева супервизора: готов, когда прогрелись все воркеры
+    def wait_ready(self, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while True:
+            waiting = [w.index for w in self.workers if not w.load.get("ready")]
+            if not waiting:
+                return
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Воркеры ещё не готовы: {waiting}")
+            time.sleep(0.5)
+
+    # Плавная остановка: после уже переданных обновлений каждый воркер получает None,
+    # дорабатывает свою очередь и завершается
+    def stop(self, timeout: float = DRAIN_TIMEOUT + 10):
+        self._stopping = True
+        for worker in self.workers:
+            if worker.process.is_alive():
+                try:
+                    worker.channel.put(None, 1)
+                except queue.Full:
+                    worker.process.terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logger.warning(f"Воркер {worker.index} не остановился за {timeout:.0f} с, завершаем принудительно")
+                worker.process.terminate()
+                worker.process.join(5)
+
+    def worker_stats(self, worker: Worker) -> dict:
+        load = worker.load
+        with self._lock:
+            forwarded = worker.forwarded
+        return {
+            "alive": int(worker.process.is_alive()),
+            "ready": load.get("ready", 0),
+            "restarts": worker.restarts,
+            "forwarded": forwarded,
+            "ipc_depth": worker.channel.depth(),
+            "queue_depth": load.get("queue_depth", 0),
+            "handled": load.get("handled", 0),
+            "errors": load.get("errors", 0),
+            "reviews": load.get("reviews", 0),
+            "cpu_percent": worker.cpu_percent,
+        }
+
+    # Сумма по воркерам (cpu_percent – суммарная загрузка, 100 = одно ядро)
+    def stats(self) -> dict:
+        total = {}
+        for worker in self.workers:
+            for key, value in self.worker_stats(worker).items():
+                total[key] = total.get(key, 0) + value
+        total["cpu_percent"] = round(total.get("cpu_percent", 0.0), 1)
+        total["workers"] = len(self.workers)
+        return total
+
+
+# Очередь обновлений супервизора: вместо хранения передаёт обновление воркеру.
+# Если очередь воркера полна дольше put_timeout, put() бросает queue.Full – как UpdateQueue
+# (в режиме webhook Telegram доставит обновление повторно).
+class ShardRouter(UpdateQueue):
+    def __init__(self, supervisor: Supervisor, put_timeout: float = None):
+        super().__init__(0, put_timeout)
+        self.supervisor = supervisor
+
+    def put(self, item, block=True, timeout=None):
+        if not self._accepting:
+            with self._stats_lock:
+                self.rejected += 1
+            raise queue.Full("Очередь обновлений закрыта")
+        started = time.monotonic()
+        try:
+            self.supervisor.forward(item, self.put_timeout if timeout is None else timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += 1
+            logger.warning("Очередь воркера переполнена, обновление отклонено")
+            raise
+        with self._stats_lock:
+            self.received += 1
+            self._wait_total += time.monotonic() - started
+
+
+# Updater супервизора: только получение обновлений, обработчиков нет
+def build_front(token: str, router: ShardRouter) -> Updater:
+    bot = ExtBot(token, base_url=TELEGRAM_API_URL, request=Request(con_pool_size=4))
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, router, workers=1, job_queue=job_queue)
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def log_shard_stats(context):
+    supervisor = context.dispatcher.update_queue.supervisor
+    for worker in supervisor.workers:
+        stats = supervisor.worker_stats(worker)
+        logger.info(f"Shard {worker.index}: " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - supervisor - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    startup.mark("imported")
+    os.environ.update(worker_environment(SHARD_PROCESSES))
+    supervisor = Supervisor(SHARD_PROCESSES, SHARD_QUEUE_SIZE, SHARD_RESTART_DELAY, SHARD_STATS_INTERVAL)
+    supervisor.start()
+    router = ShardRouter(supervisor, SHARD_PUT_TIMEOUT if BOT_MODE == "webhook" else None)
+    updater = build_front(TELEGRAM_CLIENT_TOKEN, router)
+    registry.collector("shards", supervisor.stats)
+    for worker in supervisor.workers:
+        registry.collector(f"shard{worker.index}", lambda worker=worker: supervisor.worker_stats(worker))
+    updater.job_queue.run_repeating(supervisor.check, interval=1)
+    if UPDATE_QUEUE_STATS_INTERVAL:
+        updater.job_queue.run_repeating(log_shard_stats, interval=UPDATE_QUEUE_STATS_INTERVAL)
+    try:
+        run(updater, TELEGRAM_CLIENT_TOKEN, BOT_MODE, warm_up=[("workers", supervisor.wait_ready)])
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()
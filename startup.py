@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+
+from config import STARTUP_WARMUP_RETRY
+from metrics import log_event, registry
+
+# Отсчёт времени запуска: модуль импортируется первым в main_client.py / main_admin.py
+STARTED = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_phases = {}  # этап -> секунд от старта
+_ready = threading.Event()
+_stopping = threading.Event()
+
+
+# Этапы запуска: imported (модули загружены), serving (бот принимает обновления),
+# warm_<шаг> (закончен шаг прогрева), ready (прогрев завершён)
+def mark(phase: str):
+    with _lock:
+        _phases[phase] = round(time.perf_counter() - STARTED, 3)
+
+
+def phases() -> dict:
+    with _lock:
+        return dict(_phases)
+
+
+# Готовность для /ready: бот принимает обновления, пул БД и кэши прогреты, остановка не началась
+def is_ready() -> bool:
+    return _ready.is_set() and not _stopping.is_set()
+
+
+def stopping():
+    _stopping.set()
+
+
+def _run_warm_up(steps):
+    for name, step in steps:
+        while not _stopping.is_set():
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                logger.warning(f"Прогрев {name} не удался: {e}; повтор через {STARTUP_WARMUP_RETRY:.0f} с")
+                _stopping.wait(STARTUP_WARMUP_RETRY)
+                continue
+            mark(f"warm_{name}")
+            logger.info(f"Прогрев {name}: {time.perf_counter() - started:.3f} с")
+            break
+    if _stopping.is_set():
+        return
+    mark("ready")
+    _ready.set()
+    log_event("startup", **phases())
+
+
+# Прогрев в фоне после начала приёма обновлений: steps – [(имя, функция)], выполняются по порядку,
+# неудачный шаг повторяется, пока не пройдёт (например, БД ещё не поднялась)
+def warm_up(steps) -> threading.Thread:
+    thread = threading.Thread(target=_run_warm_up, args=(list(steps),), name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+registry.collector("startup", phases)
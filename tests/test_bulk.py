@@ -0,0 +1,149 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import bulk
+import main_admin
+from bulk import BulkError, parse, validate
+
+
+def test_csv_with_bom_and_comma():
+    content = b"\xef\xbb\xbftelegram_id,business_type\n1,clinic\n2,dental\n"
+    assert parse(content, "users.csv") == [
+        (2, {"telegram_id": "1", "business_type": "clinic"}),
+        (3, {"telegram_id": "2", "business_type": "dental"}),
+    ]
+
+
+def test_csv_with_semicolon():
+    content = "business_type;question_text\nclinic;Как вам, врач?\nclinic;Что понравилось?\n".encode()
+    records = parse(content, "questions.csv")
+    assert [record["question_text"] for line, record in records] == ["Как вам, врач?", "Что понравилось?"]
+
+
+def test_json_list():
+    content = '[{"telegram_id": 1, "business_type": "clinic"}, "строка"]'.encode()
+    assert parse(content, "users.json") == [(1, {"telegram_id": 1, "business_type": "clinic"}), (2, "строка")]
+
+
+@pytest.mark.parametrize("content, filename", [
+    (b'{"telegram_id": 1}', "users.json"),
+    (b"[{", "users.json"),
+    ("telegram_id\n1\n".encode("cp1251") + "клиника".encode("cp1251"), "users.csv"),
+])
+def test_unreadable_file_is_rejected(content, filename):
+    with pytest.raises(BulkError):
+        parse(content, filename)
+
+
+def test_errors_point_to_file_lines():
+    content = b"telegram_id,business_type\n1,clinic\n\n2\nabc,clinic\n3,\n"
+    rows, errors = validate("users", parse(content, "users.csv"))
+    assert rows == [(1, "clinic")]
+    assert errors == [
+        (4, "не заполнено: business_type"),
+        (5, "telegram_id должен быть числом: abc"),
+        (6, "не заполнено: business_type"),
+    ]
+
+
+def test_missing_and_extra_columns():
+    # Нет колонки question_text – ошибка в каждой строке; лишние колонки не мешают
+    rows, errors = validate("questions", parse(b"business_type,text\nclinic,a\nclinic,b\n", "q.csv"))
+    assert rows == [] and errors == [(2, "не заполнено: question_text"), (3, "не заполнено: question_text")]
+    content = b"telegram_id,business_type,comment\n1,clinic,x\n2,dental,y,z\n"
+    assert validate("users", parse(content, "users.csv")) == ([(1, "clinic"), (2, "dental")], [])
+
+
+def test_duplicate_telegram_id():
+    content = b"telegram_id,business_type\n1,clinic\n2,dental\n001,salon\n"
+    rows, errors = validate("users", parse(content, "users.csv"))
+    assert rows == [(1, "clinic"), (2, "dental")]
+    assert errors == [(4, "telegram_id 1 повторяется (строка 2)")]
+
+
+def test_json_record_must_be_object():
+    rows, errors = validate("prompts", [(1, {"business_type": "clinic", "prompt_text": "Промпт"}), (2, ["clinic"])])
+    assert rows == [("clinic", "Промпт")]
+    assert errors == [(2, "ожидается объект с полями business_type, prompt_text")]
+
+
+# Соединение, запоминающее запросы; execute_values подменяется в тестах
+class RecordingConnection:
+    def __init__(self):
+        self.queries = []
+        self.committed = False
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def commit(self):
+        self.committed = True
+
+
+@pytest.fixture
+def db(monkeypatch):
+    conn = RecordingConnection()
+
+    @contextmanager
+    def connection():
+        yield conn
+
+    monkeypatch.setattr(bulk, "connection", connection)
+    monkeypatch.setattr(bulk, "execute_values", lambda cur, query, rows, page_size: cur.execute(query, list(rows)))
+    monkeypatch.setattr(bulk, "PAGE_SIZE", 2)
+    return conn
+
+
+def test_load_replaces_questions_page_by_page(db):
+    rows = [("clinic", "a"), ("salon", "b"), ("clinic", "c")]
+    progress = []
+    assert bulk.load("questions", rows, lambda done, total: progress.append((done, total))) == 3
+    delete, *inserts = db.queries
+    assert delete == ("DELETE FROM questions WHERE business_type = ANY(%s)", (["clinic", "salon"],))
+    assert [params for query, params in inserts] == [rows[:2], rows[2:]]
+    assert progress == [(2, 3), (3, 3)] and db.committed
+
+
+def test_load_users_upserts_without_delete(db):
+    bulk.load("users", [(1, "clinic")])
+    assert [query for query, params in db.queries] == [bulk.SPECS["users"].insert]
+
+
+class Status:
+    def __init__(self):
+        self.texts = []
+
+    def edit_text(self, text):
+        self.texts.append(text)
+
+
+def test_import_with_invalid_row_loads_nothing(monkeypatch):
+    content = b"telegram_id,business_type\n1,clinic\n2\n"
+    status = Status()
+    message = SimpleNamespace(
+        caption="/import users",
+        document=SimpleNamespace(
+            file_size=len(content),
+            file_name="users.csv",
+            get_file=lambda: SimpleNamespace(download_as_bytearray=lambda: bytearray(content)),
+        ),
+        reply_text=lambda text: status,
+    )
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1), message=message)
+    loaded = []
+    monkeypatch.setattr(main_admin, "ADMIN_IDS", {1})
+    monkeypatch.setattr(bulk, "load", lambda *args: loaded.append(args))
+    main_admin.import_document(update, None)
+    assert loaded == []
+    assert status.texts == ["Найдено ошибок: 1, данные не загружены.\nСтрока 3: не заполнено: business_type"]
@@ -0,0 +1,60 @@
+import threading
+
+from catalog import CatalogCache, CatalogEntry
+
+
+class Loader:
+    def __init__(self):
+        self.calls = []
+        self.version = 1
+
+    def __call__(self, business_type: str) -> CatalogEntry:
+        self.calls.append(business_type)
+        return CatalogEntry((f"Вопрос v{self.version}",), f"Промпт v{self.version}")
+
+
+def test_entries_are_cached_until_invalidated():
+    loader = Loader()
+    cache = CatalogCache(loader, ttl=60, max_size=10)
+    assert cache.get("clinic") is cache.get("clinic")
+    assert loader.calls == ["clinic"]
+    loader.version = 2
+    cache.invalidate("clinic")
+    assert cache.get("clinic").prompt == "Промпт v2"
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 2}
+
+
+def test_ttl_and_size_limits():
+    loader = Loader()
+    cache = CatalogCache(loader, ttl=0, max_size=1)
+    cache.get("clinic")
+    cache.get("clinic")
+    assert loader.calls == ["clinic", "clinic"]
+    cache = CatalogCache(loader, ttl=60, max_size=1)
+    cache.get("clinic")
+    cache.get("salon")
+    assert cache.stats()["size"] == 1
+
+
+def test_load_racing_with_invalidation_is_not_cached():
+    started, release = threading.Event(), threading.Event()
+    versions = iter(["устаревший", "новый"])
+
+    def loader(business_type):
+        prompt = next(versions)
+        if prompt == "устаревший":
+            started.set()
+            assert release.wait(5)
+        return CatalogEntry((), prompt)
+
+    cache = CatalogCache(loader, ttl=60, max_size=10)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(cache.get("clinic")))
+    thread.start()
+    assert started.wait(5)
+    # Каталог изменили, пока шла загрузка: её результат отдаётся вызвавшему, но не кэшируется
+    cache.invalidate()
+    release.set()
+    thread.join()
+    assert result[0].prompt == "устаревший"
+    assert cache.get("clinic").prompt == "новый"
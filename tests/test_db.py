@@ -0,0 +1,171 @@
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+from db import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        if self.conn.dead:
+            self.conn.closed = 2  # так psycopg2 отмечает потерянное соединение
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.conn.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.dead = False
+        self.rollbacks = 0
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    @property
+    def info(self):
+        return self
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if self.dead:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.rollbacks += 1
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+# Пул без Postgres: соединения – FakeConnection
+class FakePool(ConnectionPool):
+    def __init__(self, minconn=0, maxconn=2, timeout=0.2, check_idle=60):
+        super().__init__(minconn, maxconn, timeout, check_idle)
+        self.opened = []
+
+    def _connect(self):
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+
+def test_invalid_sizes_are_rejected():
+    with pytest.raises(ValueError):
+        FakePool(minconn=3, maxconn=2)
+
+
+def test_prefill_opens_minimum():
+    pool = FakePool(minconn=2, maxconn=4)
+    pool.prefill()
+    assert len(pool.opened) == 2
+    assert pool.stats()["idle"] == 2
+
+
+def test_idle_connection_is_reused():
+    pool = FakePool()
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second
+    assert len(pool.opened) == 1
+    assert pool.stats()["checkouts"] == 2
+
+
+def test_exhausted_pool_times_out():
+    pool = FakePool(maxconn=1, timeout=0.05)
+    conn = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    pool.putconn(conn)
+    assert pool.stats()["timeouts"] == 1
+    assert pool.getconn() is conn
+
+
+def test_waiter_gets_returned_connection():
+    pool = FakePool(maxconn=1, timeout=2)
+    conn = pool.getconn()
+    threading.Timer(0.05, pool.putconn, (conn,)).start()
+    started = time.monotonic()
+    assert pool.getconn() is conn
+    assert time.monotonic() - started < 1
+
+
+def test_open_transaction_is_rolled_back_on_return():
+    pool = FakePool()
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+    assert conn.rollbacks == 1
+    assert conn.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+def test_connection_error_discards_connection():
+    pool = FakePool()
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+    assert conn.closed
+    assert pool.stats()["size"] == 0
+    with pool.connection() as fresh:
+        assert fresh is not conn
+
+
+def test_dead_idle_connection_is_replaced():
+    pool = FakePool(check_idle=0)
+    with pool.connection() as conn:
+        pass
+    conn.dead = True
+    with pool.connection() as fresh:
+        assert fresh is not conn
+    stats = pool.stats()
+    assert stats["reconnects"] == 1 and stats["discarded"] == 1 and stats["size"] == 1
+
+
+def test_closed_pool_refuses_checkout():
+    pool = FakePool()
+    with pool.connection():
+        pass
+    pool.closeall()
+    assert pool.opened[0].closed
+    with pytest.raises(psycopg2.pool.PoolError):
+        pool.getconn()
+
+
+def test_lost_connection_closes_other_idle_connections():
+    pool = FakePool(maxconn=3)
+    conns = [pool.getconn() for _ in range(3)]
+    for conn in conns:
+        pool.putconn(conn)
+    # Postgres перезапущен: все открытые соединения мертвы, но простаивали недолго и не проверяются
+    for conn in conns:
+        conn.dead = True
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+    assert all(conn.closed for conn in conns)
+    assert pool.stats()["size"] == 0
+    with pool.connection() as fresh:
+        assert fresh not in conns
+
+
+def test_query_error_keeps_other_idle_connections():
+    pool = FakePool(maxconn=2)
+    first, second = pool.getconn(), pool.getconn()
+    pool.putconn(second)
+    pool.putconn(first, broken=True)
+    assert first.closed and not second.closed
+    assert pool.stats()["idle"] == 1
@@ -0,0 +1,186 @@
+import time
+
+import openai
+import pytest
+from openai.util import convert_to_openai_object
+
+import llm
+from llm import LLMClient, ModelRoute, RateLimitTimeout, TokenBucket
+
+MESSAGES = [{"role": "user", "content": "Отзыв"}]
+
+
+def test_bucket_limits_and_refills():
+    bucket = TokenBucket(60, capacity=1)
+    bucket.acquire(1, timeout=0)
+    assert 0.9 < bucket.estimated_wait(1) <= 1.0
+    with pytest.raises(RateLimitTimeout):
+        bucket.acquire(1, timeout=0.1)
+    bucket.release(1)
+    bucket.acquire(1, timeout=0)
+
+
+def test_bucket_waits_within_timeout():
+    bucket = TokenBucket(600, capacity=1)
+    bucket.acquire(1, timeout=0)
+    started = time.monotonic()
+    bucket.acquire(1, timeout=1)
+    assert 0.05 < time.monotonic() - started < 0.5
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(0)
+    for _ in range(100):
+        bucket.acquire(1000, timeout=0)
+    assert bucket.estimated_wait(10 ** 6) == 0.0
+
+
+# Виртуальное время: sleep() и ответы OpenAI только сдвигают часы
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm, "time", clock)
+    return clock
+
+
+# Заглушка ChatCompletion.create: ответы из списка по очереди, аргументы вызовов – в replies.calls
+class Replies(list):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.pop(0)(kwargs)
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    replies = Replies()
+    monkeypatch.setattr(openai.ChatCompletion, "create", replies.create)
+    return replies
+
+
+def answer(text):
+    def reply(kwargs):
+        return convert_to_openai_object({"choices": [{"message": {"content": text}}], "usage": {"total_tokens": 10}})
+    return reply
+
+
+def fail(error, clock=None, spend=0.0):
+    def reply(kwargs):
+        if clock is not None:
+            clock.sleep(spend)
+        raise error
+    return reply
+
+
+def make_client(fallback=True, **kwargs):
+    options = dict(max_retries=2, backoff_base=0.5, backoff_cap=8, request_timeout=60, fallback_wait=1000)
+    options.update(kwargs)
+    return LLMClient(
+        ModelRoute("primary", 0, 0),
+        ModelRoute("fallback", 0, 0) if fallback else None,
+        **options,
+    )
+
+
+def test_first_token_without_streaming_is_full_latency(clock, replies):
+    def slow(kwargs):
+        clock.sleep(3)
+        return answer("Отзыв")(kwargs)
+
+    replies += [slow]
+    client = make_client()
+    # Гистограммы общие для процесса – считаем только наблюдения этого вызова
+    observed = client.primary.stats()["first_token"]["count"]
+    result = client.complete(MESSAGES, 0.7, 100)
+    assert result.first_token == result.latency == 3
+    assert client.primary.stats()["first_token"]["count"] == observed + 1
+
+
+def test_retryable_error_is_retried(clock, replies):
+    replies += [fail(openai.error.ServiceUnavailableError("503")), answer("Отлично ")]
+    result = make_client().complete(MESSAGES, 0.7, 100)
+    assert (result.text, result.model, result.attempts) == ("Отлично", "primary", 2)
+
+
+def test_client_error_is_not_retried(clock, replies):
+    replies += [fail(openai.error.InvalidRequestError("bad", None)), answer("не дойдёт")]
+    with pytest.raises(openai.error.InvalidRequestError):
+        make_client().complete(MESSAGES, 0.7, 100)
+    assert len(replies.calls) == 1
+
+
+def test_fallback_gets_remaining_deadline(clock, replies):
+    replies += [fail(openai.error.Timeout("timeout"), clock, 55), answer("Запасной")]
+    result = make_client(max_retries=0).complete(MESSAGES, 0.7, 100)
+    assert result.model == "fallback"
+    assert [call["model"] for call in replies.calls] == ["primary", "fallback"]
+    assert replies.calls[1]["request_timeout"] == pytest.approx(5)
+
+
+def test_no_fallback_after_deadline(clock, replies):
+    replies += [fail(openai.error.Timeout("timeout"), clock, 61), answer("не дойдёт")]
+    with pytest.raises(openai.error.Timeout):
+        make_client(max_retries=0).complete(MESSAGES, 0.7, 100)
+    assert len(replies.calls) == 1
+
+
+def test_rate_limited_primary_switches_to_fallback(clock, replies):
+    replies += [answer("Запасной")]
+    client = make_client()
+    # Следующий запрос к основной модели – только через 2 минуты, позже срока
+    client.primary.requests = TokenBucket(0.5, capacity=1)
+    client.primary.requests.acquire(1, timeout=0)
+    result = client.complete(MESSAGES, 0.7, 100)
+    assert result.model == "fallback"
+    assert [call["model"] for call in replies.calls] == ["fallback"]
+    assert client.primary.errors == 0
+
+
+def test_backoff_past_deadline_is_not_slept(clock, replies):
+    error = openai.error.RateLimitError("429", headers={"retry-after": "120"})
+    replies += [fail(error), answer("не дойдёт")]
+    started = clock.now
+    with pytest.raises(openai.error.RateLimitError):
+        make_client(fallback=False).complete(MESSAGES, 0.7, 100)
+    assert clock.now == started
+    assert len(replies.calls) == 1
+
+
+def test_slow_stream_is_bounded_by_deadline(clock, replies):
+    def stream(kwargs):
+        assert kwargs["stream"]
+        for word in ("Очень ", "медленный ", "ответ"):
+            clock.sleep(25)
+            yield convert_to_openai_object({"choices": [{"delta": {"content": word}}]})
+
+    replies += [stream]
+    shown = []
+    with pytest.raises(openai.error.Timeout):
+        make_client(fallback=False, max_retries=0).complete(MESSAGES, 0.7, 100, on_delta=shown.append)
+    assert shown == ["Очень ", "Очень медленный "]
+
+
+def test_stream_collects_text(clock, replies):
+    def stream(kwargs):
+        for word in ("Хороший ", "отзыв"):
+            yield convert_to_openai_object({"choices": [{"delta": {"content": word}}]})
+
+    replies += [stream]
+    shown = []
+    result = make_client().complete(MESSAGES, 0.7, 100, on_delta=shown.append)
+    assert result.text == "Хороший отзыв"
+    assert shown == ["Хороший ", "Хороший отзыв"]
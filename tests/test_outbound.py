@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+from outbound import OutboundQueue, SendBudget
+
+
+@pytest.fixture
+def outbound():
+    queue = OutboundQueue(global_per_second=1000, chat_per_second=20, chat_burst=1, workers=2, max_retries=2)
+    yield queue
+    queue.stop()
+
+
+def test_budget_allows_burst_then_rate():
+    budget = SendBudget(per_second=10, burst=2)
+    now = time.monotonic()
+    for _ in range(2):
+        assert budget.delay(now) == 0
+        budget.take()
+    assert budget.delay(now) == pytest.approx(0.1, abs=0.01)
+    assert budget.delay(now + 0.1) == pytest.approx(0, abs=1e-6)
+
+
+def test_messages_to_one_chat_keep_order_and_rate(outbound):
+    sent = []
+    futures = [outbound.submit(1, lambda i=i: sent.append((i, time.monotonic())) or i) for i in range(3)]
+    assert [future.result(5) for future in futures] == [0, 1, 2]
+    assert [i for i, _ in sent] == [0, 1, 2]
+    # Не чаще chat_per_second после исчерпания пачки
+    assert sent[2][1] - sent[0][1] >= 2 / 20 * 0.9
+
+
+def test_chats_do_not_wait_for_each_other(outbound):
+    started = time.monotonic()
+    futures = [outbound.submit(chat_id, lambda: time.monotonic()) for chat_id in range(1, 6)]
+    assert max(future.result(5) for future in futures) - started < 0.5
+
+
+def test_pending_edits_of_one_message_are_collapsed(outbound):
+    release = threading.Event()
+    edits = []
+    blocker = outbound.submit(1, release.wait, (5,))
+    first = outbound.submit(1, edits.append, ("первая",), edit_key=(1, 10, None))
+    second = outbound.submit(1, edits.append, ("вторая",), edit_key=(1, 10, None))
+    release.set()
+    blocker.result(5)
+    first.result(5)
+    second.result(5)
+    assert edits == ["вторая"]
+    assert outbound.stats()["collapsed"] == 1
+
+
+def test_retry_after_is_retried(outbound):
+    attempts = []
+
+    def send():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryAfter(0.05)
+        return "ok"
+
+    assert outbound.submit(1, send).result(5) == "ok"
+    assert attempts[1] - attempts[0] >= 0.045
+    assert outbound.stats()["retries"] == 1
+
+
+def test_errors_reach_the_caller(outbound):
+    def send():
+        raise BadRequest("Message to edit not found")
+
+    with pytest.raises(BadRequest):
+        outbound.submit(1, send).result(5)
+    assert outbound.stats()["failed"] == 1
+
+    def throttled():
+        raise RetryAfter(0.01)
+
+    with pytest.raises(RetryAfter):
+        outbound.submit(2, throttled).result(5)
+
+
+def test_stop_sends_what_is_queued():
+    outbound = OutboundQueue(global_per_second=1000, chat_per_second=50, chat_burst=1, workers=1)
+    futures = [outbound.submit(1, lambda i=i: i) for i in range(5)]
+    outbound.stop()
+    assert [future.result(0) for future in futures] == list(range(5))
+    with pytest.raises(RuntimeError):
+        outbound.submit(1, lambda: None)
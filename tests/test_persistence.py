@@ -0,0 +1,253 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from queue import Queue
+
+import pytest
+from telegram import Bot, Update, User
+from telegram.ext import ConversationHandler, Dispatcher, Filters, MessageHandler
+from telegram.ext.utils.promise import Promise
+
+import persistence as persistence_module
+from persistence import CONVERSATION, USER, PostgresPersistence
+from serving import UserJobQueue, persist_user_data
+
+BOT = Bot("123:test")
+BOT._bot = User(123, "Test", is_bot=True, username="test_bot")  # без запроса getMe
+
+
+# PostgresPersistence без БД: строки для загрузки задаются заранее, запись в БД отключена
+class MemoryPersistence(PostgresPersistence):
+    def __init__(self, rows=(), **kwargs):
+        self.rows = list(rows)
+        self.written = []
+        self.fail = False
+        self.expired = []
+        super().__init__("test", flush_interval=3600, **kwargs)
+
+    def _ensure_schema(self):
+        pass
+
+    def _load(self, kind_clause: str, params: tuple):
+        return [row for row in self.rows if row[0] == params[0]]
+
+    def _upsert(self, rows: list) -> list:
+        if self.fail:
+            raise ConnectionError("БД недоступна")
+        self.written.extend(rows)
+        return [(kind, key, 2) for namespace, kind, key, user_id, payload, writer in rows]
+
+    def _delete_expired(self) -> list:
+        expired, self.expired = self.expired, []
+        return expired
+
+    def pending(self, kind: str, key: str):
+        user_id, payload = self._dirty[(kind, key)]
+        return json.loads(payload)
+
+
+@pytest.fixture
+def persistence():
+    persistence = MemoryPersistence()
+    yield persistence
+    persistence._stopped.set()
+    persistence._wakeup.set()
+
+
+def message(update_id: int, user_id: int, text: str) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }, BOT)
+
+
+def test_run_async_conversation_is_persisted(persistence):
+    release = threading.Event()
+
+    def step(next_state):
+        def callback(update, context):
+            assert release.wait(5)
+            context.user_data["step"] = next_state
+            return next_state
+        return callback
+
+    conversation = ConversationHandler(
+        entry_points=[MessageHandler(Filters.regex("^go$"), step(1), run_async=True)],
+        states={1: [MessageHandler(Filters.text, step(2), run_async=True)], 2: []},
+        fallbacks=[],
+        name="survey",
+        persistent=True,
+    )
+    dispatcher = Dispatcher(BOT, Queue(), workers=2, persistence=persistence)
+    dispatcher.add_handler(conversation)
+    # Пул потоков для run_async запускается вместе с диспетчером
+    threading.Thread(target=dispatcher.start, daemon=True).start()
+    while not dispatcher.running:
+        time.sleep(0.01)
+    key, row_key = (42, 42), json.dumps([42, 42])
+    try:
+        for update_id, text, before, after in ((1, "go", None, 1), (2, "next", 1, 2)):
+            dispatcher.process_update(message(update_id, 42, text))
+            pending = conversation.conversations[key]
+            assert isinstance(pending, tuple) and isinstance(pending[1], Promise)
+            # Пока обработчик выполняется, сохранено прежнее состояние
+            assert persistence.pending(CONVERSATION + "survey", row_key) == before
+            release.set()
+            assert pending[1].done.wait(5)
+            release.clear()
+            assert persistence.pending(CONVERSATION + "survey", row_key) == after
+    finally:
+        release.set()
+        dispatcher.stop()
+    assert persistence.pending(CONVERSATION + "survey", row_key) == 2
+
+
+def test_nested_promise_state_is_unwrapped(persistence):
+    first, second = Promise(lambda: 1, (), {}), Promise(lambda: None, (), {})
+    persistence.update_conversation("survey", (7, 7), (((3, first), first), second))
+    assert persistence.pending(CONVERSATION + "survey", json.dumps([7, 7])) == 3
+    second.run()
+    # Обработчик вернул None – состояние не меняется
+    assert persistence.pending(CONVERSATION + "survey", json.dumps([7, 7])) == 3
+
+
+def test_unchanged_user_data_is_not_rewritten():
+    persistence = MemoryPersistence([(USER, "1", {"answers": ["a"], "step": 1}, 1), (USER, "2", {"step": 1}, 1)])
+    try:
+        user_data = persistence.get_user_data()
+        # Полный проход update_persistence() передаёт всех пользователей – пишется только изменённый
+        user_data[2]["step"] = 2
+        for user_id, data in user_data.items():
+            persistence.update_user_data(user_id, data)
+        persistence._write()
+        assert [(row[2], json.loads(row[4])) for row in persistence.written] == [("2", {"step": 2})]
+
+        for user_id, data in user_data.items():
+            persistence.update_user_data(user_id, data)
+        assert persistence.stats()["pending"] == 0
+    finally:
+        persistence.flush()
+
+
+def test_user_data_is_not_copied():
+    persistence = MemoryPersistence([(USER, "1", {"answers": ["a"]}, 1)])
+    try:
+        user_data = persistence.get_user_data()
+        assert user_data is persistence._user_data
+        assert persistence.replace_bot(user_data[1]) is user_data[1]
+    finally:
+        persistence.flush()
+
+
+def test_job_persists_only_its_user():
+    persistence = MemoryPersistence([(USER, "1", {"step": 1}, 1), (USER, "2", {"step": 1}, 1)])
+    job_queue = UserJobQueue()
+    dispatcher = Dispatcher(BOT, Queue(), job_queue=job_queue, persistence=persistence)
+    job_queue.set_dispatcher(dispatcher)
+    done = threading.Event()
+
+    def deliver(context):
+        context.dispatcher.user_data[1]["step"] = 2
+        persist_user_data(context, 1)
+        done.set()
+
+    # Изменённые вне задачи данные пользователя 2 задача не сохраняет
+    dispatcher.user_data[2]["step"] = 3
+    job_queue.start()
+    try:
+        job_queue.run_once(deliver, 0)
+        assert done.wait(5)
+        time.sleep(0.1)
+        assert list(persistence._dirty) == [(USER, "1")]
+    finally:
+        job_queue.stop()
+        persistence._stopped.set()
+        persistence._wakeup.set()
+
+
+def test_expired_rows_are_pruned():
+    rows = [(USER, "1", {"step": 1}, 1), (USER, "2", {"step": 1}, 1), (CONVERSATION + "survey", "[1, 1]", 3, 1)]
+    persistence = MemoryPersistence(rows, ttl=3600)
+    try:
+        user_data = persistence.get_user_data()
+        conversations = persistence.get_conversations("survey")
+        persistence.expired = [(USER, "1"), (CONVERSATION + "survey", "[1, 1]")]
+        persistence._prune()
+        assert list(user_data) == [2] and conversations == {}
+        assert persistence.stats()["rows_pruned"] == 2
+        # Пользователь вернулся с теми же данными – запись создаётся заново
+        persistence.update_user_data(1, {"step": 1})
+        assert persistence.pending(USER, "1") == {"step": 1}
+    finally:
+        persistence._stopped.set()
+        persistence._wakeup.set()
+
+
+def test_failed_write_is_retried():
+    persistence = MemoryPersistence()
+    try:
+        persistence.update_user_data(1, {"step": 1})
+        persistence.fail = True
+        with pytest.raises(ConnectionError):
+            persistence._write()
+        # Те же данные после неудачной записи снова в очереди
+        persistence.update_user_data(1, {"step": 1})
+        persistence.fail = False
+        persistence._write()
+        assert [json.loads(row[4]) for row in persistence.written] == [{"step": 1}]
+    finally:
+        persistence.flush()
+
+
+class RecordingCursor:
+    def __init__(self, queries: list):
+        self.queries = queries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def fetchall(self):
+        return []
+
+
+def test_shard_loads_and_writes_only_its_users(monkeypatch):
+    queries = []
+
+    @contextmanager
+    def connection():
+        class Connection:
+            def cursor(self):
+                return RecordingCursor(queries)
+
+            def commit(self):
+                pass
+        yield Connection()
+
+    monkeypatch.setattr(persistence_module, "connection", connection)
+    persistence = PostgresPersistence("test", flush_interval=3600, shard=(1, 3))
+    try:
+        persistence.get_user_data()
+        query, params = queries[-1]
+        assert query.endswith("kind = %s AND user_id %% %s = %s")
+        assert params == ("test", USER, 3, 1)
+
+        persistence.update_user_data(4, {"step": 1})
+        persistence.update_user_data(5, {"step": 1})
+        persistence.update_conversation("survey", (5, 5), 1)
+        assert list(persistence._dirty) == [(USER, "4")]
+    finally:
+        persistence._stopped.set()
+        persistence._wakeup.set()
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+from review_cache import ReviewCache, make_key, normalize
+
+
+def test_normalize_ignores_case_punctuation_and_spaces():
+    assert normalize("  Всё   ОТЛИЧНО!!! ") == normalize("все отлично")
+
+
+def test_key_depends_on_answers_and_model():
+    key = make_key("clinic", "Промпт ", ["Всё отлично!"], "gpt-4", 0.7)
+    assert key == make_key("clinic", "Промпт", ["все отлично"], "gpt-4", 0.7)
+    assert key != make_key("clinic", "Промпт", ["все отлично"], "gpt-3.5-turbo", 0.7)
+    assert key != make_key("clinic", "Промпт", ["все плохо"], "gpt-4", 0.7)
+
+
+def test_variants_are_generated_then_reused():
+    cache = ReviewCache(variants=2)
+    texts = iter(["первый", "второй", "третий"])
+    results = [cache.get_or_generate("k", lambda: next(texts)) for _ in range(4)]
+    assert [status for _, status in results] == ["generated", "generated", "hit", "hit"]
+    assert {text for text, _ in results[2:]} <= {"первый", "второй"}
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+
+def test_concurrent_requests_are_merged():
+    cache = ReviewCache(variants=1)
+    release = threading.Event()
+    calls = []
+
+    def generate():
+        calls.append(1)
+        assert release.wait(5)
+        return "отзыв"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_generate("k", generate))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while cache.stats()["merged"] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(status for _, status in results) == ["generated", "merged", "merged"]
+    assert {text for text, _ in results} == {"отзыв"}
+
+
+def test_error_reaches_merged_requests_and_is_not_cached():
+    cache = ReviewCache(variants=1)
+    release = threading.Event()
+
+    def generate():
+        assert release.wait(5)
+        raise RuntimeError("OpenAI недоступен")
+
+    errors = []
+
+    def request():
+        try:
+            cache.get_or_generate("k", generate)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=request) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while cache.stats()["merged"] < 1:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2
+    assert cache.get_or_generate("k", lambda: "отзыв") == ("отзыв", "generated")
+
+
+def test_store_false_skips_caching():
+    cache = ReviewCache(variants=1)
+    assert cache.get_or_generate("k", lambda: "запасная модель", store=lambda: False)[1] == "generated"
+    assert cache.stats()["keys"] == 0
+    assert cache.get_or_generate("k", lambda: "основная модель") == ("основная модель", "generated")
+    assert cache.get_or_generate("k", lambda: "не нужен") == ("основная модель", "hit")
+
+
+def test_entries_expire_and_are_evicted():
+    cache = ReviewCache(max_keys=2, ttl=0.05, variants=1)
+    for key in ("a", "b", "c"):
+        cache.get_or_generate(key, lambda: key)
+    assert cache.stats()["keys"] == 2
+    assert cache.get_or_generate("a", lambda: "снова")[1] == "generated"
+    time.sleep(0.06)
+    assert cache.get_or_generate("c", lambda: "новый") == ("новый", "generated")
+    assert cache.stats()["evictions"] >= 2
+
+
+@pytest.mark.parametrize("variants", [1, 3])
+def test_stats_hit_rate(variants):
+    cache = ReviewCache(variants=variants)
+    texts = iter(range(variants))
+    for _ in range(variants + 1):
+        cache.get_or_generate("k", lambda: str(next(texts)))
+    assert cache.stats()["hit_rate"] == round(1 / (variants + 1), 3)
@@ -0,0 +1,79 @@
+import threading
+
+from review_jobs import ReviewJob, ReviewPipeline
+
+
+# job_queue без планировщика: доставка результатов в тесте не нужна
+class NullJobQueue:
+    def run_once(self, callback, when, context=None):
+        pass
+
+
+def make_pipeline(generate, max_pending=1, workers=4):
+    return ReviewPipeline(generate, on_success=None, on_error=None, workers=workers, max_pending=max_pending)
+
+
+def make_job(chat_id: int) -> ReviewJob:
+    return ReviewJob(chat_id, 1, {}, "prompt", bot=None)
+
+
+def blocking_generate():
+    started, release = threading.Event(), threading.Event()
+
+    def generate(job):
+        started.set()
+        assert release.wait(5)
+        return "Отзыв"
+    return generate, started, release
+
+
+def test_cancelled_running_job_keeps_its_slot():
+    generate, started, release = blocking_generate()
+    pipeline, job_queue = make_pipeline(generate), NullJobQueue()
+    try:
+        first = pipeline.submit(job_queue, make_job(1))
+        assert started.wait(5)
+        assert pipeline.cancel(1)
+        # Отменённый запрос ещё выполняется – новое задание не помещается в лимит
+        assert pipeline.submit(job_queue, make_job(2)) is None
+        release.set()
+        first.future.result(5)
+        assert pipeline.submit(job_queue, make_job(2)) is not None
+        assert pipeline.stats()["rejected"] == 1
+    finally:
+        release.set()
+        pipeline.shutdown()
+
+
+def test_resubmit_from_same_chat_respects_limit():
+    generate, started, release = blocking_generate()
+    pipeline, job_queue = make_pipeline(generate), NullJobQueue()
+    try:
+        first = pipeline.submit(job_queue, make_job(1))
+        assert started.wait(5)
+        # Повтор из того же чата отменяет выполняющееся задание, но не обходит лимит
+        assert pipeline.submit(job_queue, make_job(1)) is None
+        assert first.cancelled
+        release.set()
+        first.future.result(5)
+        assert pipeline.stats()["inflight"] == 0
+    finally:
+        release.set()
+        pipeline.shutdown()
+
+
+def test_cancelled_queued_job_frees_its_slot():
+    generate, started, release = blocking_generate()
+    pipeline, job_queue = make_pipeline(generate, max_pending=2, workers=1), NullJobQueue()
+    try:
+        pipeline.submit(job_queue, make_job(1))
+        assert started.wait(5)
+        queued = pipeline.submit(job_queue, make_job(2))
+        assert queued is not None and queued.started is None
+        # Задание ещё не начато – отмена сразу освобождает место
+        assert pipeline.submit(job_queue, make_job(2)) is not None
+        assert queued.future.cancelled()
+        assert pipeline.stats()["inflight"] == 2
+    finally:
+        release.set()
+        pipeline.shutdown()
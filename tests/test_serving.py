@@ -0,0 +1,76 @@
+import queue
+from types import SimpleNamespace
+
+from telegram import Bot, Update, User
+
+from serving import WaitingRequeue, drain
+
+BOT = Bot("123:test")
+BOT._bot = User(123, "Test", is_bot=True, username="test_bot")
+
+
+def message(update_id: int, user_id: int) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "text": "ещё",
+        },
+    }, BOT)
+
+
+# Контекст обработчика без job_queue: возврат обновления не должен через него проходить
+def make_context(update_queue):
+    return SimpleNamespace(dispatcher=SimpleNamespace(update_queue=update_queue), job_queue=None)
+
+
+def test_update_is_returned_to_queue():
+    update_queue = queue.Queue()
+    requeue = WaitingRequeue(delay=0.01, attempts=2)
+    update = message(1, 42)
+    requeue._requeue(update, make_context(update_queue))
+    assert update_queue.get(timeout=5) is update
+    requeue._requeue(update, make_context(update_queue))
+    assert update_queue.get(timeout=5) is update
+    # Попытки исчерпаны
+    requeue._requeue(update, make_context(update_queue))
+    assert requeue.stats() == {"requeued": 2, "dropped": 1, "delayed": 0}
+
+
+def test_waiting_updates_are_capped_per_user():
+    update_queue = queue.Queue()
+    requeue = WaitingRequeue(delay=0.2, attempts=10, per_user=2)
+    context = make_context(update_queue)
+    for update_id in (1, 2, 3):
+        requeue._requeue(message(update_id, 42), context)
+    requeue._requeue(message(4, 7), context)
+    assert requeue.stats()["dropped"] == 1
+    returned = sorted(update_queue.get(timeout=5).update_id for _ in range(3))
+    assert returned == [1, 2, 4]
+    # Обновления вернулись в очередь – место для новых освободилось
+    requeue._requeue(message(5, 42), context)
+    assert update_queue.get(timeout=5).update_id == 5
+
+
+
+# Очередь, которую drain застаёт ещё не разобранной: запоминает, шёл ли в этот момент поллинг
+class ObservedQueue(queue.Queue):
+    def __init__(self, updater):
+        super().__init__()
+        self.updater = updater
+        self.polling = []
+
+    def empty(self):
+        self.polling.append(self.updater.running)
+        return super().empty()
+
+
+def test_drain_stops_polling_before_waiting():
+    updater = SimpleNamespace(httpd=None, running=True, bot=None)
+    updater.update_queue = ObservedQueue(updater)
+    updater.stop = lambda: updater.update_queue.polling.append("stopped")
+    drain(updater, timeout=5)
+    assert updater.update_queue.polling == [False, "stopped"]
@@ -0,0 +1,48 @@
+import multiprocessing
+import queue
+import time
+
+import pytest
+
+from sharding import ShardChannel
+
+
+@pytest.fixture
+def channel():
+    return ShardChannel(multiprocessing.get_context("spawn"), maxsize=3)
+
+
+def receive(channel, count: int) -> list:
+    items = []
+    for _ in range(count):
+        assert channel.reader.poll(5)
+        items.append(channel.reader.recv())
+    return items
+
+
+def test_items_are_sent_in_order(channel):
+    for i in range(3):
+        channel.put({"update_id": i})
+    assert receive(channel, 3) == [{"update_id": i} for i in range(3)]
+    assert channel.depth() == 0
+
+
+def test_put_times_out_when_full(channel):
+    # Отправитель не может передать больше, чем вмещает pipe, – заполняем очередь крупными элементами
+    payload = "x" * (1 << 20)
+    with pytest.raises(queue.Full):
+        for _ in range(20):
+            channel.put(payload, timeout=0.1)
+
+
+def test_reset_returns_unread_items_to_the_front(channel):
+    for i in range(3):
+        channel.put(i)
+    while channel.depth():
+        time.sleep(0.01)
+    old_reader = channel.reader
+    # Воркер упал, не прочитав pipe: непрочитанное переходит в новый pipe раньше новых обновлений
+    assert channel.reset() == 3
+    assert channel.reader is not old_reader
+    channel.put(3)
+    assert receive(channel, 4) == [0, 1, 2, 3]
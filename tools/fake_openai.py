@@ -0,0 +1,149 @@
+# Локальный сервер, имитирующий Chat Completions API OpenAI (обычный и потоковый режим).
+# Нужен для проверки llm.py и нагрузочных тестов без обращения к OpenAI:
+#     python -m tools.fake_openai --port 8899 --latency-ms 1500 --error-rate 0.1
+#     OPENAI_API_BASE=http://127.0.0.1:8899/v1 python main_client.py
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_REVIEW = (
+    "Отличная клиника! Врачи внимательные, всё подробно объяснили, "
+    "в регистратуре вежливый персонал. Обязательно приду ещё и порекомендую знакомым."
+)
+
+
+class FakeOpenAI:
+    def __init__(self, port: int = 0, latency: float = 1.0, first_token: float = 0.3, error_rate: float = 0.0,
+                 error_status: int = 429, retry_after: float = None, text: str = SAMPLE_REVIEW):
+        self.latency = latency
+        self.first_token = first_token
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.text = text
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.models = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело уходят отдельными send(): без TCP_NODELAY ответ ждёт delayed ACK (~40 мс)
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, status: int, body: dict, headers=None):
+                data = json.dumps(body, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    self._json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+                    return
+                model = body.get("model", "fake")
+                with fake._lock:
+                    fake.requests += 1
+                    fake.models[model] = fake.models.get(model, 0) + 1
+                    failed = random.random() < fake.error_rate
+                    fake.errors += failed
+                if failed:
+                    headers = {"Retry-After": str(fake.retry_after)} if fake.retry_after is not None else None
+                    self._json(fake.error_status, {"error": {"message": "fake error", "type": "rate_limit_error"}}, headers)
+                    return
+                if body.get("stream"):
+                    self._stream(model)
+                else:
+                    time.sleep(fake.latency)
+                    self._json(200, {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": fake.text}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": 100, "completion_tokens": len(fake.text) // 3, "total_tokens": 100 + len(fake.text) // 3},
+                    })
+
+            def _stream(self, model: str):
+                words = fake.text.split(" ")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(fake.first_token)
+                pause = max(0.0, fake.latency - fake.first_token) / max(1, len(words))
+                for i, word in enumerate(words):
+                    chunk = {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+                    }
+                    self._chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+                    time.sleep(pause)
+                self._chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chunk(self, text: str):
+                data = text.encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors, "models": dict(self.models)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Имитация OpenAI Chat Completions API")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--latency-ms", type=float, default=1000, help="полное время ответа")
+    parser.add_argument("--first-token-ms", type=float, default=300, help="задержка первого токена (stream)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов с ошибкой")
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--retry-after", type=float, help="значение заголовка Retry-After в ошибках")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(args.port, args.latency_ms / 1000, args.first_token_ms / 1000, args.error_rate,
+                      args.error_status, args.retry_after)
+    print(f"Fake OpenAI: {fake.api_base}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(fake.stats())
+
+
+if __name__ == "__main__":
+    main()
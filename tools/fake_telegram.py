@@ -0,0 +1,169 @@
+# Локальный сервер, имитирующий Bot API Telegram: принимает sendMessage, editMessageText,
+# answerCallbackQuery, sendDocument и т.п. и отвечает правдоподобными объектами Message.
+# Нужен для нагрузочных тестов без обращения к Telegram:
+#     python -m tools.fake_telegram --port 8898 --latency-ms 30
+#     TELEGRAM_API_URL=http://127.0.0.1:8898/bot python main_client.py
+# Каждый вызов с chat_id попадает во «входящие» этого чата (inbox) – так синтетические
+# пользователи tools/loadtest.py узнают об ответе бота.
+import argparse
+import email
+import itertools
+import json
+import queue
+import threading
+import time
+import urllib.parse
+from collections import Counter, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Вызов Bot API, адресованный чату
+Call = namedtuple("Call", ["method", "chat_id", "message_id", "text", "reply_markup", "at"])
+
+# Методы, которые не попадают во входящие чата
+SILENT_METHODS = {"answercallbackquery", "getme", "getupdates", "deletewebhook", "setwebhook", "getwebhookinfo"}
+
+
+def _parse_body(content_type: str, body: bytes) -> dict:
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("multipart/form-data"):
+        message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        fields = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is None:
+                fields[name] = part.get_payload(decode=True).decode()
+            else:
+                fields[name] = part.get_filename()
+        return fields
+    return {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+
+
+class FakeTelegram:
+    # record=False – не копить входящие (когда их никто не читает)
+    def __init__(self, port: int = 0, latency: float = 0.0, bot_id: int = 123456, username: str = "fake_bot",
+                 record: bool = True):
+        self.latency = latency
+        self.record = record
+        self.bot_user = {"id": bot_id, "is_bot": True, "first_name": "Fake", "username": username}
+        self._lock = threading.Lock()
+        self._inboxes = {}
+        self._message_ids = itertools.count(1)
+        self.calls = Counter()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    # Адрес для ExtBot(base_url=...) / TELEGRAM_API_URL
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot"
+
+    # Очередь вызовов Call, адресованных чату
+    def inbox(self, chat_id: int) -> queue.Queue:
+        with self._lock:
+            inbox = self._inboxes.get(chat_id)
+            if inbox is None:
+                inbox = self._inboxes[chat_id] = queue.Queue()
+            return inbox
+
+    def _message(self, chat_id: int, message_id: int, text: str) -> dict:
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": self.bot_user,
+            "text": text or "",
+        }
+
+    def call(self, method: str, params: dict):
+        name = method.lower()
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if name == "getme":
+            return self.bot_user
+        if name in SILENT_METHODS:
+            return True
+        chat_id = params.get("chat_id")
+        if chat_id is None:
+            # Правка inline-сообщения – адресата нет
+            return True
+        chat_id = int(chat_id)
+        if name.startswith("edit"):
+            message_id = int(params.get("message_id", 0))
+        else:
+            message_id = next(self._message_ids)
+        text = params.get("text") or params.get("caption")
+        reply_markup = params.get("reply_markup")
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        if self.record:
+            self.inbox(chat_id).put(Call(method, chat_id, message_id, text, reply_markup, time.monotonic()))
+        return self._message(chat_id, message_id, text)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело уходят отдельными send(): без TCP_NODELAY ответ ждёт delayed ACK (~40 мс)
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, status: int, body: dict):
+                data = json.dumps(body, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                # Путь: /bot<token>/<method>
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                try:
+                    params = _parse_body(self.headers.get("Content-Type", ""), body)
+                    result = fake.call(method, params)
+                except Exception as e:
+                    self._json(400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"})
+                    return
+                self._json(200, {"ok": True, "result": result})
+
+            do_GET = do_POST
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": dict(self.calls), "chats": len(self._inboxes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Имитация Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8898)
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка ответа на каждый вызов")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.port, args.latency_ms / 1000, record=False)
+    print(f"Fake Telegram: {fake.base_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(fake.stats())
+
+
+if __name__ == "__main__":
+    main()
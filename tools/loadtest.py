@@ -0,0 +1,442 @@
+# Сквозной нагрузочный стенд клиентского бота: тысячи синтетических пользователей проходят
+# настоящий ConversationHandler из main_client.py (/start, ответы, «Далее», генерация отзыва,
+# «Отправить в WhatsApp») против локальных заменителей Telegram (tools/fake_telegram.py),
+# OpenAI (tools/fake_openai.py) и Postgres (tools/standin_db.py или настоящая база).
+#
+#     python -m tools.loadtest --users 2000 --concurrency 200 --llm-latency-ms 1500
+#     python -m tools.loadtest --users 500 --no-limits --json report.json --check-p95-ms 500
+#     DB_HOST=... DB_NAME=bot_test python -m tools.loadtest --postgres --users 1000
+#
+# С --postgres стенд пишет в базу из DB_* и удаляет за собой только свои строки: пользователей
+# из своего диапазона ID и строки со своим business_type (loadtest_<номер запуска>). База должна
+# быть тестовой (test в DB_NAME), иначе нужен явный --allow-destructive; если пользователи
+# с ID из диапазона уже есть, стенд не запускается.
+#
+# Отчёт: p50/p95/p99 по каждому шагу анкеты (от отправки обновления до ответа бота в Bot API;
+# review – от нажатия «Далее» на последнем вопросе до готового отзыва),
+# пропускная способность, исходы анкет, пиковые значения пула соединений БД.
+# По умолчанию действуют те же лимиты, что и в продакшене (очередь исходящих, лимиты OpenAI,
+# REVIEW_MAX_PENDING); --no-limits снимает лимиты Telegram и OpenAI, чтобы мерить сам горячий путь.
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+
+from tools.fake_openai import FakeOpenAI
+from tools.fake_telegram import FakeTelegram
+
+FAKE_TOKEN = "123456:loadtest"
+# Метка строк этого запуска: по ней удаляется только то, что стенд создал сам
+BUSINESS_TYPE = f"loadtest_{uuid.uuid4().hex[:12]}"
+QUESTIONS = [
+    "Как вас встретили в регистратуре?",
+    "Насколько внимателен был врач?",
+    "Понравилось ли вам в клинике?",
+    "Порекомендуете ли вы нас знакомым?",
+]
+PROMPT = "Составь короткий доброжелательный отзыв от первого лица."
+FIRST_USER_ID = 10_000_000
+
+STEPS = ("start", "start_survey", "answer", "next_question", "review", "send_whatsapp")
+# Ответы бота, после которых анкета считается прерванной
+FAIL_TEXTS = ("Вы не авторизованы", "Ошибка", "Сервис перегружен", "Не удалось", "Неизвестная команда", "Диалог отменен")
+
+
+class StepFailed(Exception):
+    def __init__(self, step: str, reason: str):
+        super().__init__(f"{step}: {reason}")
+        self.step = step
+        self.reason = reason
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Синтетические пользователи: отправляют обновления в очередь диспетчера и ждут ответа бота
+# во входящих своего чата на fake Bot API
+class Harness:
+    def __init__(self, bot, update_queue, telegram: FakeTelegram,
+                 step_timeout: float, think: float, repeat_answers: bool):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.telegram = telegram
+        self.step_timeout = step_timeout
+        self.think = think
+        self.repeat_answers = repeat_answers
+        self._lock = threading.Lock()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.latencies = {step: [] for step in STEPS}
+        self.outcomes = Counter()
+        self.updates = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+            },
+        }
+
+    # Нажатие кнопки под сообщением бота message_id
+    def callback(self, user_id: int, message_id: int, data: str) -> dict:
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": self.telegram.bot_user,
+                    "text": "",
+                },
+            },
+        }
+
+    # Отправляет обновление (если есть) и ждёт вызова Bot API, текст которого начинается с expect
+    # (expect=None – любой ответ, кроме ошибки)
+    def step(self, name: str, user_id: int, payload, expect, started: float = None):
+        inbox = self.telegram.inbox(user_id)
+        if started is None:
+            started = time.monotonic()
+        if payload is not None:
+            self.update_queue.put(Update.de_json(payload, self.bot))
+            with self._lock:
+                self.updates += 1
+        deadline = started + self.step_timeout
+        while True:
+            try:
+                call = inbox.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise StepFailed(name, "timeout")
+            text = call.text or ""
+            if text.startswith(FAIL_TEXTS):
+                raise StepFailed(name, text.splitlines()[0])
+            if expect is None or text.startswith(expect):
+                break
+            # Промежуточные правки (потоковый вывод, «ещё формирую») пропускаем
+        self.record(name, call.at - started)
+        if self.think:
+            time.sleep(self.think)
+        return call
+
+    def record(self, name: str, latency: float):
+        with self._lock:
+            self.latencies[name].append(latency)
+
+    def answers(self, user_id: int, count: int):
+        if self.repeat_answers:
+            return [f"Ответ на вопрос {i + 1}: всё понравилось" for i in range(count)]
+        return [f"Ответ на вопрос {i + 1} от пользователя {user_id}" for i in range(count)]
+
+    def run_user(self, user_id: int) -> str:
+        try:
+            menu = self.step("start", user_id, self.message(user_id, "/start"), "Добро пожаловать")
+            self.step("start_survey", user_id, self.callback(user_id, menu.message_id, "start_survey"), "📝 Вопрос")
+            answers = self.answers(user_id, len(QUESTIONS))
+            for i, answer in enumerate(answers):
+                reply = self.step("answer", user_id, self.message(user_id, answer), "Ответ:")
+                last = i == len(answers) - 1
+                clicked = time.monotonic()
+                # После последнего вопроса очередь исходящих может схлопнуть «Формирую отзыв»
+                # с последующими правками того же сообщения – годится любой ответ
+                call = self.step("next_question", user_id, self.callback(user_id, reply.message_id, "next_question"),
+                                 None if last else "📝 Вопрос", started=clicked)
+            # Шаг review – от нажатия «Далее» на последнем вопросе до готового отзыва
+            if call.text.startswith("🎉"):
+                review = call
+                self.record("review", call.at - clicked)
+            else:
+                review = self.step("review", user_id, None, "🎉 Отзыв сформирован", started=clicked)
+            self.step("send_whatsapp", user_id, self.callback(user_id, review.message_id, "send_whatsapp"),
+                      "Отправьте отзыв через WhatsApp")
+            outcome = "completed"
+        except StepFailed as e:
+            outcome = f"failed at {e.step}: {e.reason}"
+        with self._lock:
+            self.outcomes[outcome] += 1
+        return outcome
+
+
+# Пиковые значения статистики пула соединений за время прогона
+class PoolSampler:
+    def __init__(self, stats, interval: float = 0.05):
+        self._stats = stats
+        self.interval = interval
+        self.peak = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="pool-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            stats = self._stats()
+            for key in ("size", "in_use", "waiters"):
+                self.peak[key] = max(self.peak[key], stats.get(key, 0))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+# Переменные окружения читаются config.py при импорте – задаём их до импорта модулей бота
+def configure(args, telegram: FakeTelegram, openai_fake: FakeOpenAI):
+    os.environ["TELEGRAM_CLIENT_TOKEN"] = FAKE_TOKEN
+    os.environ["TELEGRAM_API_URL"] = telegram.base_url
+    os.environ["OPENAI_API_BASE"] = openai_fake.api_base
+    os.environ["OPENAI_API_KEY"] = "loadtest"
+    os.environ["BOT_MODE"] = "polling"
+    if not args.postgres:
+        # Встроенная замена БД не поддерживает таблицу bot_persistence
+        os.environ["PERSISTENCE_ENABLED"] = "0"
+    if args.no_limits:
+        for name, value in (
+            ("OUTBOUND_GLOBAL_PER_SECOND", "100000"),
+            ("OUTBOUND_CHAT_PER_SECOND", "1000"),
+            ("OUTBOUND_CHAT_BURST", "1000"),
+            ("OPENAI_RPM", "0"),
+            ("OPENAI_TPM", "0"),
+            ("REVIEW_MAX_PENDING", str(args.users)),
+        ):
+            os.environ.setdefault(name, value)
+
+
+# --postgres без --allow-destructive – только в базе, которая по имени явно тестовая
+def check_target_db(args):
+    name = os.environ.get("DB_NAME") or ""
+    if args.postgres and not args.allow_destructive and "test" not in name.lower():
+        sys.exit(f"База «{name}» не похожа на тестовую (нет test в DB_NAME). "
+                 "Стенд создаёт и удаляет в ней строки; чтобы всё же запустить его, укажите --allow-destructive")
+
+
+def seed_postgres(connection, user_ids):
+    from psycopg2.extras import execute_values
+
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*), min(telegram_id) FROM users WHERE telegram_id BETWEEN %s AND %s",
+                        (user_ids[0], user_ids[-1]))
+            existing, first = cur.fetchone()
+            if existing:
+                conn.rollback()
+                sys.exit(f"В users уже есть {existing} пользователей из диапазона стенда (например, {first}); "
+                         "выберите другой диапазон через --first-user-id")
+            execute_values(cur, "INSERT INTO users (telegram_id, business_type) VALUES %s",
+                           [(user_id, BUSINESS_TYPE) for user_id in user_ids], page_size=1000)
+            execute_values(cur, "INSERT INTO questions (business_type, question_text) VALUES %s",
+                           [(BUSINESS_TYPE, q) for q in QUESTIONS])
+            cur.execute("INSERT INTO prompts (business_type, prompt_text) VALUES (%s, %s)", (BUSINESS_TYPE, PROMPT))
+        conn.commit()
+
+
+# Удаляются только строки с меткой этого запуска
+def cleanup_postgres(connection, user_ids, persistence: bool, analytics: bool):
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM users WHERE telegram_id BETWEEN %s AND %s AND business_type = %s",
+                        (user_ids[0], user_ids[-1], BUSINESS_TYPE))
+            cur.execute("DELETE FROM questions WHERE business_type = %s", (BUSINESS_TYPE,))
+            cur.execute("DELETE FROM prompts WHERE business_type = %s", (BUSINESS_TYPE,))
+            if persistence:
+                cur.execute("DELETE FROM bot_persistence WHERE namespace = %s", (BUSINESS_TYPE,))
+            if analytics:
+                cur.execute("DELETE FROM survey_results WHERE business_type = %s", (BUSINESS_TYPE,))
+        conn.commit()
+
+
+def report(args, harness: Harness, elapsed: float, extra: dict) -> dict:
+    steps = {}
+    for name in STEPS:
+        values = harness.latencies[name]
+        steps[name] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+            "max_ms": round(max(values) * 1000, 1) if values else 0.0,
+        }
+    completed = harness.outcomes.get("completed", 0)
+    result = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 2),
+        "surveys_per_s": round(completed / elapsed, 2) if elapsed else 0.0,
+        "updates_per_s": round(harness.updates / elapsed, 1) if elapsed else 0.0,
+        "outcomes": dict(harness.outcomes),
+        "steps": steps,
+    }
+    result.update(extra)
+
+    print(f"Пользователей: {args.users}, одновременно: {args.concurrency}, время: {elapsed:.1f} с")
+    print(f"Пропускная способность: {result['surveys_per_s']} анкет/с, {result['updates_per_s']} обновлений/с")
+    print(f"Исходы: {result['outcomes']}")
+    print(f"{'шаг':<15}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, s in steps.items():
+        print(f"{name:<15}{s['count']:>8}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+    for key, value in extra.items():
+        print(f"{key}: {value}")
+    return result
+
+
+def run(args) -> int:
+    check_target_db(args)
+    telegram = FakeTelegram(latency=args.telegram_latency_ms / 1000).start()
+    openai_fake = FakeOpenAI(
+        latency=args.llm_latency_ms / 1000,
+        first_token=args.llm_first_token_ms / 1000,
+        error_rate=args.llm_error_rate,
+    ).start()
+    configure(args, telegram, openai_fake)
+
+    # Модули бота импортируются только после настройки окружения
+    import db
+    import main_client
+    import metrics
+    from analytics import AnalyticsWriter
+    from config import ANALYTICS_ENABLED, ANALYTICS_FLUSH_MS, ANALYTICS_FLUSH_ROWS, ANALYTICS_MAX_PENDING
+    from config import DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, PERSISTENCE_ENABLED
+    from persistence import PostgresPersistence
+    from serving import QueuedBot, build_updater
+    from tools import standin_db
+
+    user_ids = range(args.first_user_id, args.first_user_id + args.users)
+    if args.postgres:
+        seed_postgres(db.connection, user_ids)
+    else:
+        data = standin_db.StandInData(
+            {user_id: BUSINESS_TYPE for user_id in user_ids},
+            {BUSINESS_TYPE: QUESTIONS},
+            {BUSINESS_TYPE: PROMPT},
+        )
+        standin_db.install(standin_db.StandInPool(
+            data, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+            latency=args.db_latency_ms / 1000, connect_latency=args.db_connect_ms / 1000,
+        ))
+
+    persistence = None
+    if args.postgres and PERSISTENCE_ENABLED:
+        persistence = PostgresPersistence(BUSINESS_TYPE)
+    if args.postgres and ANALYTICS_ENABLED:
+        # Встроенная замена БД не поддерживает запись аналитики
+        main_client.analytics_writer = AnalyticsWriter(ANALYTICS_FLUSH_MS / 1000, ANALYTICS_FLUSH_ROWS, ANALYTICS_MAX_PENDING)
+    updater = build_updater(FAKE_TOKEN, persistence=persistence)
+    updater.dispatcher.add_handler(main_client.build_conversation(persistent=persistence is not None))
+    updater.job_queue.start()
+    threading.Thread(target=updater.dispatcher.start, name="dispatcher", daemon=True).start()
+    while not updater.dispatcher.running:
+        time.sleep(0.01)
+
+    harness = Harness(updater.bot, updater.update_queue, telegram,
+                      args.step_timeout, args.think_ms / 1000, args.repeat_answers)
+    sampler = PoolSampler(db.pool_stats).start()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="user") as executor:
+        list(executor.map(harness.run_user, user_ids))
+    elapsed = time.monotonic() - started
+    sampler.stop()
+
+    snapshot = metrics.registry.snapshot()
+    extra = {
+        "handlers": snapshot.get("bot_handler_duration_seconds", {}),
+        "db_queries": snapshot.get("bot_db_query_seconds", {}),
+        "db_pool": db.pool_stats(),
+        "db_pool_peak": dict(sampler.peak),
+        "update_queue": updater.update_queue.stats(),
+        "waiting_updates": main_client.waiting_updates.stats(),
+        "review_jobs": main_client.review_pipeline.stats(),
+        "review_cache": main_client.review_cache.stats(),
+        "openai": openai_fake.stats(),
+        "telegram": telegram.stats(),
+    }
+    if isinstance(updater.bot, QueuedBot):
+        extra["outbound"] = updater.bot.outbound.stats()
+    if main_client.analytics_writer is not None:
+        extra["analytics"] = main_client.analytics_writer.stats()
+    result = report(args, harness, elapsed, extra)
+
+    updater.dispatcher.stop()
+    updater.job_queue.stop()
+    main_client.review_pipeline.shutdown()
+    if isinstance(updater.bot, QueuedBot):
+        updater.bot.outbound.stop()
+    if persistence is not None:
+        persistence.flush()
+    if main_client.analytics_writer is not None:
+        main_client.analytics_writer.close()
+    if args.postgres:
+        cleanup_postgres(db.connection, user_ids, persistence is not None, main_client.analytics_writer is not None)
+    db.close_pool()
+    telegram.stop()
+    openai_fake.stop()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2, default=str)
+
+    failed = args.users - harness.outcomes.get("completed", 0)
+    slow = [name for name, s in result["steps"].items() if args.check_p95_ms and s["p95_ms"] > args.check_p95_ms]
+    if failed > args.max_failed or slow:
+        print(f"ПРОВАЛ: незавершённых анкет {failed} (допустимо {args.max_failed}), p95 выше порога: {slow or 'нет'}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд клиентского бота")
+    parser.add_argument("--users", type=int, default=1000, help="всего синтетических пользователей")
+    parser.add_argument("--concurrency", type=int, default=100, help="пользователей, проходящих анкету одновременно")
+    parser.add_argument("--think-ms", type=float, default=0, help="пауза пользователя между шагами")
+    parser.add_argument("--step-timeout", type=float, default=120, help="ожидание ответа бота на шаг, с")
+    parser.add_argument("--repeat-answers", action="store_true", help="одинаковые ответы у всех (проверка кэша отзывов)")
+    parser.add_argument("--no-limits", action="store_true", help="снять лимиты Telegram и OpenAI")
+    parser.add_argument("--telegram-latency-ms", type=float, default=20)
+    parser.add_argument("--llm-latency-ms", type=float, default=1500, help="полное время ответа OpenAI")
+    parser.add_argument("--llm-first-token-ms", type=float, default=300)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--postgres", action="store_true", help="настоящий Postgres из DB_* вместо встроенной замены")
+    parser.add_argument("--allow-destructive", action="store_true",
+                        help="разрешить --postgres на базе без test в DB_NAME")
+    parser.add_argument("--first-user-id", type=int, default=FIRST_USER_ID, help="первый ID синтетических пользователей")
+    parser.add_argument("--db-latency-ms", type=float, default=1, help="время запроса во встроенной замене БД")
+    parser.add_argument("--db-connect-ms", type=float, default=20, help="время открытия соединения во встроенной замене")
+    parser.add_argument("--json", help="записать отчёт в файл JSON")
+    parser.add_argument("--max-failed", type=int, default=0, help="допустимо незавершённых анкет")
+    parser.add_argument("--check-p95-ms", type=float, help="порог p95 для каждого шага")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Встроенная замена Postgres для нагрузочного стенда: настоящий db.ConnectionPool,
+# но «соединения» отвечают из памяти на запросы клиентского бота (users, questions, prompts)
+# с настраиваемой задержкой. Так счётчики пула (размер, занятость, ожидание соединения)
+# остаются настоящими, а стенд не требует запущенной базы.
+import threading
+import time
+
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+import db
+
+
+class StandInData:
+    def __init__(self, users: dict, questions: dict, prompts: dict):
+        self.users = users          # telegram_id -> business_type
+        self.questions = questions  # business_type -> [текст вопроса]
+        self.prompts = prompts      # business_type -> текст промпта
+        self._lock = threading.Lock()
+        self.queries = 0
+
+    # [(колонки, строки)] для поддерживаемых запросов
+    def query(self, sql: str, params):
+        with self._lock:
+            self.queries += 1
+        sql = " ".join(sql.split())
+        if sql == "SELECT 1":
+            return ["?column?"], [(1,)]
+        if "FROM users" in sql:
+            business_type = self.users.get(params[0])
+            rows = [(params[0], business_type)] if business_type is not None else []
+            return ["telegram_id", "business_type"], rows
+        if "FROM questions" in sql:
+            return ["question_text"], [(q,) for q in self.questions.get(params[0], [])]
+        if sql.startswith("SELECT DISTINCT business_type FROM prompts"):
+            return ["business_type"], [(b,) for b in sorted(self.prompts)[:params[0]]]
+        if "FROM prompts" in sql:
+            prompt = self.prompts.get(params[0])
+            return ["prompt_text"], [(prompt,)] if prompt is not None else []
+        raise psycopg2.NotSupportedError(f"Запрос не поддерживается встроенной заменой БД: {sql}")
+
+
+class _Info:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class StandInCursor:
+    def __init__(self, conn, cursor_factory=None):
+        self._conn = conn
+        self._as_dict = cursor_factory is RealDictCursor
+        self._rows = []
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, sql, params=None):
+        if self._conn.latency:
+            time.sleep(self._conn.latency)
+        columns, rows = self._conn.data.query(sql, params or ())
+        self._rows = [dict(zip(columns, row)) for row in rows] if self._as_dict else list(rows)
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        self._rows = []
+
+
+class StandInConnection:
+    info = _Info()
+
+    def __init__(self, data: StandInData, latency: float):
+        self.data = data
+        self.latency = latency
+        self.closed = 0
+
+    def cursor(self, name=None, cursor_factory=None):
+        return StandInCursor(self, cursor_factory)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+# db.ConnectionPool с соединениями StandInConnection; connect_latency имитирует открытие соединения
+class StandInPool(db.ConnectionPool):
+    def __init__(self, data: StandInData, minconn: int, maxconn: int, timeout: float,
+                 latency: float = 0.0, connect_latency: float = 0.0):
+        super().__init__(minconn, maxconn, timeout, check_idle=float("inf"))
+        self.data = data
+        self.latency = latency
+        self.connect_latency = connect_latency
+
+    def _connect(self):
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+        return StandInConnection(self.data, self.latency)
+
+
+# Подменяет общий пул процесса: db.connection() будет выдавать соединения StandInPool
+def install(pool: StandInPool):
+    db.close_pool()
+    with db._pool_lock:
+        db._pool = pool
+    pool.prefill()
@@ -0,0 +1,100 @@
+# Отчёт о времени импорта точки входа бота на основе python -X importtime:
+#     python -m tools.startup_report main_client --runs 5
+#     python -m tools.startup_report main_admin --json --check-ms 600
+# Импорт запускается в отдельных процессах runs раз, в отчёт идёт прогон с медианным временем:
+# общее время, прямые импорты модуля (что тянет каждый) и самые тяжёлые пакеты по собственному времени.
+# С --check-ms код выхода 1, если импорт дольше порога – так время запуска отслеживается как регрессия.
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import Counter, namedtuple
+
+# Строка вывода -X importtime: собственное и накопленное время в микросекундах, глубина вложенности
+ImportTime = namedtuple("ImportTime", ["name", "depth", "self_us", "cumulative_us"])
+
+
+def parse(output: str):
+    result = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # заголовок
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        result.append(ImportTime(name.strip(), depth, int(parts[0]), int(parts[1])))
+    return result
+
+
+def measure(module: str) -> list:
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env,
+    )
+    if process.returncode:
+        raise RuntimeError(f"Импорт {module} завершился ошибкой:\n{process.stderr[-2000:]}")
+    return parse(process.stderr)
+
+
+def report(module: str, times: list, top: int) -> dict:
+    index = max(i for i, t in enumerate(times) if t.depth == 0 and t.name == module)
+    # Дочерние импорты выводятся до родителя: идём назад до предыдущего импорта верхнего уровня
+    direct = []
+    for t in reversed(times[:index]):
+        if t.depth == 0:
+            break
+        if t.depth == 1:
+            direct.append(t)
+    packages = Counter()
+    for t in times[:index + 1]:
+        packages[t.name.split(".")[0]] += t.self_us
+    return {
+        "module": module,
+        "total_ms": round(times[index].cumulative_us / 1000, 1),
+        "interpreter_ms": round(sum(t.cumulative_us for t in times[:index] if t.depth == 0) / 1000, 1),
+        "modules": index + 1,
+        "direct": {t.name: round(t.cumulative_us / 1000, 1)
+                   for t in sorted(direct, key=lambda t: -t.cumulative_us)[:top]},
+        "packages": {name: round(us / 1000, 1) for name, us in packages.most_common(top)},
+    }
+
+
+def print_report(result: dict, runs: list):
+    print(f"Импорт {result['module']}: {result['total_ms']} мс (прогоны: {', '.join(f'{r:.0f}' for r in runs)} мс), "
+          f"модулей {result['modules']}, до него интерпретатор {result['interpreter_ms']} мс")
+    print("\nПрямые импорты (накопленное время, мс):")
+    for name, ms in result["direct"].items():
+        print(f"  {ms:8.1f}  {name}")
+    print("\nПакеты (собственное время модулей, мс):")
+    for name, ms in result["packages"].items():
+        print(f"  {ms:8.1f}  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта точки входа бота")
+    parser.add_argument("module", nargs="?", default="main_client")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="сколько импортов и пакетов показывать")
+    parser.add_argument("--json", action="store_true", help="вывести отчёт одной строкой JSON")
+    parser.add_argument("--check-ms", type=float, help="код выхода 1, если импорт дольше")
+    args = parser.parse_args()
+
+    results = sorted((report(args.module, measure(args.module), args.top) for _ in range(max(1, args.runs))),
+                     key=lambda r: r["total_ms"])
+    result = results[len(results) // 2]
+    runs = [r["total_ms"] for r in results]
+    if args.json:
+        print(json.dumps({**result, "runs_ms": runs}, ensure_ascii=False))
+    else:
+        print_report(result, runs)
+    if args.check_ms is not None and result["total_ms"] > args.check_ms:
+        print(f"Импорт {args.module} дольше {args.check_ms:.0f} мс", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
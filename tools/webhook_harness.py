@@ -0,0 +1,153 @@
+# Нагрузочный стенд для режима webhook: отправляет синтетические Update в формате JSON
+# и измеряет пропускную способность без обращения к Telegram.
+#
+# Локально (встроенный webhook-сервер с ограниченной очередью и «пустыми» обработчиками):
+#     python -m tools.webhook_harness --updates 5000 --concurrency 32 --work-ms 20
+# Против уже запущенного бота (BOT_MODE=webhook):
+#     python -m tools.webhook_harness --url http://127.0.0.1:8443/<token> --updates 1000
+import argparse
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.ext import Defaults, Dispatcher, JobQueue, TypeHandler
+from telegram.ext.extbot import ExtBot
+from telegram.ext.utils.webhookhandler import WebhookAppClass, WebhookServer
+from telegram import Update, User
+
+from serving import UpdateQueue
+
+FAKE_TOKEN = "123456:harness"
+
+
+# Синтетическое текстовое сообщение от пользователя user_id
+def make_update(update_id: int, user_id: int, text: str = "/start") -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+        },
+    }
+
+
+def post_update(url: str, payload: dict, timeout: float):
+    data = json.dumps(payload).encode()
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    started = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception:
+        status = "error"
+    return status, time.monotonic() - started
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Встроенный сервер: та же очередь и диспетчер, что в serving.build_updater, но без set_webhook
+class LocalTarget:
+    def __init__(self, port: int, workers: int, queue_size: int, put_timeout: float, work_ms: float):
+        self.processed = 0
+        self._lock = threading.Lock()
+        self.work = work_ms / 1000
+        bot = ExtBot(FAKE_TOKEN, defaults=Defaults(run_async=True))
+        # Данные бота задаём заранее, чтобы не вызывать getMe у настоящего Bot API
+        bot._bot = User(int(FAKE_TOKEN.split(":")[0]), "harness", True, username="harness_bot")
+        self.update_queue = UpdateQueue(queue_size, put_timeout)
+        self.dispatcher = Dispatcher(bot, self.update_queue, workers=workers, job_queue=JobQueue())
+        self.dispatcher.add_handler(TypeHandler(Update, self._handle))
+        app = WebhookAppClass("/harness", bot, self.update_queue)
+        self.server = WebhookServer("127.0.0.1", port, app, None)
+        self.url = f"http://127.0.0.1:{port}/harness"
+
+    def _handle(self, update, context):
+        time.sleep(self.work)
+        with self._lock:
+            self.processed += 1
+
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self.server.serve_forever, kwargs={"ready": ready}, daemon=True).start()
+        threading.Thread(target=self.dispatcher.start, daemon=True).start()
+        ready.wait()
+
+    def wait_processed(self, expected: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        while self.processed < expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stop(self):
+        self.server.shutdown()
+        self.dispatcher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд webhook")
+    parser.add_argument("--url", help="адрес webhook запущенного бота; без него поднимается локальный сервер")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=500, help="количество разных пользователей")
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--put-timeout", type=float, default=1)
+    parser.add_argument("--work-ms", type=float, default=10, help="имитация работы обработчика (локальный режим)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+
+    target = None
+    url = args.url
+    if not url:
+        target = LocalTarget(args.port, args.workers, args.queue_size, args.put_timeout, args.work_ms)
+        target.start()
+        url = target.url
+
+    statuses = Counter()
+    latencies = []
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(post_update, url, make_update(i + 1, 1000 + i % args.users), args.timeout)
+            for i in range(args.updates)
+        ]
+        for future in futures:
+            status, latency = future.result()
+            statuses[status] += 1
+            latencies.append(latency)
+    sent = time.monotonic() - started
+
+    print(f"Отправлено: {args.updates} за {sent:.2f} с ({args.updates / sent:.0f} обновлений/с)")
+    print(f"Ответы: {dict(statuses)}")
+    print("Задержка POST, мс: p50={:.1f} p95={:.1f} p99={:.1f}".format(
+        *(percentile(latencies, p) * 1000 for p in (50, 95, 99))))
+
+    if target is not None:
+        target.wait_processed(statuses.get(200, 0), args.timeout)
+        total = time.monotonic() - started
+        print(f"Обработано: {target.processed} за {total:.2f} с ({target.processed / total:.0f} обновлений/с)")
+        print(f"Очередь: {target.update_queue.stats()}")
+        target.stop()
+
+
+if __name__ == "__main__":
+    main()